@@ -15,8 +15,8 @@ def main():
         ['\n\tConfiguration:', ''],
         ['set_threshold {number of bytes}', 'Set the threshold for the size of the memtable in bytes'],
         ['set_sparsity {value}', 'Set the sparsity factor for the DBs index'],
-        ['set_bf_num_items {items}', 'Set the number of expected items to be stored in the Bloom Filter. Warning: this overrides it.'],
-        ['set_bf_false_pos_prob {probability}', 'Set the desired false positive probability for the Bloom Filter. Warning: this overrides it.'],
+        ['set_bf_num_items {items}', 'Set the number of items the Bloom Filter starts out sized for. It is rebuilt in the background.'],
+        ['set_bf_false_pos_prob {probability}', 'Set the desired false positive probability for the Bloom Filter. It is rebuilt in the background.'],
         ['', ''],
         ['help', 'Print the usage message'],
         ['exit', 'Quit the program. Your instance will be saved to disk.']
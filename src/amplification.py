@@ -0,0 +1,41 @@
+# Counters of the bytes written to disk on behalf of users, by what wrote them
+WRITE_COUNTERS = ('wal_bytes', 'flush_bytes', 'value_log_bytes', 'compaction_bytes', 'merge_bytes')
+
+# Every amplification counter. live_bytes is only there when space is measured.
+COUNTERS = ('user_bytes',) + WRITE_COUNTERS + ('reads', 'segment_probes', 'disk_bytes', 'live_bytes')
+
+
+def amplification_ratios(counters):
+    ''' (dict) -> dict
+    Returns counters, the amplification counters of a DB, along with the
+    amplification they add up to: bytes written to disk per byte written by
+    users (write), segments probed per read (read) and, if counters holds
+    live_bytes, bytes on disk per byte of live records (space). Ratios are 0.0
+    until there is something to divide by.
+    '''
+    ratios = dict(counters)
+    ratios['write'] = ratio(sum(counters[name] for name in WRITE_COUNTERS), counters['user_bytes'])
+    ratios['read'] = ratio(counters['segment_probes'], counters['reads'])
+    if 'live_bytes' in counters:
+        ratios['space'] = ratio(counters['disk_bytes'], counters['live_bytes'])
+    return ratios
+
+
+def ratio(numerator, denominator):
+    ''' (int, int) -> float
+    Returns numerator / denominator, rounded, or 0.0 if denominator is 0.
+    '''
+    return round(numerator / denominator, 6) if denominator else 0.0
+
+
+def combined_amplification(stats):
+    ''' ([dict]) -> dict
+    Returns the amplification of a DB split into parts with the given statistics,
+    from the sums of the amplification counters of the parts.
+    '''
+    counters = {}
+    for part in stats:
+        for name in COUNTERS:
+            if 'amplification.' + name in part:
+                counters[name] = counters.get(name, 0) + int(part['amplification.' + name])
+    return amplification_ratios(counters) if counters else {}
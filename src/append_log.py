@@ -1,21 +1,43 @@
+import logging
+import os
+import struct
 import threading
+import zlib
+from os import rename as rename_file, replace as replace_file
+from pathlib import Path
 
 from tenacity import retry
 
 
+logger = logging.getLogger(__name__)
+
 lock = threading.Lock()
 
+# Each record is a header holding the CRC32 of the rest of the record and the
+# lengths of the key and value, followed by the UTF-8 encoded key and value
+RECORD_HEADER = struct.Struct('<III')
+RECORD_LENGTHS = struct.Struct('<II')
+
+# Number of bytes read from a log at a time while replaying it
+READ_SIZE = 1024 * 1024
+
+# Logs written before records were binary hold one key,value line per record.
+# They are rewritten as binary records through a file named with this prefix.
+LEGACY_UPGRADE_PREFIX = 'upgrading-'
+
 
 class Singleton:
     def __init__(self, decorated):
         self._decorated = decorated
+        self._instances = {}
 
     def instance(self, filename):
-        try:
-            return self._instance
-        except AttributeError:
-            self._instance = self._decorated(filename)
-            return self._instance
+        # There is a single instance per file, so that several trees can live in
+        # the same process without sharing a log.
+        with lock:
+            if filename not in self._instances:
+                self._instances[filename] = self._decorated(filename)
+            return self._instances[filename]
 
     def __call__(self):
         raise TypeError('Singletons must be accessed through `instance()`.')
@@ -27,11 +49,25 @@ class Singleton:
 class AppendLog:
     def __init__(self, filename):
         self.filename = filename
-        self.stream = open(filename, 'a')
+        self.stream = open(filename, 'ab')
         self.is_clearing = False
+        self.subscribers = []
+
+    def write(self, key, value):
+        ''' (self, str, str) -> int
+        Appends a record of key being set to value to the log. Returns the number
+        of bytes the record takes up.
+        '''
+        record = encode_record(key, value)
+        self.write_to_stream(record)
+
+        # Subscribers only hear about records once they are in the log
+        for subscriber in self.subscribers:
+            subscriber(key, value)
+        return len(record)
 
     @retry
-    def write(self, val):
+    def write_to_stream(self, val):
         try:
             while self.is_clearing:
                 pass
@@ -40,13 +76,152 @@ class AppendLog:
         except IOError:
             print("The file stream isn't currently open")
 
+    def subscribe(self, subscriber):
+        ''' (self, function) -> None
+        Calls subscriber with the key and value of every record written to the
+        log from now on.
+        '''
+        self.subscribers.append(subscriber)
+
+    def unsubscribe(self, subscriber):
+        ''' (self, function) -> None
+        Stops calling subscriber with the records written to the log.
+        '''
+        self.subscribers.remove(subscriber)
+
     def clear(self):
         with lock:
             self.is_clearing = True
             try:
                 self.stream.close()
                 # Clearing the stream should clear the current file contents
-                self.stream = open(self.filename, 'w')
+                self.stream = open(self.filename, 'wb')
+            finally:
+                self.is_clearing = False
+
+    def rotate(self, archive_filename):
+        ''' (self, str) -> None
+        Moves the current contents of the log to archive_filename and
+        continues with an empty log under the original filename.
+        '''
+        with lock:
+            self.is_clearing = True
+            try:
+                self.stream.close()
+                if Path(self.filename).exists():
+                    rename_file(self.filename, archive_filename)
+                self.stream = open(self.filename, 'wb')
+            finally:
+                self.is_clearing = False
+
+    def reopen(self):
+        ''' (self) -> None
+        Continues the log in the file now at filename, after it was replaced.
+        '''
+        with lock:
+            self.is_clearing = True
+            try:
+                self.stream.close()
+                self.stream = open(self.filename, 'ab')
             finally:
                 self.is_clearing = False
 
+
+def encode_record(key, value):
+    ''' (str, str) -> bytes
+    Returns the log record of key being set to value.
+    '''
+    key, value = key.encode(), value.encode()
+    body = RECORD_LENGTHS.pack(len(key), len(value)) + key + value
+    return struct.pack('<I', zlib.crc32(body)) + body
+
+
+def read_records(filename):
+    ''' (str) -> generator
+    Yields the key and value of every record of the log at filename, in order.
+
+    The log is read READ_SIZE bytes at a time. Reading stops at the first record
+    that is cut short or fails its checksum, which is where a crash interrupted
+    the last write.
+    '''
+    header_size = RECORD_HEADER.size
+    with open(filename, 'rb') as s:
+        buffer, position = b'', 0
+        while True:
+            # Carry over the start of a record that runs into the next chunk
+            chunk = s.read(READ_SIZE)
+            buffer = buffer[position:] + chunk
+            position = 0
+            end = len(buffer)
+
+            while position + header_size <= end:
+                checksum, key_size, value_size = RECORD_HEADER.unpack_from(buffer, position)
+                record_end = position + header_size + key_size + value_size
+                if record_end > end:
+                    break
+
+                if zlib.crc32(buffer[position + 4:record_end]) != checksum:
+                    logger.warning('Ignoring corrupt record at the end of %s', filename)
+                    return
+
+                key_end = position + header_size + key_size
+                yield buffer[position + header_size:key_end].decode(), buffer[key_end:record_end].decode()
+                position = record_end
+
+            if not chunk:
+                if position < end:
+                    logger.warning('Ignoring torn record at the end of %s', filename)
+                return
+
+
+def is_legacy_log(filename):
+    ''' (str) -> Boolean
+    Returns whether the log at filename holds key,value lines, as logs did before
+    records were binary, rather than binary records.
+    '''
+    with open(filename, 'rb') as s:
+        data = s.read()
+    if not data:
+        return False
+
+    # A binary log starts with a record that passes its checksum, unless a crash
+    # cut its first record short
+    header_size = RECORD_HEADER.size
+    if len(data) >= header_size:
+        checksum, key_size, value_size = RECORD_HEADER.unpack_from(data)
+        record_end = header_size + key_size + value_size
+        if record_end <= len(data) and zlib.crc32(data[4:record_end]) == checksum:
+            return False
+
+    try:
+        lines = data.decode().splitlines()
+    except UnicodeDecodeError:
+        return False
+    return all(',' in line for line in lines if line)
+
+
+def read_legacy_records(filename):
+    ''' (str) -> generator
+    Yields the key and value of every line of the legacy log at filename, in order.
+    '''
+    with open(filename, 'r') as s:
+        for line in s:
+            key, separator, value = line.strip().partition(',')
+            if separator:
+                yield key, value
+
+
+def upgrade_legacy_log(filename):
+    ''' (str) -> None
+    Rewrites the legacy log at filename as binary records. The records are written
+    to a file of their own, which then replaces the log, so that a crash leaves
+    one or the other whole.
+    '''
+    path = Path(filename)
+    upgrade_path = str(path.with_name(LEGACY_UPGRADE_PREFIX + path.name))
+    with open(upgrade_path, 'wb') as s:
+        s.write(b''.join(encode_record(key, value) for key, value in read_legacy_records(filename)))
+        s.flush()
+        os.fsync(s.fileno())
+    replace_file(upgrade_path, filename)
+    logger.info('Upgraded %s to binary records', filename)
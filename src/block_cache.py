@@ -0,0 +1,148 @@
+from collections import OrderedDict, defaultdict
+import threading
+
+
+# Size of the byte ranges segments are read and cached in
+BLOCK_SIZE = 4096
+
+# Default memory budget of a block cache, in bytes
+BLOCK_CACHE_CAPACITY = 8 * 1024 * 1024
+
+
+class BlockCache:
+    def __init__(self, capacity=BLOCK_CACHE_CAPACITY):
+        ''' (self, int) -> BlockCache
+        Creates a cache of decoded segment blocks holding up to capacity bytes of
+        records. The least recently used blocks are evicted first.
+
+        Blocks are cached by (path, generation, block number). A cache may be
+        shared by several trees, as their segments have different paths.
+        '''
+        self.capacity = capacity
+        self.blocks = OrderedDict()
+        self.keys_by_path = defaultdict(set)
+        self.size = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        ''' (self, tuple) -> dict
+        Returns the block cached under key, or None.
+        '''
+        with self.lock:
+            entry = self.blocks.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.blocks.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, block, size):
+        ''' (self, tuple, dict, int) -> None
+        Caches block, which takes up size bytes, under key. Blocks larger than the
+        whole cache aren't kept.
+        '''
+        if size > self.capacity:
+            return
+
+        with self.lock:
+            if key in self.blocks:
+                return
+
+            self.blocks[key] = (block, size)
+            self.keys_by_path[key[0]].add(key)
+            self.size += size
+            self.evict(self.capacity)
+
+    def invalidate(self, path):
+        ''' (self, str) -> None
+        Drops every block of the segment at path.
+        '''
+        with self.lock:
+            for key in self.keys_by_path.pop(path, ()):
+                self.size -= self.blocks.pop(key)[1]
+
+    def set_capacity(self, capacity):
+        ''' (self, int) -> None
+        Sets the memory budget of the cache, in bytes, evicting blocks as needed.
+        '''
+        with self.lock:
+            self.capacity = capacity
+            self.evict(capacity)
+
+    def stats(self):
+        ''' (self) -> dict
+        Returns the hit and miss counts of the cache along with its occupancy.
+        '''
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 6) if lookups else 0.0,
+            'evictions': self.evictions,
+            'blocks': len(self.blocks),
+            'bytes': self.size,
+            'capacity': self.capacity,
+        }
+
+    # Helpers
+    def evict(self, capacity):
+        ''' (self, int) -> None
+        Evicts the least recently used blocks until the cache fits in capacity.
+
+        Note: the caller must hold lock.
+        '''
+        while self.size > capacity:
+            key, (_, size) = self.blocks.popitem(last=False)
+            self.size -= size
+            self.evictions += 1
+
+            keys = self.keys_by_path[key[0]]
+            keys.discard(key)
+            if not keys:
+                del self.keys_by_path[key[0]]
+
+
+def read_block(data, number):
+    ''' (bytes, int) -> (dict, int)
+    Reads block number of a segment from data, the segment's contents or a memory
+    map of them. Returns the records that start within the block, by key in file
+    order, and the number of bytes they take up.
+    '''
+    first, stop = block_bounds(data, number)
+    if first == stop:
+        return {}, 0
+    chunk = data[first:stop]
+
+    records = {}
+    for line in chunk.decode().split('\n'):
+        if line:
+            key, _, value = line.strip().partition(',')
+            records[key] = value.strip()
+
+    return records, len(chunk)
+
+
+def block_bounds(data, number):
+    ''' (bytes, int) -> (int, int)
+    Returns the offsets in data, a segment's contents, where the records of block
+    number start and end. Both are the same if no record starts within the block.
+    '''
+    start = number * BLOCK_SIZE
+    end = min(start + BLOCK_SIZE, len(data))
+
+    # A record belongs to the block its first byte is in, so skip the tail of
+    # the record that runs into the block from the one before
+    first = data.find(b'\n', start - 1, end) + 1 if start else 0
+    if (start and first == 0) or first >= end:
+        return end, end
+
+    # The last record of the block ends at the first newline from its last byte
+    stop = data.find(b'\n', end - 1)
+    stop = len(data) if stop == -1 else stop + 1
+    return first, stop
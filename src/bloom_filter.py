@@ -1,8 +1,34 @@
-from math import log
-from mmh3 import hash
+from math import ceil, exp, lgamma, log
+from mmh3 import hash, hash64
 from bitarray import bitarray 
+import mmap
+import numpy as np
+import os
+import struct
+
+# Bits in a block of a BlockedBloomFilter, one 64 byte cache line
+BLOCK_BITS = 512
+
+# Filter files hold a header followed by the bit array, as is, so that they can
+# be memory mapped. The header holds the magic, the format version, the hash
+# scheme, the bit array size, the number of hash functions and the false
+# positive probability.
+FILTER_FILE_MAGIC = b'LSBF'
+FILTER_FILE_VERSION = 1
+FILTER_FILE_HEADER = struct.Struct('<4sHHQId')
+
+# Scalable filters follow the header with their initial capacity, growth factor
+# and tightening ratio, and use the bit array size for their number of
+# sub-filters, which come next in the file.
+SCALABLE_FILTER_HEADER = struct.Struct('<Qdd')
+
+# Headers and bit arrays start on cache line boundaries
+FILTER_FILE_HEADER_SIZE = 64
   
 class BloomFilter:
+    # Stored in filter files, to tell how the bits of an item are picked
+    HASH_SCHEME = 0
+
     def __init__(self, num_items, false_positive_prob): 
         ''' (self, int, float) -> BloomFilter
         Creates a new BloomFilter. num_items represents the number of items 
@@ -42,8 +68,104 @@ class BloomFilter:
                 # if any bit is false, the item is not definitely present
                 return False
         return True
+
+    def add_many(self, items):
+        ''' (self, [str]) -> None
+        Add every item in items to the BloomFilter, setting their bits all at once.
+        '''
+        if not len(items):
+            return
+
+        # Bits are set in place, in the bytes that hold them, so that the cost
+        # only depends on the number of items and not on the size of the filter
+        digests = self.digests_many(items).ravel()
+        masks = (128 >> (digests & 7)).astype(np.uint8)
+        np.bitwise_or.at(self.bit_buffer(), digests >> 3, masks)
+
+    def check_many(self, items):
+        ''' (self, [str]) -> [Boolean]
+        Check for existence of every item in items in the filter, in order.
+        '''
+        digests = self.digests_many(items)
+        bits = self.bit_buffer()[digests >> 3] & (128 >> (digests & 7))
+        return (bits != 0).all(axis=1).tolist()
+
+    def save(self, path):
+        ''' (self, str) -> None
+        Writes the filter to path in the filter file format.
+
+        The file is replaced atomically, so filters memory mapped from the
+        previous version of it are unaffected.
+        '''
+        temp_path = path + '_temp'
+        with open(temp_path, 'wb') as s:
+            self.write(s)
+        os.replace(temp_path, path)
+
+    def write(self, stream):
+        ''' (self, file) -> None
+        Writes the header and bit array of the filter to stream.
+        '''
+        header = FILTER_FILE_HEADER.pack(
+            FILTER_FILE_MAGIC, FILTER_FILE_VERSION, self.HASH_SCHEME,
+            self.bit_array_size, self.num_hash_fns, self.false_positive_prob)
+        stream.write(header.ljust(FILTER_FILE_HEADER_SIZE, b'\0'))
+
+        bits = self.bit_array.tobytes()
+        stream.write(bits.ljust(padded_size(len(bits)), b'\0'))
+
+    def fill_ratio(self):
+        ''' (self) -> float
+        Returns the share of the bits of the filter that are set.
+        '''
+        return self.bit_array.count() / max(self.bit_array_size, 1)
+
+    def estimated_items(self):
+        ''' (self) -> int
+        Estimates the number of distinct items added to the filter from its fill ratio.
+
+        n = -(m / k) * ln(1 - X / m)
+        '''
+        fill_ratio = self.fill_ratio()
+        if not self.num_hash_fns:
+            return 0
+        if fill_ratio >= 1:
+            return self.bit_array_size
+
+        return int(-(self.bit_array_size / self.num_hash_fns) * log(1 - fill_ratio))
+
+    def estimated_false_positive_prob(self):
+        ''' (self) -> float
+        Estimates the current false positive probability from the fill ratio: an
+        absent item is let through when all of its bits happen to be set.
+
+        p = (X / m)^k
+        '''
+        return self.fill_ratio() ** self.num_hash_fns
+
+    def num_bits(self):
+        ''' (self) -> int
+        Returns the size of the filter in bits.
+        '''
+        return self.bit_array_size
   
     # Helpers
+    def digests_many(self, items):
+        ''' (self, [str]) -> ndarray
+        Returns the positions of the bits of each item in items, one row per item.
+        '''
+        seeds = range(self.num_hash_fns)
+        digests = np.array([hash(item, seed) for item in items for seed in seeds],
+                           dtype=np.int64).reshape(len(items), self.num_hash_fns)
+        return digests % max(self.bit_array_size, 1)
+
+    def bit_buffer(self):
+        ''' (self) -> ndarray
+        Returns the bytes of the bit array, shared with it. Bits are stored big
+        endian, so bit i is the bit 128 >> (i % 8) of byte i // 8.
+        '''
+        return np.frombuffer(self.bit_array, dtype=np.uint8)
+
     def bit_array_size(self, num_items, probability):
         ''' (self, int, float) -> int
         Return the required size of the bit array, m, as a function
@@ -71,3 +193,341 @@ class BloomFilter:
         digest for the same input.
         '''
         return int((bit_arr_size/num_items) * log(2))
+
+
+class BlockedBloomFilter(BloomFilter):
+    HASH_SCHEME = 1
+
+    def __init__(self, num_items, false_positive_prob):
+        ''' (self, int, float) -> BlockedBloomFilter
+        Creates a new BloomFilter that keeps all of the bits of an item within
+        one 64 byte block, so that a check touches a single cache line.
+
+        Items are hashed once, with the 128 bit MurmurHash3. One half picks the
+        block and the other is split in two values, a and b, which give the bits
+        within the block as a + i * b + i(i - 1)(i - 2) / 6. This is Kirsch-Mitzenmacher
+        double hashing, with the cubic term of enhanced double hashing: within a
+        block of 512 bits, plain a + i * b sequences overlap often enough to
+        double the false positive rate of filters with many hash functions.
+        '''
+        super().__init__(num_items, false_positive_prob)
+
+        # Round the bit array up to whole blocks
+        self.num_blocks = max(1, ceil(self.bit_array_size / BLOCK_BITS))
+        self.bit_array_size = self.num_blocks * BLOCK_BITS
+        self.bit_array = bitarray(self.bit_array_size)
+        self.bit_array.setall(0)
+
+    def add(self, item):
+        ''' (self, str) -> None
+        Add item to the BloomFilter.
+        '''
+        block_hash, probe_hash = hash64(item, signed=False)
+        start = (block_hash % self.num_blocks) * BLOCK_BITS
+        a = probe_hash & 0xffffffff
+        b = probe_hash >> 32
+
+        bit_array = self.bit_array
+        for i in range(self.num_hash_fns):
+            bit_array[start + a % BLOCK_BITS] = True
+            a += b
+            b += i
+
+    def check(self, item):
+        ''' (self, str) -> Boolean
+        Check for existence of an item in filter
+        '''
+        block_hash, probe_hash = hash64(item, signed=False)
+        start = (block_hash % self.num_blocks) * BLOCK_BITS
+        a = probe_hash & 0xffffffff
+        b = probe_hash >> 32
+
+        bit_array = self.bit_array
+        for i in range(self.num_hash_fns):
+            if not bit_array[start + a % BLOCK_BITS]:
+                return False
+            a += b
+            b += i
+        return True
+
+    def expected_false_positive_prob(self, num_items):
+        ''' (self, int) -> float
+        Returns the false positive probability of the filter once it holds num_items.
+
+        This is higher than for an unblocked filter of the same size, since the
+        number of items per block varies. Each block gets a Poisson distributed
+        number of items i, with mean l = n / blocks, and then acts as a filter of
+        512 bits holding i items:
+
+        f = sum(e^-l * l^i / i! * (1 - (1 - 1/512)^(i * k))^k)
+        '''
+        if not self.num_hash_fns:
+            return 1.0
+
+        mean = num_items / self.num_blocks
+        probability = 0.0
+        for i in range(int(mean + 10 * mean ** 0.5) + 20):
+            items = exp(-mean + i * log(mean) - lgamma(i + 1)) if mean else float(i == 0)
+            probability += items * (1 - (1 - 1 / BLOCK_BITS) ** (i * self.num_hash_fns)) ** self.num_hash_fns
+        return probability
+
+    def estimated_false_positive_prob(self):
+        ''' (self) -> float
+        Estimates the current false positive probability from the number of
+        items the fill ratio suggests the filter holds.
+        '''
+        return self.expected_false_positive_prob(self.estimated_items())
+
+    # Helpers
+    def digests(self, item):
+        ''' (self, str) -> [int]
+        Returns the positions of the bits of item in the bit array.
+
+        add and check inline this, as the extra call adds up on every lookup.
+        '''
+        block_hash, probe_hash = hash64(item, signed=False)
+        start = (block_hash % self.num_blocks) * BLOCK_BITS
+        a = probe_hash & 0xffffffff
+        b = probe_hash >> 32
+        return [start + (a + i * b + i * (i - 1) * (i - 2) // 6) % BLOCK_BITS
+                for i in range(self.num_hash_fns)]
+
+    def digests_many(self, items):
+        ''' (self, [str]) -> ndarray
+        Returns the positions of the bits of each item in items, one row per item.
+        '''
+        hashes = np.array([hash64(item, signed=False) for item in items],
+                          dtype=np.uint64).reshape(len(items), 2)
+        start = (hashes[:, 0] % np.uint64(self.num_blocks)) * np.uint64(BLOCK_BITS)
+        a = hashes[:, 1] & np.uint64(0xffffffff)
+        b = hashes[:, 1] >> np.uint64(32)
+
+        # Only the bits below BLOCK_BITS matter, so overflows are harmless
+        i = np.arange(self.num_hash_fns, dtype=np.int64)
+        cubic = (i * (i - 1) * (i - 2) // 6).astype(np.uint64)
+        i = i.astype(np.uint64)
+        probes = (a[:, None] + i * b[:, None] + cubic) % np.uint64(BLOCK_BITS)
+        return (start[:, None] + probes).astype(np.int64)
+
+
+
+class ScalableBloomFilter:
+    HASH_SCHEME = 2
+
+    def __init__(self, initial_capacity, false_positive_prob, growth_factor=2, tightening_ratio=0.8):
+        ''' (self, int, float, int, float) -> ScalableBloomFilter
+        Creates a BloomFilter that grows with the number of items added to it,
+        while keeping its false positive probability under false_positive_prob.
+
+        Items go to the newest of a series of BlockedBloomFilters. Once it is full,
+        judging by how many of its bits are set, a new filter is added with
+        growth_factor times the capacity and tightening_ratio times the false
+        positive probability, so that the sum of their probabilities stays under
+        false_positive_prob.
+        '''
+        self.initial_capacity = initial_capacity
+        self.false_positive_prob = false_positive_prob
+        self.growth_factor = growth_factor
+        self.tightening_ratio = tightening_ratio
+        self.filters = []
+        self.add_filter()
+
+    def add(self, item):
+        ''' (self, str) -> None
+        Add item to the BloomFilter.
+        '''
+        if self.active_count >= self.capacity():
+            self.grow()
+
+        self.filters[-1].add(item)
+        self.active_count += 1
+
+    def check(self, item):
+        ''' (self, str) -> Boolean
+        Check for existence of an item in filter
+        '''
+        for bloom_filter in self.filters:
+            if bloom_filter.check(item):
+                return True
+        return False
+
+    def add_many(self, items):
+        ''' (self, [str]) -> None
+        Add every item in items to the BloomFilter, a batch per sub-filter.
+        '''
+        while items:
+            if self.active_count >= self.capacity():
+                self.grow()
+
+            batch = items[:self.capacity() - self.active_count]
+            self.filters[-1].add_many(batch)
+            self.active_count += len(batch)
+            items = items[len(batch):]
+
+    def check_many(self, items):
+        ''' (self, [str]) -> [Boolean]
+        Check for existence of every item in items in the filter, in order.
+        '''
+        found = np.zeros(len(items), dtype=bool)
+        for bloom_filter in self.filters:
+            found |= np.array(bloom_filter.check_many(items), dtype=bool)
+        return found.tolist()
+
+    def save(self, path):
+        ''' (self, str) -> None
+        Writes the filter to path in the filter file format.
+        '''
+        temp_path = path + '_temp'
+        with open(temp_path, 'wb') as s:
+            self.write(s)
+        os.replace(temp_path, path)
+
+    def write(self, stream):
+        ''' (self, file) -> None
+        Writes the header of the filter to stream, followed by its sub-filters.
+        '''
+        header = FILTER_FILE_HEADER.pack(
+            FILTER_FILE_MAGIC, FILTER_FILE_VERSION, self.HASH_SCHEME,
+            len(self.filters), 0, self.false_positive_prob)
+        header += SCALABLE_FILTER_HEADER.pack(
+            self.initial_capacity, self.growth_factor, self.tightening_ratio)
+        stream.write(header.ljust(FILTER_FILE_HEADER_SIZE, b'\0'))
+
+        for bloom_filter in self.filters:
+            bloom_filter.write(stream)
+
+    def fill_ratio(self):
+        ''' (self) -> float
+        Returns the share of the bits set across all of the sub-filters.
+        '''
+        bits = sum(f.bit_array_size for f in self.filters)
+        return sum(f.bit_array.count() for f in self.filters) / max(bits, 1)
+
+    def estimated_items(self):
+        ''' (self) -> int
+        Estimates the number of distinct items added to the filter.
+        '''
+        return sum(f.estimated_items() for f in self.filters)
+
+    def estimated_false_positive_prob(self):
+        ''' (self) -> float
+        Estimates the current false positive probability: an absent item is let
+        through when any of the sub-filters lets it through.
+        '''
+        probability = 1.0
+        for bloom_filter in self.filters:
+            probability *= 1 - bloom_filter.estimated_false_positive_prob()
+        return 1 - probability
+
+    def num_bits(self):
+        ''' (self) -> int
+        Returns the size of the filter in bits.
+        '''
+        return sum(f.num_bits() for f in self.filters)
+
+    # Helpers
+    def capacity(self):
+        ''' (self) -> int
+        Returns the number of items the newest sub-filter was sized for.
+        '''
+        return int(self.initial_capacity * self.growth_factor ** (len(self.filters) - 1))
+
+    def grow(self):
+        ''' (self) -> None
+        Called once as many items as the newest sub-filter was sized for have been
+        added to it. Adds a new sub-filter if it is full, or corrects the count of
+        its items if some of them were added more than once.
+        '''
+        # Leave some slack for the error of the estimate
+        estimated_items = self.filters[-1].estimated_items()
+        if estimated_items >= 0.9 * self.capacity():
+            self.add_filter()
+        else:
+            self.active_count = estimated_items
+
+    def add_filter(self):
+        ''' (self) -> None
+        Adds a new, empty sub-filter for the items added from now on.
+        '''
+        number = len(self.filters)
+        capacity = int(self.initial_capacity * self.growth_factor ** number)
+        probability = self.false_positive_prob * (1 - self.tightening_ratio) * self.tightening_ratio ** number
+
+        # Keeping the bits of an item in one block makes them collide more often,
+        # so the sub-filter is sized for a lower rate until it meets the target
+        sub_filter = BlockedBloomFilter(capacity, probability)
+        while sub_filter.expected_false_positive_prob(capacity) > probability:
+            sub_filter = BlockedBloomFilter(capacity, sub_filter.false_positive_prob * 0.8)
+
+        self.filters.append(sub_filter)
+        self.active_count = 0
+
+
+def padded_size(size):
+    ''' (int) -> int
+    Returns size rounded up to a whole number of cache lines.
+    '''
+    return ceil(size / FILTER_FILE_HEADER_SIZE) * FILTER_FILE_HEADER_SIZE
+
+
+def load(path):
+    ''' (str) -> BloomFilter
+    Opens the filter saved at path by BloomFilter.save.
+
+    The bit array is memory mapped rather than read, so only the pages that
+    checks touch are loaded. The mapping is private: items added afterwards
+    aren't written back to the file until the filter is saved again.
+    '''
+    with open(path, 'rb') as s:
+        mapping = mmap.mmap(s.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    try:
+        bloom_filter, _ = read_filter(memoryview(mapping), 0)
+    except struct.error:
+        raise ValueError('{} is truncated'.format(path))
+    if bloom_filter is None:
+        raise ValueError('{} is not a version {} filter file'.format(path, FILTER_FILE_VERSION))
+
+    return bloom_filter
+
+
+def read_filter(buffer, offset):
+    ''' (memoryview, int) -> (BloomFilter, int)
+    Reads the filter stored in buffer at offset, without copying its bits. Returns
+    the filter, or None if there is no filter at offset, and the offset after it.
+    '''
+    magic, version, scheme, bit_array_size, num_hash_fns, false_positive_prob = \
+        FILTER_FILE_HEADER.unpack_from(buffer, offset)
+    if magic != FILTER_FILE_MAGIC or version != FILTER_FILE_VERSION:
+        return None, offset
+
+    if scheme == ScalableBloomFilter.HASH_SCHEME:
+        bloom_filter = ScalableBloomFilter.__new__(ScalableBloomFilter)
+        bloom_filter.false_positive_prob = false_positive_prob
+        bloom_filter.initial_capacity, bloom_filter.growth_factor, bloom_filter.tightening_ratio = \
+            SCALABLE_FILTER_HEADER.unpack_from(buffer, offset + FILTER_FILE_HEADER.size)
+        offset += FILTER_FILE_HEADER_SIZE
+
+        bloom_filter.filters = []
+        for _ in range(bit_array_size):
+            sub_filter, offset = read_filter(buffer, offset)
+            if sub_filter is None:
+                return None, offset
+            bloom_filter.filters.append(sub_filter)
+        bloom_filter.active_count = bloom_filter.filters[-1].estimated_items()
+
+        return bloom_filter, offset
+
+    filter_types = {cls.HASH_SCHEME: cls for cls in (BloomFilter, BlockedBloomFilter)}
+    bloom_filter = filter_types[scheme].__new__(filter_types[scheme])
+    bloom_filter.false_positive_prob = false_positive_prob
+    bloom_filter.bit_array_size = bit_array_size
+    bloom_filter.num_hash_fns = num_hash_fns
+    if scheme == BlockedBloomFilter.HASH_SCHEME:
+        bloom_filter.num_blocks = bit_array_size // BLOCK_BITS
+
+    offset += FILTER_FILE_HEADER_SIZE
+    size = ceil(bit_array_size / 8)
+    bloom_filter.bit_array = bitarray(buffer=buffer[offset:offset + size], endian='big')
+
+    return bloom_filter, offset + padded_size(size)
@@ -0,0 +1,63 @@
+from pathlib import Path
+import errno
+import os
+import shutil
+
+
+# Manifests are appended to in place, so checkpoints hold copies of them rather
+# than links
+MANIFEST_NAME = 'MANIFEST'
+
+
+def link_or_copy(source, destination):
+    ''' (str, str) -> None
+    Hard links the file at source to destination, or copies it when the two are
+    on different file systems.
+    '''
+    try:
+        os.link(source, destination)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.copy2(source, destination)
+
+
+def prepare_directory(directory):
+    ''' (str) -> None
+    Creates directory if it doesn't exist. Raises ValueError if it holds any files,
+    so that a checkpoint is never mixed with older files.
+    '''
+    path = Path(directory)
+    path.mkdir(parents=True, exist_ok=True)
+    if any(path.iterdir()):
+        raise ValueError('{} is not empty'.format(directory))
+
+
+def restore_checkpoint(checkpoint_directory, segments_directory):
+    ''' (str, str) -> int
+    Restores the checkpoint in checkpoint_directory into segments_directory, which
+    must be empty or not exist, so that a DB opened there starts from the
+    checkpoint. Returns the number of files restored.
+
+    Files are hard linked, so restoring takes no extra space. The DB never
+    modifies them in place, which leaves the checkpoint intact once the restored
+    DB takes writes.
+    '''
+    checkpoint = Path(checkpoint_directory)
+    if not any(checkpoint.rglob(MANIFEST_NAME)):
+        raise ValueError('{} does not hold a checkpoint'.format(checkpoint_directory))
+
+    prepare_directory(segments_directory)
+    files = 0
+    for source in sorted(checkpoint.rglob('*')):
+        destination = Path(segments_directory) / source.relative_to(checkpoint)
+        if source.is_dir():
+            destination.mkdir(exist_ok=True)
+        elif source.name == MANIFEST_NAME:
+            shutil.copy2(source, destination)
+            files += 1
+        else:
+            link_or_copy(str(source), str(destination))
+            files += 1
+
+    return files
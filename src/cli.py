@@ -4,7 +4,7 @@ from functools import partial
 import random
 import click
 
-from client import DbException, LSMDbClient
+from client import DbException, LSMDbClient, LSMDbClusterClient
 
 
 @click.group()
@@ -35,7 +35,9 @@ def repl(address: str, port: int):
                 value = client.flush()
                 print(value)
             elif command.lower() == "set":
-                if len(args) != 2:
+                if len(args) == 4 and args[2].lower() == "ex":
+                    print(client.set(args[0], args[1], args[3]))
+                elif len(args) != 2:
                     print("Invalid args", args)
                 else:
                     msg = client.set(args[0], args[1])
@@ -43,6 +45,23 @@ def repl(address: str, port: int):
             elif command.lower() == "ping":
                 response = client.ping()
                 print(response)
+            elif command.lower() == "stats":
+                measure_space = [arg.lower() for arg in args] == ["space"]
+                for name, value in client.stats(measure_space).items():
+                    print(f"{name}={value}")
+            elif command.lower() == "verify":
+                for name, value in client.verify().items():
+                    print(f"{name}={value}")
+            elif command.lower() == "checkpoint":
+                if len(args) != 1:
+                    print("Invalid args", args)
+                else:
+                    for name, value in client.checkpoint(args[0]).items():
+                        print(f"{name}={value}")
+            elif command.lower() == "status":
+                print(client.status())
+            elif command.lower() == "promote":
+                print(client.promote())
             else:
                 print(f"Unknown command {command}!")
         except DbException as dbe:
@@ -74,6 +93,15 @@ def multiple_thread(address: str, port: int, nthread: int, key: str, unique: boo
     client = LSMDbClient(address, port)
     client.flush()
 
+@click.option("--nodes", "-n", required=True, help="Current nodes, as comma separated host:port")
+@click.option("--to", "-t", "new_nodes", required=True, help="Nodes after rebalancing, as comma separated host:port")
+@click.option("--vnodes", "-v", default=100)
+@cli.command()
+def rebalance(nodes: str, new_nodes: str, vnodes: int):
+    client = LSMDbClusterClient(nodes.split(","), vnodes)
+    moved = client.rebalance(new_nodes.split(","))
+    print(f"Moved {moved} keys")
+
 if __name__ == "__main__":
     cli()
         
\ No newline at end of file
@@ -1,7 +1,11 @@
+from concurrent.futures import ThreadPoolExecutor
 import socket
 
 import click
 
+from expiry import split_expiry
+from hash_ring import HashRing
+
 
 class DbException(Exception):
     pass
@@ -14,10 +18,23 @@ class LSMDbClient:
         # Create a socket object 
         self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.client_socket.connect((server_ip, port))
-        
+        # Replies are read line by line. One reader is kept for the connection, so
+        # that nothing it reads ahead is lost between replies.
+        self.stream = self.client_socket.makefile('r')
+
+    def read_reply(self):
+        line = self.stream.readline()
+        if not line:
+            raise DbException("Connection closed by the server")
+        return line.rstrip('\n')
+
+    def close(self):
+        self.stream.close()
+        self.client_socket.close()
+
     def get(self, key):
         self.client_socket.sendall(f"GET {key}\n".encode())
-        result = self.client_socket.recv(1024).decode()
+        result = self.read_reply()
         if not result.startswith("ERROR:"):
             return result
         else:
@@ -25,37 +42,211 @@ class LSMDbClient:
 
     def getall(self, *keys):
         self.client_socket.sendall(f"GETALL {' '.join(keys)}\n".encode())
-        result = self.client_socket.recv(1024).decode()
+        result = self.read_reply()
         if not result.startswith("ERROR:"):
             return result
         else:
             raise DbException(f"Error while getting keys {keys}: {result[6:]}")
     
-    def set(self, key, value):
-        self.client_socket.sendall(f"SET {key} {value}\n".encode())
-        msg = self.client_socket.recv(1024).decode()
+    def set(self, key, value, ttl=None, expires_at=None):
+        if ttl is not None:
+            self.client_socket.sendall(f"SET {key} {value} EX {ttl}\n".encode())
+        elif expires_at is not None:
+            self.client_socket.sendall(f"SET {key} {value} PXAT {expires_at}\n".encode())
+        else:
+            self.client_socket.sendall(f"SET {key} {value}\n".encode())
+        msg = self.read_reply()
         return msg
 
+    def scan(self, start=None, end=None, with_expiry=False):
+        # With with_expiry, values come as stored, along with their expiry time
+        option = " EXPIRY" if with_expiry else ""
+        self.client_socket.sendall(f"SCAN {start or ''} {end or ''}{option}\n".encode())
+        stream = self.stream
+        done = False
+        try:
+            for line in stream:
+                line = line.rstrip('\n')
+                if not line:
+                    done = True
+                    return
+                key, value = line.split(',', 1)
+                yield key, value
+        finally:
+            # Read the rest of the response, so that it isn't taken for the
+            # reply to the next command
+            while not done and stream.readline() not in ('\n', ''):
+                pass
+
     def disk_usage(self):
         self.client_socket.sendall("DISKUSAGE\n".encode())
-        msg = self.client_socket.recv(1024).decode()
+        msg = self.read_reply()
         return msg
 
     def ping(self):
         self.client_socket.sendall("PING\n".encode())
-        msg = self.client_socket.recv(1024).decode()
+        msg = self.read_reply()
         return msg
 
     def compact(self):
         self.client_socket.sendall("COMPACT\n".encode())
-        msg = self.client_socket.recv(1024).decode()
+        msg = self.read_reply()
         return msg
 
     def flush(self):
         self.client_socket.sendall("flush\n".encode())
-        msg = self.client_socket.recv(1024).decode()
+        msg = self.read_reply()
         return msg
 
+    def stats(self, measure_space=False):
+        self.client_socket.sendall(("STATS SPACE\n" if measure_space else "STATS\n").encode())
+        stats = {}
+        for line in self.stream:
+            line = line.rstrip('\n')
+            if not line:
+                break
+            name, value = line.split('=', 1)
+            stats[name] = value
+        return stats
+
+    def verify(self):
+        self.client_socket.sendall("VERIFY\n".encode())
+        report = {}
+        for line in self.stream:
+            line = line.rstrip('\n')
+            if not line:
+                break
+            if line.startswith("ERROR:"):
+                raise DbException(f"Error while verifying: {line[6:]}")
+            name, value = line.split('=', 1)
+            report[name] = value
+        return report
+
+    def checkpoint(self, directory):
+        self.client_socket.sendall(f"CHECKPOINT {directory}\n".encode())
+        report = {}
+        for line in self.stream:
+            line = line.rstrip('\n')
+            if not line:
+                break
+            if line.startswith("ERROR:"):
+                raise DbException(f"Error while checkpointing: {line[6:]}")
+            name, value = line.split('=', 1)
+            report[name] = value
+        return report
+
+    def status(self):
+        self.client_socket.sendall("STATUS\n".encode())
+        msg = self.read_reply()
+        return msg
+
+    def promote(self):
+        self.client_socket.sendall("PROMOTE\n".encode())
+        msg = self.read_reply()
+        return msg
+
+
+class LSMDbClusterClient:
+    """
+    Talks to a cluster of servers, given as "host:port" nodes. Keys are placed on a
+    consistent hash ring, and every request goes straight to the node that owns the key.
+    """
+    def __init__(self, nodes, vnodes: int = 100) -> None:
+        self.vnodes = vnodes
+        self.ring = HashRing(nodes, vnodes)
+        self.clients = {}
+        for node in nodes:
+            self.connect(node)
+        self.executor = ThreadPoolExecutor(len(nodes))
+
+    def get(self, key):
+        return self.client_for(key).get(key)
+
+    def getall(self, *keys):
+        # Each node is sent one GETALL for its share of the keys, in parallel
+        def getall_positions(client, positions):
+            return client.getall(*[keys[i] for i in positions]).split("^")
+
+        values = [None] * len(keys)
+        for positions, result in self.per_node(keys, getall_positions):
+            for i, value in zip(positions, result):
+                values[i] = value
+        return "^".join(values)
+
+    def set(self, key, value, ttl=None, expires_at=None):
+        return self.client_for(key).set(key, value, ttl, expires_at)
+
+    def set_many(self, pairs):
+        # The pairs of each node are written in order, while nodes are written in parallel
+        def set_positions(client, positions):
+            return [client.set(*pairs[i]) for i in positions]
+
+        messages = [None] * len(pairs)
+        for positions, result in self.per_node([key for key, _ in pairs], set_positions):
+            for i, message in zip(positions, result):
+                messages[i] = message
+        return messages
+
+    def ping(self):
+        return {node: client.ping() for node, client in self.clients.items()}
+
+    def flush(self):
+        return {node: client.flush() for node, client in self.clients.items()}
+
+    def compact(self):
+        return {node: client.compact() for node, client in self.clients.items()}
+
+    def rebalance(self, nodes):
+        """
+        Moves the cluster onto a ring made of nodes: every key whose owner changes
+        is streamed from its current node to its new one. Returns the number of keys moved.
+
+        Note: the engine has no deletes, so moved keys are left behind on their old
+        node. They are never read again, since requests go to the new owner.
+        """
+        new_ring = HashRing(nodes, self.vnodes)
+        for node in nodes:
+            if node not in self.clients:
+                self.connect(node)
+
+        # Keys keep the time they expire at
+        moved = 0
+        for node in self.ring.nodes():
+            for key, stored in self.clients[node].scan(with_expiry=True):
+                owner = new_ring.node_for(key)
+                if owner != node:
+                    value, expires_at = split_expiry(stored)
+                    self.clients[owner].set(key, value, expires_at=expires_at)
+                    moved += 1
+
+        for node in list(self.clients):
+            if node not in nodes:
+                self.clients.pop(node).close()
+        self.ring = new_ring
+        self.executor = ThreadPoolExecutor(len(nodes))
+        return moved
+
+    # Helpers
+    def connect(self, node):
+        host, port = node.rsplit(":", 1)
+        self.clients[node] = LSMDbClient(host, int(port))
+
+    def client_for(self, key):
+        return self.clients[self.ring.node_for(key)]
+
+    def per_node(self, keys, request):
+        # Groups the positions of keys by owner and runs request(client, positions) for
+        # every node in parallel, so each connection is only used by one thread at a time.
+        batches = {}
+        for i, key in enumerate(keys):
+            batches.setdefault(self.ring.node_for(key), []).append(i)
+
+        futures = [
+            (positions, self.executor.submit(request, self.clients[node], positions))
+            for node, positions in batches.items()
+        ]
+        return [(positions, future.result()) for positions, future in futures]
+
 
 @click.group()
 def client():
@@ -0,0 +1,82 @@
+import time
+
+
+# Values that expire are stored with their expiry time, in milliseconds since the
+# epoch, after this separator. Values can't hold it otherwise.
+EXPIRY_SEPARATOR = '\x1f'
+
+
+def now_ms():
+    ''' () -> int
+    Returns the current time, in milliseconds since the epoch.
+    '''
+    return int(time.time() * 1000)
+
+
+def with_expiry(value, ttl, now=None):
+    ''' (str, float, int) -> str
+    Returns value as stored to expire ttl seconds after now, the current time by
+    default.
+    '''
+    if ttl <= 0:
+        raise ValueError('TTL must be positive, got {}'.format(ttl))
+
+    return with_expiry_time(value, (now_ms() if now is None else now) + int(ttl * 1000))
+
+
+def with_expiry_time(value, expires_at):
+    ''' (str, int) -> str
+    Returns value as stored to expire at expires_at, in milliseconds since the epoch.
+    '''
+    return '{}{}{}'.format(value, EXPIRY_SEPARATOR, expires_at)
+
+
+def split_expiry(stored):
+    ''' (str) -> (str, int)
+    Returns the value held by stored, a value or record as stored, along with the
+    time it expires at, or None if it doesn't expire.
+    '''
+    value, separator, expires_at = stored.rpartition(EXPIRY_SEPARATOR)
+    if separator and expires_at.isdigit():
+        return value, int(expires_at)
+    return stored, None
+
+
+def live_value(stored, now=None):
+    ''' (str, int) -> str
+    Returns the value held by stored, a value as stored, or None if stored is None
+    or expired by now, the current time by default.
+    '''
+    if stored is None or EXPIRY_SEPARATOR not in stored:
+        return stored
+
+    value, expires_at = split_expiry(stored)
+    if expires_at is not None and expires_at <= (now_ms() if now is None else now):
+        return None
+    return value
+
+
+def expiry_range(expiry_times, count):
+    ''' ([int], int) -> (int, int, Boolean)
+    Returns the expiry range of a segment of count records, of which those that
+    expire do so at expiry_times: the earliest and latest of those times, and
+    whether every record expires. None is returned if no record expires.
+    '''
+    if not expiry_times:
+        return None
+    return min(expiry_times), max(expiry_times), len(expiry_times) == count
+
+
+def merge_expiry_ranges(ranges):
+    ''' ([(int, int, Boolean)]) -> (int, int, Boolean)
+    Returns the expiry range of the segment made of the records of segments with
+    the given expiry ranges, which are None for segments where no record expires.
+    '''
+    expiring = [expiry for expiry in ranges if expiry is not None]
+    if not expiring:
+        return None
+
+    return (
+        min(first for first, _, _ in expiring),
+        max(last for _, last, _ in expiring),
+        len(expiring) == len(ranges) and all(all_expire for _, _, all_expire in expiring))
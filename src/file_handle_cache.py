@@ -0,0 +1,158 @@
+from collections import OrderedDict, defaultdict
+import mmap
+import threading
+
+
+# Default number of segment files kept open
+MAX_OPEN_FILES = 256
+
+
+class SegmentFile:
+    def __init__(self, path):
+        ''' (self, str) -> SegmentFile
+        Opens the segment file at path and memory maps it. The mapping keeps the
+        contents of the file readable even after the file is replaced or deleted.
+
+        The segment file starts with one reference, held by the caller, and is
+        closed when the last reference is dropped.
+        '''
+        self.path = path
+        with open(path, 'rb') as s:
+            try:
+                self.data = mmap.mmap(s.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty files can't be mapped
+                self.data = b''
+
+        self.refs = 1
+        self.lock = threading.Lock()
+
+    def ref(self):
+        ''' (self) -> None
+        Registers a new holder of the segment file.
+        '''
+        with self.lock:
+            self.refs += 1
+
+    def unref(self):
+        ''' (self) -> None
+        Drops a holder of the segment file, closing it if it was the last one.
+        '''
+        with self.lock:
+            self.refs -= 1
+            if self.refs == 0 and isinstance(self.data, mmap.mmap):
+                self.data.close()
+
+    def size(self):
+        ''' (self) -> int
+        Returns the size of the segment file in bytes.
+        '''
+        return len(self.data)
+
+    def lines(self):
+        ''' (self) -> generator
+        Yields the lines of the segment file as bytes, newlines included.
+        '''
+        data = self.data
+        position = 0
+        while position < len(data):
+            end = data.find(b'\n', position)
+            end = len(data) if end == -1 else end + 1
+            yield data[position:end]
+            position = end
+
+
+class FileHandleCache:
+    def __init__(self, max_open_files=MAX_OPEN_FILES):
+        ''' (self, int) -> FileHandleCache
+        Creates a cache that keeps up to max_open_files segment files open, closing
+        the least recently used ones first.
+
+        Segment files are cached by (path, generation). A segment file that is
+        evicted or invalidated while it is being read stays open until its
+        readers are done with it.
+        '''
+        self.max_open_files = max_open_files
+        self.files = OrderedDict()
+        self.keys_by_path = defaultdict(set)
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        ''' (self, tuple) -> SegmentFile
+        Returns the segment file cached under key with a new reference to it,
+        or None.
+        '''
+        with self.lock:
+            segment_file = self.files.get(key)
+            if segment_file is None:
+                self.misses += 1
+                return None
+
+            self.files.move_to_end(key)
+            self.hits += 1
+            segment_file.ref()
+            return segment_file
+
+    def put(self, key, segment_file):
+        ''' (self, tuple, SegmentFile) -> None
+        Caches segment_file under key. The cache takes a reference of its own.
+        '''
+        with self.lock:
+            if key in self.files:
+                return
+
+            segment_file.ref()
+            self.files[key] = segment_file
+            self.keys_by_path[key[0]].add(key)
+            self.evict(self.max_open_files)
+
+    def invalidate(self, path):
+        ''' (self, str) -> None
+        Drops every cached segment file opened from path.
+        '''
+        with self.lock:
+            for key in self.keys_by_path.pop(path, ()):
+                self.files.pop(key).unref()
+
+    def set_max_open_files(self, max_open_files):
+        ''' (self, int) -> None
+        Sets the number of segment files kept open, closing files as needed.
+        '''
+        with self.lock:
+            self.max_open_files = max_open_files
+            self.evict(max_open_files)
+
+    def stats(self):
+        ''' (self) -> dict
+        Returns the hit and miss counts of the cache along with the number of
+        files it keeps open.
+        '''
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'open_files': len(self.files),
+            'max_open_files': self.max_open_files,
+        }
+
+    # Helpers
+    def evict(self, max_open_files):
+        ''' (self, int) -> None
+        Drops the least recently used segment files until at most max_open_files
+        are cached.
+
+        Note: the caller must hold lock.
+        '''
+        while len(self.files) > max_open_files:
+            key, segment_file = self.files.popitem(last=False)
+            segment_file.unref()
+            self.evictions += 1
+
+            keys = self.keys_by_path[key[0]]
+            keys.discard(key)
+            if not keys:
+                del self.keys_by_path[key[0]]
@@ -0,0 +1,64 @@
+from bisect import bisect, insort
+from mmh3 import hash
+
+
+# Keeps ring positions independent from the hashes used by workers and shards
+RING_SEED = 0x41e6
+
+
+class HashRing:
+    def __init__(self, nodes=(), vnodes=100):
+        ''' (self, [str], int) -> HashRing
+        Creates a consistent hash ring over nodes. Each node is placed on the ring
+        vnodes times, which evens out the share of keys each node owns and spreads
+        the keys of a departing node over all of the others.
+        '''
+        self.vnodes = vnodes
+        self.positions = []
+        self.owners = {}
+
+        for node in nodes:
+            self.add_node(node)
+
+    def add_node(self, node):
+        ''' (self, str) -> None
+        Places node on the ring.
+        '''
+        for i in range(self.vnodes):
+            position = self.position('{}#{}'.format(node, i))
+
+            # On the rare collision, the node that was placed first keeps the position
+            if position not in self.owners:
+                insort(self.positions, position)
+                self.owners[position] = node
+
+    def remove_node(self, node):
+        ''' (self, str) -> None
+        Removes node from the ring.
+        '''
+        self.positions = [p for p in self.positions if self.owners[p] != node]
+        self.owners = {p: self.owners[p] for p in self.positions}
+
+    def nodes(self):
+        ''' (self) -> [str]
+        Returns the nodes on the ring, sorted.
+        '''
+        return sorted(set(self.owners.values()))
+
+    def node_for(self, key):
+        ''' (self, str) -> str
+        Returns the node that owns key: the first node clockwise from the
+        key's position on the ring.
+        '''
+        if not self.positions:
+            return None
+
+        i = bisect(self.positions, self.position(key)) % len(self.positions)
+        return self.owners[self.positions[i]]
+
+    # Helpers
+    def position(self, value):
+        ''' (self, str) -> int
+        Returns the position of value on the ring.
+        '''
+        return hash(value, RING_SEED) & 0xffffffff
@@ -1,116 +1,588 @@
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from itertools import repeat
+from bisect import bisect_left, bisect_right
 from pathlib import Path
 import logging
-from os import remove as remove_file, rename as rename_file
+import os
+from os import remove as remove_file, replace as replace_file
+from negative_cache import NegativeCache
 from red_black_tree import RedBlackTree
-from append_log import AppendLog
-from bloom_filter import BloomFilter
+from amplification import amplification_ratios
+from append_log import AppendLog, is_legacy_log, read_records, upgrade_legacy_log
+from block_cache import BLOCK_SIZE, BlockCache, block_bounds, read_block
+from checkpoint import MANIFEST_NAME, link_or_copy, prepare_directory
+from expiry import (
+    EXPIRY_SEPARATOR, expiry_range, live_value, merge_expiry_ranges, now_ms, split_expiry, with_expiry,
+    with_expiry_time)
+from file_handle_cache import FileHandleCache, SegmentFile
+from manifest import Manifest
+from bloom_filter import ScalableBloomFilter, load as load_bloom_filter
+from row_cache import MISSING, RowCache
+from rw_lock import RWLock
+from segment_checksums import (
+    CorruptSegmentError, block_checksums, checksummed_size, checksums_path, load_checksums, remove_checksums,
+    write_checksums)
+from segment_scan import SCAN_PROCESSES, scan_segments
+from value_log import VALUE_POINTER_PREFIX, ValueLog, is_pointer, parse_pointer
+from version import Snapshot, Version, visible_value
+from xor_filter import XorFilter, load as load_xor_filter
+import heapq
 import pickle
+import random
 import threading
+import time
+import zlib
 
 
 logger = logging.getLogger(__name__)
-lock = threading.Lock()
+
+# The kinds of filters an LSMTree can use to skip segments: a single bloom filter
+# for all of them, or an xor filter built for each segment when it is written
+FILTER_TYPES = ('bloom', 'xor')
+
+# How often blocks read from disk are checked against their checksums: every
+# time, for one read in CHECKSUM_SAMPLE_RATE, or never
+CHECKSUM_VERIFICATION_MODES = ('always', 'sampled', 'off')
+CHECKSUM_SAMPLE_RATE = 16
+
+# Characters that end a segment record when segments are read as lines, so that
+# keys and values can't hold them
+RECORD_SEPARATORS = ('\n', '\r')
+
+# Number of threads segments are read with by verify
+VERIFY_THREADS = 4
+
+# Share of the span between the earliest and latest expiry times of a segment
+# that has to have passed before compaction rewrites it to drop expired records
+EXPIRED_REWRITE_RATIO = 0.5
+
+# Share of the bytes of a value log file that have to belong to values since
+# overwritten or deleted for the garbage collector to rewrite it, and how often,
+# in seconds, the garbage collector looks for such a file
+VALUE_LOG_GC_RATIO = 0.5
+VALUE_LOG_GC_INTERVAL = 60
+
+
+class FlushFailedError(Exception):
+    pass
 
 
 class LSMTree():
-    def __init__(self, segment_basename, segments_directory, wal_basename):
-        ''' (self, str, str, str) -> LSMTree
+    def __init__(self, segment_basename, segments_directory, wal_basename,
+                 block_cache=None, file_handle_cache=None, row_cache=None, negative_cache=None):
+        ''' (self, str, str, str, BlockCache, FileHandleCache, RowCache, NegativeCache) -> LSMTree
         Initialize a new LSM Tree with:
 
         - A first segment called segment_basename
         - A segments directory called segments_directory
         - A memtable write ahead log (WAL) called wal_basename
+        - A cache for the blocks read from segments, a cache of open segment
+          files, a cache of the values of hot keys and a cache of keys missing
+          from disk, shared with other trees if given
         '''
         self.segments_directory = segments_directory
         self.wal_basename = wal_basename
         self.current_segment = segment_basename
-        self.segments = []
+
+        # Concurrency control. Readers work against the current Version (memtable,
+        # immutable memtables and segments) and never wait on flushes or compactions.
+        # Writers are serialised by write_lock, and only hold memtable_lock while
+        # inserting into the memtable.
+        self.write_lock = threading.Lock()
+        self.flush_lock = threading.Condition()
+        self.version_lock = threading.RLock()
+        self.memtable_lock = RWLock()
+        self.index_lock = RWLock()
+        self.version = None
+        self.live_versions = set()
+        self.obsolete_segments = set()
+        self.install_version(memtable=RedBlackTree(), immutable_memtables=[], segments=[])
+
+        # Every write is numbered, in order. Snapshots pin the number of the last
+        # write they see, and memtable nodes keep the older values that live
+        # snapshots still see. Numbers only need to be ordered within a session,
+        # as snapshots don't outlive it.
+        self.sequence = 0
+        self.snapshots = []
+        self.snapshots_lock = threading.Lock()
+
+        # Records compaction kept on disk for snapshots that still see them, as
+        # (sequence, keys, segments): the keys are deleted from the segments once
+        # no snapshot older than sequence is live
+        self.deferred_deletions = []
+
+        # Expiry ranges of the segments holding records that expire, by segment,
+        # as (earliest expiry, latest expiry, whether every record expires).
+        # Compaction drops expired records, and whole segments once every record
+        # has expired, unless drop_expired_segments is off.
+        self.segment_expiries = {}
+        self.drop_expired_segments = True
+        self.expired_records_dropped = 0
+        self.expired_segments_dropped = 0
 
         # Default threshold is 1mb
         self.threshold = 1000000
-        self.memtable = RedBlackTree()
 
-        # Index
+        # Index. An index restored from the manifest is only built on first use.
+        self.index_load_lock = threading.Lock()
         self.index = RedBlackTree()
         self.sparsity_factor = 100
 
-        # Bloom Filter
+        # Number of processes segments are scanned with to rebuild the index or filters
+        self.scan_processes = SCAN_PROCESSES
+
+        # Bloom Filter. bf_num_items is only the initial capacity, as the filter grows
+        # with the number of keys. While the filter is being rebuilt with new settings,
+        # flushed keys go to both the current and the new filter.
         self.bf_num_items = 1000000
         self.bf_false_pos_prob = 0.2
-        self.bloom_filter = BloomFilter(
-            self.bf_num_items, self.bf_false_pos_prob)
+        self.bloom_filter = self.new_bloom_filter()
+        self.rebuilding_bloom_filter = None
+
+        # Cleared while the filters restored at startup catch up with the segments
+        # in the background. Until then, the bloom filter lets every key through.
+        # filters_settled is set once the catch up is over, whether it succeeded
+        # or not: if it failed, filters_ready stays cleared for the session, and
+        # the bloom filter is never saved.
+        self.filters_ready = threading.Event()
+        self.filters_ready.set()
+        self.filters_settled = threading.Event()
+        self.filters_settled.set()
+
+        # Xor filters, by segment, when filter_type is 'xor'
+        self.filter_type = 'bloom'
+        self.segment_filters = {}
+
+        # Lookup counts for each filter, by segment or 'bloom'. Counts are updated
+        # without locking, so concurrent lookups may occasionally lose one.
+        self.filter_counters = defaultdict(Counter)
+
+        # Amplification counters: the bytes written by users, and those written to
+        # disk on their behalf by the write ahead log, flushes, compactions and
+        # merges; and the lookups made along with the segments they probed. Like
+        # the filter counters, they are updated without locking.
+        self.io_counters = Counter()
+
+        # Segments are read in blocks, through the block cache, from files kept open
+        # by the file handle cache. Each segment path has a generation, bumped
+        # whenever its file is replaced, so that blocks, block indexes and open
+        # files of an older file are never used for a newer one.
+        self.block_cache = BlockCache() if block_cache is None else block_cache
+        self.file_handle_cache = FileHandleCache() if file_handle_cache is None else file_handle_cache
+
+        # Values of recently read keys, off until given a capacity
+        self.row_cache = RowCache() if row_cache is None else row_cache
+
+        # Keys that got past the filters but weren't on disk
+        self.negative_cache = NegativeCache() if negative_cache is None else negative_cache
+        self.segment_generations = {}
+        self.block_indexes = {}
+
+        # Number of times a segment was rewritten in place, which reads compare to
+        # tell whether a miss may be a record compaction moved under them
+        self.segment_rewrites = 0
+
+        # The error a flush failed with. The memtable it was flushing stays queued,
+        # and every later flush fails rather than waiting for it forever.
+        self.flush_error = None
+
+        # Checksums of the blocks of each segment, read from the file kept next to
+        # it, by path along with the generation they were read at
+        self.checksum_verification = 'always'
+        self.segment_checksums = {}
+        self.verified_blocks = 0
+        self.checksum_failures = 0
 
         # Create the segments directory
         if not (Path(segments_directory).exists() and Path(segments_directory).is_dir):
             Path(segments_directory).mkdir()
 
+        # Values of at least value_separation_threshold bytes are moved to the value
+        # log when memtables are flushed, leaving segments with pointers to them.
+        # 0 turns this off, though values moved before are still read. Files of
+        # the log collected by the garbage collector are only deleted on its next
+        # run, once readers that followed older pointers into them are done.
+        self.value_log = ValueLog(segments_directory)
+        self.value_separation_threshold = 0
+        self.value_log_gc_thread = None
+        self.value_log_gc_stop = threading.Event()
+        self.collected_value_logs = []
+        self.separated_values = 0
+        self.value_log_bytes_collected = 0
+
+        # Changes to the segments and settings are logged to the manifest as they happen
+        self.manifest = Manifest(self.manifest_path())
+
         # Attempt to load metadata and a pre-existing memtable
+        self.startup_timings = {}
+        started = time.perf_counter()
         self.load_metadata()
+        loaded = time.perf_counter()
         self.restore_memtable()
-
-    def db_set(self, key, value):
-        ''' (self, str, str) -> None
-        Stores a new key value pair in the DB
+        restored = time.perf_counter()
+
+        self.startup_timings['metadata_ms'] = round((loaded - started) * 1000, 3)
+        self.startup_timings['memtable_ms'] = round((restored - loaded) * 1000, 3)
+        self.startup_timings['total_ms'] = round((restored - started) * 1000, 3)
+        logger.info(
+            'Opened %s in %.1fms: metadata %.1fms (manifest %.1fms), memtable %.1fms, %d segments',
+            segments_directory, self.startup_timings['total_ms'], self.startup_timings['metadata_ms'],
+            self.startup_timings.get('manifest_ms', 0), self.startup_timings['memtable_ms'],
+            len(self.segments))
+
+    def db_set(self, key, value, ttl=None, expires_at=None):
+        ''' (self, str, str, float, int) -> None
+        Stores a new key value pair in the DB. If ttl is given, the pair expires
+        ttl seconds from now, after which it reads as absent. It expires at
+        expires_at instead, in milliseconds since the epoch, if that is given.
         '''
-        log = self.to_log_entry(key, value)
-
-        # Check if we can save effort by updating the memtable in place
-        node = self.memtable.find_node(key)
-        if node:
-            self.memtable_wal().write(log)
-            node.value = value
-            return
-
-        # Check if new segment needed
-        additional_size = len(key) + len(value)
-        with lock:
-            if self.memtable.total_bytes + additional_size > self.threshold:
-                    self.compact()
-                    self.flush_memtable_to_disk(self.current_segment_path())
-
-                    # Update bookkeeping metadata
-                    self.memtable = RedBlackTree()
-                    self.memtable_wal().clear()
-
-                    self.segments.append(self.current_segment)
-                    new_seg_name = self.incremented_segment_name()
-                    self.current_segment = new_seg_name
-                    self.memtable.total_bytes = 0
+        self.validate_record(key, value)
+        if ttl is not None and expires_at is not None:
+            raise ValueError('Expected either a TTL or an expiry time, not both')
+        if ttl is not None:
+            value = with_expiry(value, ttl)
+        elif expires_at is not None:
+            value = with_expiry_time(value, expires_at)
+
+        with self.write_lock:
+            frozen = self.insert(key, value)
+            self.io_counters['user_bytes'] += len(key) + len(value)
+
+        # Flushing happens outside of the write lock so that other writers can
+        # keep filling the new memtable in the meantime.
+        if frozen:
+            self.flush_immutable_memtable(*frozen)
+
+    def db_get(self, key, snapshot=None):
+        ''' (self, str, Snapshot) -> None
+        Retrieve the value associated with key in the db, as of snapshot if given
+        '''
+        self.io_counters['reads'] += 1
+        if snapshot is not None:
+            return live_value(self.resolve_value(self.version_get(key, snapshot.version, snapshot.sequence)))
+
+        row_cache = self.row_cache
+        if row_cache.capacity:
+            stamp = row_cache.stamp(key)
+            value = row_cache.get(key)
+            if value is not MISSING:
+                return live_value(value)
+
+        while True:
+            rewrites = self.segment_rewrites
+            version = self.acquire_version()
+            try:
+                value = self.resolve_value(self.version_get(key, version))
+            finally:
+                self.release_version(version)
+
+            # Compaction rewrites segments in place, so a miss against an old version,
+            # or while a segment was rewritten, may be a record that has since moved
+            # to a newer memtable or segment.
+            if value is not None or (version is self.version and rewrites == self.segment_rewrites):
+                break
+
+        if row_cache.capacity:
+            row_cache.put(key, value, stamp)
+        return live_value(value)
+
+    def db_get_many(self, keys, snapshot=None):
+        ''' (self, [str], Snapshot) -> [str]
+        Retrieve the values associated with keys, in order. Every key is read as
+        of the same point in time: snapshot if given, or a snapshot taken for the
+        lookup otherwise.
+        '''
+        if snapshot is not None:
+            return [self.db_get(key, snapshot) for key in keys]
 
-            # Write to memtable write ahead log in case of crash
-            self.memtable_wal().write(log)
+        with self.snapshot() as snapshot:
+            return [self.db_get(key, snapshot) for key in keys]
 
-            # Write to memtable
-            self.memtable.add(key, value)
-            self.memtable.total_bytes += additional_size
+    def version_get(self, key, version, sequence=None, counted=True):
+        ''' (self, str, Version, int, Boolean) -> str
+        Retrieve the value associated with key as seen by version, ignoring the
+        writes numbered after sequence if given. Values in the value log are
+        returned as the pointers to them.
 
-    def db_get(self, key):
-        ''' (self, str) -> None
-        Retrieve the value associated with key in the db
+        Lookups the DB makes for itself, such as those of the value log's garbage
+        collector, have counted unset, so that they are left out of the filter
+        statistics, the segment probes and the negative cache.
         '''
-        # Attempt to find the key in the memtable first
-        memtable_result = self.memtable.find_node(key)
-        if memtable_result:
-            return memtable_result.value
-
-        # Check the bloom filter before searching disk
-        if not self.bloom_filter.check(key):
+        # Read before the memtables, so that a write racing with this lookup
+        # keeps its miss from being cached
+        stamp = self.negative_cache.stamp(key)
+
+        # Attempt to find the key in the memtables first, newest to oldest
+        with self.memtable_lock.read():
+            node = version.memtable.find_node(key)
+            found, value = visible_value(node, sequence) if node else (False, None)
+        if found:
+            return value
+
+        for memtable in version.immutable_memtables:
+            node = memtable.find_node(key)
+            if node:
+                found, value = visible_value(node, sequence)
+                if found:
+                    return value
+
+        # Keys that were recently missed on disk are not searched for again. The
+        # cache only covers the current version, so snapshots skip it.
+        if counted and sequence is None and self.negative_cache.contains(key):
             return None
 
+        # Check the filters before searching disk
+        segments = version.segments
+        ruled_out = ()
+        if self.filter_type == 'xor':
+            segments = self.segments_that_may_contain(key, segments, counted)
+            if not segments:
+                return None
+            ruled_out = set(version.segments) - set(segments)
+            filters = [segment for segment in segments if segment in self.segment_filters]
+        elif not self.bloom_filter_check(key, counted):
+            return None
+        else:
+            filters = ['bloom']
+
+        value = self.segments_get(key, segments, ruled_out, pinned=sequence is not None, counted=counted)
+        if value is None and counted:
+            # Every filter that let the key through was wrong
+            for name in filters:
+                self.filter_counters[name]['false_positives'] += 1
+            if sequence is None:
+                self.negative_cache.add(key, stamp)
+
+        return value
+
+    def segments_get(self, key, segments, ruled_out=(), pinned=False, counted=True):
+        ''' (self, str, [str], set, Boolean, Boolean) -> str
+        Retrieve the value associated with key from segments, using the index
+        unless it points into a segment in ruled_out, or, if pinned is set because
+        segments belong to a snapshot, into a segment outside of segments. The
+        segments searched count as probes if counted is set.
+        '''
         # Check the index
-        floor_val = self.index.floor(key)
-        floor_node = self.index.find_node(floor_val)
+        with self.index_lock.read():
+            floor_val = self.index.floor(key)
+            floor_node = self.index.find_node(floor_val)
+
+        # Keys that compaction kept older records of for snapshots may be in more
+        # than one segment, so the newest one has to be found by searching them all
+        if (floor_node and floor_node.segment not in ruled_out
+                and (not pinned or floor_node.segment in segments) and not self.is_shadowed(key)):
+            try:
+                value = self.search_segment(key, floor_node.segment, counted)
+                if value is not None:
+                    return value
+            except FileNotFoundError:
+                # The segment was merged away since the index entry was written
+                pass
+
+        return self.search_all_segments(key, segments, counted)
+
+    def flush(self):
+        ''' (self) -> None
+        Flushes the current memtable to a new segment on disk, if it holds any data.
+        Either way, returns once the memtables frozen before are on disk too.
+        '''
+        with self.write_lock:
+            if not self.memtable.count:
+                pending = self.version.immutable_memtables
+                frozen = None
+            else:
+                frozen = self.rotate_memtable()
+
+        # Memtables are flushed in the order they were frozen, so flushing this one
+        # waits for the ones frozen before it
+        if frozen:
+            self.flush_immutable_memtable(*frozen)
+            return
+
+        with self.flush_lock:
+            self.flush_lock.wait_for(
+                lambda: self.flush_error is not None
+                or not any(m in pending for m in self.version.immutable_memtables))
+            self.check_flush_error()
+
+    def scan(self, start=None, end=None, snapshot=None, with_expiry=False):
+        ''' (self, str, str, Snapshot, Boolean) -> generator
+        Yields the key value pairs with start <= key < end, in key order, as of
+        snapshot if given. Either bound may be None to leave that side of the
+        range open. Expired pairs are skipped, and values are yielded as stored,
+        along with their expiry time, if with_expiry is set.
+        '''
+        now = now_ms()
+        if snapshot is None:
+            version, sequence = self.acquire_version(), None
+        else:
+            version, sequence = snapshot.version, snapshot.sequence
+        segment_files = []
+        try:
+            # Segments are opened before the memtables are read, so that a compaction
+            # can only drop records from them once those records are in a memtable.
+            # The generation is read first, so that a segment replaced in between
+            # is read from the new file without being cached as the old one.
+            for segment in reversed(version.segments):
+                path = self.segment_path(segment)
+                generation = self.segment_generations.get(path, 0)
+                segment_files.append((path, generation, self.open_segment(path, generation)))
+
+            with self.memtable_lock.read():
+                sources = [self.memtable_items(version.memtable, start, end, sequence)]
+            for memtable in version.immutable_memtables:
+                sources.append(self.memtable_items(memtable, start, end, sequence))
+            for path, generation, segment_file in segment_files:
+                sources.append(self.segment_block_items(path, generation, segment_file, start, end))
+
+            # Sources are ordered newest first, so the first record seen for a key wins
+            # The rank is zipped in, as generators would otherwise all read the last one
+            ranked = [
+                ((key, rank, value) for (key, value), rank in zip(source, repeat(rank)))
+                for rank, source in enumerate(sources)
+            ]
+            last_key = None
+            for key, _, value in heapq.merge(*ranked):
+                if key != last_key:
+                    last_key = key
+                    value = self.resolve_value(value, now)
+                    live = live_value(value, now)
+                    if live is not None:
+                        yield key, value if with_expiry else live
+        finally:
+            for _, _, segment_file in segment_files:
+                segment_file.unref()
+            if snapshot is None:
+                self.release_version(version)
+
+    def snapshot(self):
+        ''' (self) -> Snapshot
+        Returns a snapshot of the DB as of the last write. Reads given the snapshot
+        don't see the writes made after it, until it is released with
+        release_snapshot, or by leaving a with block.
+        '''
+        with self.write_lock:
+            return self.take_snapshot()
 
-        if floor_node:
-            path = self.segment_path(floor_node.segment)
-            with open(path, 'r') as s:
-                s.seek(floor_node.offset)
-                for line in s:
-                    k, v = line.strip().split(',')
-                    if k == key:
-                        return v.strip()
+    def release_snapshot(self, snapshot):
+        ''' (self, Snapshot) -> None
+        Releases snapshot. The records compaction kept on disk for it are deleted
+        once no older snapshot needs them either.
+        '''
+        with self.snapshots_lock:
+            if snapshot.released:
+                return
+            snapshot.released = True
+            self.snapshots.remove(snapshot)
+
+        self.release_version(snapshot.version)
+        self.apply_deferred_deletions()
+
+    # Statistics
+    def stats(self, measure_space=False):
+        ''' (self, Boolean) -> dict
+        Returns statistics about the DB, by name, including its amplification,
+        with space amplification if measure_space is set.
+
+        For each filter, by segment for xor filters: the lookups it was checked
+        for, those it ruled out and those it let through for keys that weren't on
+        disk (false positives), the false positive rate measured from those, and
+        the rate expected from its size and contents.
+        '''
+        filter_type, bloom_filter = self.filter_type, self.bloom_filter
+        stats = {'filter_type': filter_type}
+
+        if filter_type == 'xor':
+            filters = list(self.segment_filters.items())
+        else:
+            filters = [('bloom', bloom_filter)] if bloom_filter is not None else []
+
+        for name, bloom_filter in filters:
+            counters = self.filter_counters[name]
+            prefix = 'filter.{}.'.format(name)
+
+            # Lookups of keys that aren't on disk are either ruled out or false positives
+            absent = counters['negatives'] + counters['false_positives']
+            stats[prefix + 'checks'] = counters['checks']
+            stats[prefix + 'negatives'] = counters['negatives']
+            stats[prefix + 'false_positives'] = counters['false_positives']
+            stats[prefix + 'measured_false_positive_rate'] = \
+                round(counters['false_positives'] / absent, 6) if absent else 0.0
+            stats[prefix + 'estimated_false_positive_rate'] = \
+                round(bloom_filter.estimated_false_positive_prob(), 6)
+            stats[prefix + 'bits'] = bloom_filter.num_bits()
+            if hasattr(bloom_filter, 'fill_ratio'):
+                stats[prefix + 'fill_ratio'] = round(bloom_filter.fill_ratio(), 6)
+                stats[prefix + 'estimated_items'] = bloom_filter.estimated_items()
+
+        for name, value in self.block_cache.stats().items():
+            stats['block_cache.' + name] = value
+        for name, value in self.file_handle_cache.stats().items():
+            stats['file_handle_cache.' + name] = value
+        for name, value in self.row_cache.stats().items():
+            stats['row_cache.' + name] = value
+        for name, value in self.negative_cache.stats().items():
+            stats['negative_cache.' + name] = value
+        stats['checksums.verification'] = self.checksum_verification
+        stats['checksums.verified_blocks'] = self.verified_blocks
+        stats['checksums.failures'] = self.checksum_failures
+        stats['sequence'] = self.sequence
+        stats['snapshots'] = len(self.snapshots)
+        stats['expiry.expiring_segments'] = len(self.segment_expiries)
+        stats['expiry.dropped_records'] = self.expired_records_dropped
+        stats['expiry.dropped_segments'] = self.expired_segments_dropped
+        stats['value_log.threshold'] = self.value_separation_threshold
+        stats['value_log.files'] = len(self.value_log.file_numbers())
+        stats['value_log.bytes'] = self.value_log.disk_size()
+        stats['value_log.separated_values'] = self.separated_values
+        stats['value_log.collected_bytes'] = self.value_log_bytes_collected
+        for name, value in self.amplification(measure_space).items():
+            stats['amplification.' + name] = value
+        for name, value in self.startup_timings.items():
+            stats['startup.' + name] = value
+
+        return stats
+
+    def amplification(self, measure_space=True):
+        ''' (self, Boolean) -> dict
+        Returns the amplification counters of the DB, along with the write, read
+        and space amplification they add up to. See amplification_ratios.
+
+        Space amplification compares the bytes the segments and value log take up
+        on disk with the bytes the live records, those still in memtables
+        included, would take up in a single segment. Measuring it reads every
+        record, so it is left out unless measure_space is set.
+        '''
+        return amplification_ratios(self.amplification_counters(measure_space))
 
-        return self.search_all_segments(key)
+    def amplification_counters(self, measure_space=True):
+        ''' (self, Boolean) -> dict
+        Returns the amplification counters of the DB, with the bytes it takes up
+        on disk, and those its live records take up if measure_space is set.
+        '''
+        counters = {name: self.io_counters[name] for name in (
+            'user_bytes', 'wal_bytes', 'flush_bytes', 'compaction_bytes', 'merge_bytes',
+            'reads', 'segment_probes')}
+        counters['value_log_bytes'] = self.value_log.bytes_written
+
+        version = self.acquire_version()
+        try:
+            disk_bytes = self.value_log.disk_size()
+            for segment in version.segments:
+                disk_bytes += self.get_file_size(self.segment_path(segment))
+            counters['disk_bytes'] = disk_bytes
+
+            if measure_space:
+                counters['live_bytes'] = sum(
+                    len(key.encode()) + len(value.encode()) + 2
+                    for key, value in self.scan(with_expiry=True))
+        finally:
+            self.release_version(version)
+
+        return counters
 
     # Configuration methods
     def set_threshold(self, threshold):
@@ -130,6 +602,221 @@ class LSMTree():
         '''
         self.sparsity_factor = factor
 
+    def set_block_cache_capacity(self, capacity):
+        ''' (self, int) -> None
+        Sets the memory budget of the block cache, in bytes.
+        '''
+        self.block_cache.set_capacity(capacity)
+
+    def set_max_open_files(self, max_open_files):
+        ''' (self, int) -> None
+        Sets the number of segment files kept open between reads.
+        '''
+        self.file_handle_cache.set_max_open_files(max_open_files)
+
+    def set_row_cache_capacity(self, capacity):
+        ''' (self, int) -> None
+        Sets the memory budget of the row cache, in bytes. 0 turns it off.
+        '''
+        self.row_cache.set_capacity(capacity)
+
+    def set_negative_cache_size(self, max_keys):
+        ''' (self, int) -> None
+        Sets the number of keys missing from disk that are remembered. 0 turns
+        the negative cache off.
+        '''
+        self.negative_cache.set_max_keys(max_keys)
+
+    def set_checksum_verification(self, mode):
+        ''' (self, str) -> None
+        Sets how often blocks read from disk are checked against their checksums:
+        'always', 'sampled' for one read in CHECKSUM_SAMPLE_RATE, or 'off'.
+        '''
+        if mode not in CHECKSUM_VERIFICATION_MODES:
+            raise ValueError('Unknown verification mode {}, expected one of {}'.format(
+                mode, CHECKSUM_VERIFICATION_MODES))
+        self.checksum_verification = mode
+
+    def set_drop_expired_segments(self, enabled):
+        ''' (self, Boolean) -> None
+        Sets whether compaction drops whole segments once every record in them has
+        expired. Expired records are dropped from segments either way.
+        '''
+        self.drop_expired_segments = enabled
+
+    def set_value_separation_threshold(self, threshold):
+        ''' (self, int) -> None
+        Sets the size, in bytes, from which values are moved to the value log when
+        memtables are flushed, and starts collecting the log's garbage in the
+        background, in a single thread that runs until close is called. 0 stops
+        moving values.
+        '''
+        self.value_separation_threshold = threshold
+        if threshold and self.value_log_gc_thread is None and not self.value_log_gc_stop.is_set():
+            self.value_log_gc_thread = threading.Thread(target=self.collect_value_log_periodically, daemon=True)
+            self.value_log_gc_thread.start()
+
+    def close(self):
+        ''' (self) -> None
+        Stops collecting the garbage of the value log, waiting for a run in
+        progress to end, and closes the files of the value log and the manifest.
+        The DB can't be used afterwards.
+        '''
+        self.value_log_gc_stop.set()
+        if self.value_log_gc_thread is not None:
+            self.value_log_gc_thread.join()
+            self.value_log_gc_thread = None
+        self.value_log.close()
+        self.manifest.close()
+
+    def verify(self, threads=VERIFY_THREADS):
+        ''' (self, int) -> dict
+        Checks every block of every segment against its checksum, reading segments
+        over threads threads. Returns the number of segments and blocks checked,
+        the number of corrupt blocks and of segments without checksums, and the
+        numbers of the corrupt blocks of each corrupt segment.
+
+        Segments whose size differs from the size their checksums were computed
+        for, such as segments cut short, are counted as size mismatches, along
+        with their size and the size they should have.
+        '''
+        version = self.acquire_version()
+        try:
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                results = list(executor.map(self.verify_segment, version.segments))
+        finally:
+            self.release_version(version)
+
+        report = {
+            'segments': len(results), 'blocks': 0, 'corrupt_blocks': 0, 'unchecked_segments': 0,
+            'size_mismatches': 0}
+        for segment, (blocks, corrupt, sizes) in zip(version.segments, results):
+            if sizes is not None:
+                logger.error('Segment %s holds %d bytes, but its checksums cover %d', segment, *sizes)
+                report['size_mismatches'] += 1
+                report['size_mismatch.' + segment] = '{},{}'.format(*sizes)
+                continue
+            if blocks is None:
+                report['unchecked_segments'] += 1
+                continue
+
+            report['blocks'] += blocks
+            report['corrupt_blocks'] += len(corrupt)
+            if corrupt:
+                logger.error('Segment %s has corrupt blocks %s', segment, corrupt)
+                report['corrupt.' + segment] = ','.join(str(number) for number in corrupt)
+
+        return report
+
+    def verify_segment(self, segment):
+        ''' (self, str) -> (int, [int], (int, int))
+        Returns the number of blocks of segment and the numbers of those that fail
+        their checksums, or None and [] if segment has no checksums for its size.
+        The size of segment and the size its checksums were computed for are
+        returned last if they differ, or None otherwise.
+        '''
+        path = self.segment_path(segment)
+        while True:
+            generation = self.segment_generations.get(path, 0)
+            with self.segment_file(path, generation) as s:
+                expected = self.segment_block_checksums(path, generation, s)
+                actual = block_checksums(s.data) if expected is not None else None
+                size = s.size()
+                expected_size = checksummed_size(path) if expected is None else size
+
+            # The segment may have been replaced while it was read, along with
+            # its checksums, in which case it is read again
+            if self.is_stable_generation(path, generation):
+                break
+
+        if expected_size is not None and expected_size != size:
+            return None, [], (size, expected_size)
+        if expected is None:
+            return None, [], None
+
+        corrupt = [number for number, (a, b) in enumerate(zip(actual, expected)) if a != b]
+        return len(actual), corrupt, None
+
+    def collect_value_log(self):
+        ''' (self) -> int
+        Collects the garbage of the value log: the oldest file in which at least
+        VALUE_LOG_GC_RATIO of the bytes belong to values since overwritten, deleted
+        or expired has its live values written again, which moves them to the
+        newest file when they are flushed, and is deleted on the next run.
+        Returns the number of bytes of garbage found in the file, or 0 if none
+        was collected.
+
+        Nothing is collected or deleted while snapshots are live, as they may
+        still read values that are garbage to the current version.
+        '''
+        with self.flush_lock:
+            if not self.snapshots and not self.deferred_deletions:
+                for number in self.collected_value_logs:
+                    self.value_log.remove(number)
+                self.collected_value_logs = []
+
+            # Between flushes, every value in a sealed file is either pointed to by
+            # a published segment or garbage
+            numbers = [
+                number for number in self.value_log.sealed_files() if number not in self.collected_value_logs]
+
+        for number in numbers:
+            if self.snapshots or self.deferred_deletions:
+                return 0
+
+            now = now_ms()
+            live = []
+            live_bytes = 0
+            version = self.acquire_version()
+            try:
+                for key, value, pointer in self.value_log.records(number):
+                    stored = self.version_get(key, version, counted=False)
+                    if (stored is not None and split_expiry(stored)[0] == pointer
+                            and live_value(stored, now) is not None):
+                        live.append((key, value, stored))
+                        live_bytes += parse_pointer(pointer)[2]
+            finally:
+                self.release_version(version)
+
+            size = self.value_log.file_size(number)
+            garbage = max(size - live_bytes, 0)
+            if not size or garbage / size < VALUE_LOG_GC_RATIO:
+                continue
+
+            # Values are only written again if they weren't overwritten since
+            for key, value, stored in live:
+                with self.write_lock:
+                    version = self.acquire_version()
+                    try:
+                        if self.version_get(key, version, counted=False) != stored:
+                            continue
+                        frozen = self.insert(key, value + stored[len(split_expiry(stored)[0]):])
+                    finally:
+                        self.release_version(version)
+                if frozen:
+                    self.flush_immutable_memtable(*frozen)
+            self.flush()
+
+            with self.flush_lock:
+                self.collected_value_logs.append(number)
+            self.value_log_bytes_collected += garbage
+            logger.info('Collected value log file %d: %d live values written again, %d bytes of garbage',
+                        number, len(live), garbage)
+            return garbage
+
+        return 0
+
+    def collect_value_log_periodically(self):
+        ''' (self) -> None
+        Collects the garbage of the value log every VALUE_LOG_GC_INTERVAL seconds,
+        until value_log_gc_stop is set.
+        '''
+        while not self.value_log_gc_stop.wait(VALUE_LOG_GC_INTERVAL):
+            try:
+                self.collect_value_log()
+            except Exception:
+                logger.exception('Failed to collect the garbage of the value log')
+
     ### Helper methods
 
     def memtable_wal(self):
@@ -138,111 +825,996 @@ class LSMTree():
         '''
         return AppendLog.instance(self.memtable_wal_path())
 
-    def search_all_segments(self, key):
-        ''' (self, str) -> str
-        Searches all segments on disk for key.
+    def validate_record(self, key, value):
+        ''' (self, str, str) -> None
+        Raises ValueError if key and value can't be stored: segment records are
+        lines holding the key, a comma and the value, values are followed by
+        EXPIRY_SEPARATOR and their expiry time when they expire, and values moved
+        to the value log are replaced by pointers starting with VALUE_POINTER_PREFIX.
+        '''
+        if ',' in key or any(separator in key for separator in RECORD_SEPARATORS):
+            raise ValueError('Keys cannot contain commas or line breaks, got {!r}'.format(key))
+        if any(separator in value for separator in RECORD_SEPARATORS):
+            raise ValueError('Values cannot contain line breaks, got {!r}'.format(value))
+        if EXPIRY_SEPARATOR in value:
+            raise ValueError('Values cannot contain {!r}, which marks expiry times'.format(EXPIRY_SEPARATOR))
+        if is_pointer(value):
+            raise ValueError('Values cannot start with {!r}, which marks pointers to the value log'.format(
+                VALUE_POINTER_PREFIX))
+
+    def resolve_value(self, stored, now=None):
+        ''' (self, str, int) -> str
+        Returns stored, a value as stored, with the value it points to in the value
+        log in place of the pointer, if it points to one and hasn't expired by now.
         '''
-        segments = self.segments[:]
+        if stored is None or not self.value_log.used or not is_pointer(stored):
+            return stored
+
+        pointer, expires_at = split_expiry(stored)
+        if expires_at is not None and expires_at <= (now_ms() if now is None else now):
+            return stored
+        return self.value_log.read(pointer) + stored[len(pointer):]
+
+    def search_all_segments(self, key, segments=None, counted=True):
+        ''' (self, str, [str], Boolean) -> str
+        Searches all segments on disk for key, defaulting to the segments of
+        the current version. The segments searched count as probes if counted is set.
+        '''
+        segments = list(self.segments if segments is None else segments)
         while len(segments):
             segment = segments.pop()
 
-            value = self.search_segment(key, segment)
+            value = self.search_segment(key, segment, counted)
             if value != None:
                 return value
 
-    def search_segment(self, key, segment_name):
-        ''' (self, str) -> str
+    def memtable_items(self, memtable, start, end, sequence=None):
+        ''' (self, RedBlackTree, str, str, int) -> [(str, str)]
+        Returns the key value pairs of memtable with start <= key < end, in key order,
+        ignoring the writes numbered after sequence if given.
+        '''
+        items = []
+        for node in memtable.in_order():
+            if (start is None or node.key >= start) and (end is None or node.key < end):
+                found, value = visible_value(node, sequence)
+                if found:
+                    items.append((node.key, value))
+        return items
+
+    def segment_items(self, stream, start, end):
+        ''' (self, file, str, str) -> generator
+        Yields the key value pairs read from the segment stream with start <= key < end,
+        in key order.
+        '''
+        for line in stream:
+            key, _, value = line.strip().partition(',')
+            if end is not None and key >= end:
+                return
+            if start is None or key >= start:
+                yield key, value
+
+    def segment_block_items(self, path, generation, segment_file, start, end):
+        ''' (self, str, int, SegmentFile, str, str) -> generator
+        Yields the key value pairs with start <= key < end from the segment at path,
+        opened as segment_file at generation, in key order.
+
+        Blocks come from the block cache when they are there, but blocks read for
+        a scan aren't added to it, so that scans don't evict the blocks point
+        reads keep using.
+        '''
+        num_blocks = -(-segment_file.size() // BLOCK_SIZE)
+
+        first = 0
+        index = self.block_indexes.get(path)
+        if start is not None and index is not None and index[0] == generation:
+            _, first_keys, numbers = index
+            first = numbers[max(bisect_right(first_keys, start) - 1, 0)] if numbers else 0
+
+        for number in range(first, num_blocks):
+            block = self.segment_block(path, number, generation, segment_file, fill_cache=False)
+            for key, value in block.items():
+                if end is not None and key >= end:
+                    return
+                if start is None or key >= start:
+                    yield key, value
+
+    def segment_keys(self, segment):
+        ''' (self, str) -> [str]
+        Returns the keys of segment, in order.
+        '''
+        with open(self.segment_path(segment), 'r') as s:
+            return [key for key, _ in self.segment_items(s, None, None)]
+
+    def search_segment(self, key, segment_name, counted=True):
+        ''' (self, str, str, Boolean) -> str
         Returns the value associated with key in the segment represented
-        by segment_name, if it exists. Otherwise return None.
+        by segment_name, if it exists. Otherwise return None. The search counts
+        as a segment probe if counted is set.
+
+        The block index of the segment gives the only block that may hold key.
         '''
-        with open(self.segment_path(segment_name), 'r') as s:
-            pairs = [line.strip() for line in s]
+        if counted:
+            self.io_counters['segment_probes'] += 1
+        path = self.segment_path(segment_name)
+        while True:
+            generation, first_keys, numbers = self.segment_block_index(path)
+            i = bisect_right(first_keys, key) - 1
+            value = self.segment_block(path, numbers[i], generation).get(key) if i >= 0 else None
+
+            # The block index and the block may disagree if the segment was
+            # replaced in the meantime, in which case the search is repeated
+            if self.is_stable_generation(path, generation):
+                return value
 
-            while len(pairs):
-                ptr = (len(pairs) - 1) // 2
-                k, v = pairs[ptr].split(',')
+    # Blocks
+    def segment_block(self, path, number, generation=None, segment_file=None, fill_cache=True):
+        ''' (self, str, int, int, SegmentFile, Boolean) -> dict
+        Returns block number of the segment at path, as the values of its records
+        by key in file order, from the block cache if it is there.
 
-                if k == key:
-                    return v
+        segment_file, if given, is the segment opened at generation, which
+        defaults to the current generation. Blocks read from disk are only cached
+        if fill_cache is set and the segment wasn't replaced while they were read.
+        '''
+        if generation is None:
+            generation = self.segment_generations.get(path, 0)
+
+        cache_key = (path, generation, number)
+        block = self.block_cache.get(cache_key)
+        if block is not None:
+            return block
+
+        if segment_file is None:
+            with self.segment_file(path, generation) as s:
+                self.verify_block(path, generation, s, number)
+                block, size = read_block(s.data, number)
+        else:
+            self.verify_block(path, generation, segment_file, number)
+            block, size = read_block(segment_file.data, number)
+
+        if fill_cache and self.is_stable_generation(path, generation):
+            self.block_cache.put(cache_key, block, size)
+
+        return block
+
+    def verify_block(self, path, generation, segment_file, number):
+        ''' (self, str, int, SegmentFile, int) -> None
+        Checks block number of the segment at path, opened as segment_file at
+        generation, against its checksum, as often as checksum_verification says.
+        Raises CorruptSegmentError if it doesn't match.
+
+        A mismatch while the segment is being replaced may be a race between the
+        file and its checksums, so it is left for the reader to retry.
+        '''
+        mode = self.checksum_verification
+        if mode == 'off' or (mode == 'sampled' and random.randrange(CHECKSUM_SAMPLE_RATE)):
+            return
 
-                if key < k:
-                    pairs = pairs[0:ptr]
-                else:
-                    pairs = pairs[ptr+1:]
+        checksums = self.segment_block_checksums(path, generation, segment_file)
+        if checksums is None or number >= len(checksums):
+            return
+
+        first, stop = block_bounds(segment_file.data, number)
+        self.verified_blocks += 1
+        if zlib.crc32(segment_file.data[first:stop]) != checksums[number] and \
+                self.is_stable_generation(path, generation):
+            self.checksum_failures += 1
+            raise CorruptSegmentError('Block {} of segment {} fails its checksum'.format(number, path))
+
+    def segment_block_checksums(self, path, generation, segment_file):
+        ''' (self, str, int, SegmentFile) -> array
+        Returns the checksums of the blocks of the segment at path, opened as
+        segment_file at generation, or None if it has none. Checksums are read
+        the first time they are needed, and kept until the segment is replaced.
+        '''
+        cached = self.segment_checksums.get(path)
+        if cached is not None and cached[0] == generation:
+            return cached[1]
+
+        checksums = load_checksums(path, segment_file.size())
+        if self.is_stable_generation(path, generation):
+            self.segment_checksums[path] = (generation, checksums)
+
+        return checksums
+
+    def segment_block_index(self, path):
+        ''' (self, str) -> (int, [str], [int])
+        Returns the block index of the segment at path: the generation it was read
+        at, and the first key and number of every block that holds a record.
+
+        Block indexes are built by reading the whole segment the first time it is
+        searched, and kept until the segment is replaced.
+        '''
+        generation = self.segment_generations.get(path, 0)
+        index = self.block_indexes.get(path)
+        if index is not None and index[0] == generation:
+            return index
+
+        first_keys, numbers = [], []
+        position = 0
+        with self.segment_file(path, generation) as s:
+            for line in s.lines():
+                number = position // BLOCK_SIZE
+                if not numbers or numbers[-1] != number:
+                    first_keys.append(line.decode().strip().partition(',')[0])
+                    numbers.append(number)
+                position += len(line)
+
+        index = (generation, first_keys, numbers)
+        if self.is_stable_generation(path, generation):
+            self.block_indexes[path] = index
+
+        return index
+
+    def open_segment(self, path, generation=None):
+        ''' (self, str, int) -> SegmentFile
+        Returns the segment file at path, opened at generation (the current one by
+        default), from the file handle cache if it is open there. The caller holds
+        a reference to it and must unref it once done.
+        '''
+        if generation is None:
+            generation = self.segment_generations.get(path, 0)
+
+        cache_key = (path, generation)
+        segment_file = self.file_handle_cache.get(cache_key)
+        if segment_file is None:
+            segment_file = SegmentFile(path)
+            if self.is_stable_generation(path, generation):
+                self.file_handle_cache.put(cache_key, segment_file)
+
+        return segment_file
+
+    @contextmanager
+    def segment_file(self, path, generation=None):
+        ''' (self, str, int) -> SegmentFile
+        Holds the segment file at path open for the duration of the with block.
+        '''
+        segment_file = self.open_segment(path, generation)
+        try:
+            yield segment_file
+        finally:
+            segment_file.unref()
+
+    def is_stable_generation(self, path, generation):
+        ''' (self, str, int) -> Boolean
+        Returns whether generation is the current generation of the segment at
+        path, and its file isn't being replaced.
+        '''
+        return generation % 2 == 0 and generation == self.segment_generations.get(path, 0)
+
+    def replace_segment(self, temp_path, path):
+        ''' (self, str, str) -> None
+        Replaces the segment file at path with the file at temp_path.
+
+        The generation of the segment is odd while the file is being replaced,
+        so that readers can tell when the blocks they read may be from either file.
+        The rewrite is counted before the file is replaced, so that a reader that
+        finds the new file also finds the count changed.
+        '''
+        self.segment_rewrites += 1
+        self.segment_generations[path] = self.segment_generations.get(path, 0) + 1
+        replace_file(temp_path, path)
+        if Path(checksums_path(temp_path)).exists():
+            replace_file(checksums_path(temp_path), checksums_path(path))
+        else:
+            remove_checksums(path)
+        self.segment_generations[path] += 1
+        self.forget_segment(path)
+
+    def forget_segment(self, path):
+        ''' (self, str) -> None
+        Drops the cached blocks, block index and open file of the segment at path.
+        Readers that still hold the file keep reading it until they are done.
+        '''
+        self.block_cache.invalidate(path)
+        self.file_handle_cache.invalidate(path)
+        self.block_indexes.pop(path, None)
+        self.segment_checksums.pop(path, None)
+
+    # Index
+    @property
+    def index(self):
+        if self.unloaded_index_entries is not None:
+            self.load_index()
+        return self.sparse_index
+
+    @index.setter
+    def index(self, index):
+        with self.index_load_lock:
+            self.sparse_index = index
+            self.unloaded_index_entries = None
+
+    def load_index(self):
+        ''' (self) -> None
+        Builds the index from the entries restored from the manifest.
+        '''
+        with self.index_load_lock:
+            entries = self.unloaded_index_entries
+            if entries is None:
+                return
+
+            index = RedBlackTree()
+            for key, (value, offset, segment) in entries.items():
+                index.add(key, value, offset=offset, segment=segment)
+            self.sparse_index = index
+            self.unloaded_index_entries = None
+
+    # Versions
+    @property
+    def memtable(self):
+        return self.version.memtable
+
+    @memtable.setter
+    def memtable(self, memtable):
+        self.install_version(memtable=memtable)
+
+    @property
+    def segments(self):
+        return self.version.segments
+
+    @segments.setter
+    def segments(self, segments):
+        self.install_version(segments=segments)
+
+    def install_version(self, memtable=None, immutable_memtables=None, segments=None):
+        ''' (self, RedBlackTree, [RedBlackTree], [str]) -> None
+        Makes a new version current. Any component that isn't given is carried
+        over from the current version.
+        '''
+        with self.version_lock:
+            current = self.version
+            version = Version(
+                current.memtable if memtable is None else memtable,
+                current.immutable_memtables if immutable_memtables is None else immutable_memtables,
+                current.segments if segments is None else segments)
+
+            version.ref()
+            self.live_versions.add(version)
+            self.version = version
+            if current:
+                self.release_version(current)
+
+    def acquire_version(self):
+        ''' (self) -> Version
+        Returns the current version, pinning it until release_version is called.
+        '''
+        with self.version_lock:
+            version = self.version
+            version.ref()
+        return version
+
+    def release_version(self, version):
+        ''' (self, Version) -> None
+        Unpins version. Segments that have been made obsolete are deleted once
+        no pinned version refers to them.
+        '''
+        with self.version_lock:
+            if version.unref() == 0:
+                self.live_versions.discard(version)
+                self.delete_obsolete_segments()
+
+    def delete_obsolete_segments(self):
+        ''' (self) -> None
+        Deletes the files of obsolete segments that no live version refers to.
+        '''
+        with self.version_lock:
+            for segment in list(self.obsolete_segments):
+                if any(segment in v.segments for v in self.live_versions):
+                    continue
+
+                self.obsolete_segments.discard(segment)
+                self.segment_filters.pop(segment, None)
+                self.filter_counters.pop(segment, None)
+                for path in (self.segment_path(segment), self.segment_filter_path(segment),
+                             checksums_path(self.segment_path(segment))):
+                    if Path(path).exists():
+                        remove_file(path)
+
+                path = self.segment_path(segment)
+                self.segment_generations[path] = self.segment_generations.get(path, 0) + 2
+                self.forget_segment(path)
+
+    def take_snapshot(self):
+        ''' (self) -> Snapshot
+        Returns a snapshot of the DB as of the last write.
+
+        Note: the caller must hold write_lock.
+        '''
+        snapshot = Snapshot(self.sequence, self.acquire_version(), self.release_snapshot)
+        with self.snapshots_lock:
+            self.snapshots.append(snapshot)
+        return snapshot
+
+    def snapshot_sequences(self):
+        ''' (self) -> [int]
+        Returns the sequence numbers of the live snapshots, in increasing order.
+        '''
+        with self.snapshots_lock:
+            return [snapshot.sequence for snapshot in self.snapshots]
+
+    def retain_history(self, node):
+        ''' (self, Node) -> None
+        Keeps the value of the memtable node, which is about to be overwritten,
+        along with its older values, as long as a live snapshot sees them.
+
+        Note: the caller must hold write_lock and memtable_lock for writing.
+        '''
+        sequences = self.snapshot_sequences()
+        if not sequences:
+            node.history = None
+            return
+
+        versions = (node.history or []) + [(node.sequence or 0, node.value)]
+        history = []
+        for i, (sequence, value) in enumerate(versions):
+            # A value is seen by the snapshots taken before the next one was written
+            next_sequence = versions[i + 1][0] if i + 1 < len(versions) else self.sequence
+            position = bisect_left(sequences, sequence)
+            if position < len(sequences) and sequences[position] < next_sequence:
+                history.append((sequence, value))
+        node.history = history or None
+
+    def is_shadowed(self, key):
+        ''' (self, str) -> Boolean
+        Returns whether compaction kept older records of key on disk for snapshots.
+        '''
+        return any(key in keys for _, keys, _ in self.deferred_deletions)
+
+    def apply_deferred_deletions(self):
+        ''' (self) -> None
+        Deletes the records compaction kept on disk for snapshots that have all
+        been released since.
+        '''
+        def ready(deletion, sequences):
+            return not sequences or sequences[0] >= deletion[0]
+
+        if not any(ready(d, self.snapshot_sequences()) for d in self.deferred_deletions):
+            return
+
+        with self.flush_lock:
+            sequences = self.snapshot_sequences()
+            deletions = [d for d in self.deferred_deletions if ready(d, sequences)]
+            for _, keys, segments in deletions:
+                self.delete_keys_from_segments(keys, [s for s in segments if s in self.segments])
+
+            # Keys are only unshadowed once their older records are gone
+            self.set_deferred_deletions([d for d in self.deferred_deletions if d not in deletions])
+
+    def set_deferred_deletions(self, deletions):
+        ''' (self, [(int, set, [str])]) -> None
+        Replaces the deletions held back for snapshots, and logs them to the
+        manifest, so that they are applied when the DB is next opened if it
+        stops before the snapshots are released.
+        '''
+        self.deferred_deletions = deletions
+        self.manifest.append({'op': 'deferred_deletions', 'deletions': self.deferred_deletions_record()})
+
+    def deferred_deletions_record(self):
+        ''' (self) -> list
+        Returns the deletions held back for snapshots in the form kept by the manifest.
+        '''
+        return [[sequence, sorted(keys), segments] for sequence, keys, segments in self.deferred_deletions]
+
+    def insert(self, key, value):
+        ''' (self, str, str) -> (RedBlackTree, str)
+        Writes key and value, as stored, to the write ahead log and the memtable.
+        Returns the memtable frozen to make room for them, along with the segment
+        it should be flushed to, or None.
+
+        Note: the caller must hold write_lock.
+        '''
+        additional_size = len(key) + len(value)
+        frozen = None
+        self.sequence += 1
+
+        # Check if we can save effort by updating the memtable in place
+        node = self.memtable.find_node(key)
+        if node:
+            self.io_counters['wal_bytes'] += self.memtable_wal().write(key, value)
+            with self.memtable_lock.write():
+                self.retain_history(node)
+                node.value = value
+                node.sequence = self.sequence
+            self.row_cache.invalidate(key)
+            self.negative_cache.invalidate(key)
+            return None
+
+        # Check if new segment needed
+        if self.memtable.total_bytes + additional_size > self.threshold:
+            frozen = self.rotate_memtable()
+
+        # Write to memtable write ahead log in case of crash
+        self.io_counters['wal_bytes'] += self.memtable_wal().write(key, value)
+
+        # Write to memtable
+        with self.memtable_lock.write():
+            self.memtable.add(key, value, sequence=self.sequence)
+        self.memtable.total_bytes += additional_size
+        self.row_cache.invalidate(key)
+        self.negative_cache.invalidate(key)
+        return frozen
+
+    def rotate_memtable(self):
+        ''' (self) -> (RedBlackTree, str)
+        Freezes the current memtable and replaces it with an empty one. Returns the
+        frozen memtable along with the name of the segment it should be flushed to.
+
+        Note: the caller must hold write_lock.
+        '''
+        memtable, segment = self.memtable, self.current_segment
+        self.memtable_wal().rotate(self.immutable_wal_path(segment))
+        self.current_segment = self.incremented_segment_name()
+
+        with self.version_lock:
+            self.install_version(
+                memtable=RedBlackTree(),
+                immutable_memtables=(memtable,) + self.version.immutable_memtables)
+
+        return memtable, segment
+
+    def flush_immutable_memtable(self, memtable, segment):
+        ''' (self, RedBlackTree, str) -> None
+        Compacts the segments on disk against memtable, writes memtable to segment and
+        publishes the segment in a new version. Flushes are applied one at a time, in
+        the order the memtables were frozen.
+        '''
+        with self.flush_lock:
+            self.flush_lock.wait_for(
+                lambda: self.flush_error is not None or self.version.immutable_memtables[-1] is memtable)
+            self.check_flush_error()
+            try:
+                try:
+                    self.compact(memtable)
+                    index_entries = self.flush_memtable_to_disk(self.segment_path(segment), memtable, segment)
+                except Exception as e:
+                    # The memtable stays queued and readable, and its write ahead log
+                    # is replayed on the next start
+                    logger.exception('Failed to flush %s', segment)
+                    self.flush_error = e
+                    raise
+
+                with self.version_lock:
+                    immutable_memtables = [
+                        m for m in self.version.immutable_memtables if m is not memtable]
+                    self.install_version(
+                        immutable_memtables=immutable_memtables,
+                        segments=self.segments + [segment])
+
+                # The segment is in the manifest before its write ahead log is removed
+                self.manifest.append({
+                    'op': 'add_segment',
+                    'segment': segment,
+                    'current_segment': self.current_segment,
+                    'index': [[key, value, offset] for key, value, offset in index_entries],
+                    'expiry': self.segment_expiries.get(segment),
+                })
+
+                wal_path = self.immutable_wal_path(segment)
+                if Path(wal_path).exists():
+                    remove_file(wal_path)
+
+                if self.manifest.needs_checkpoint() and self.filters_settled.is_set():
+                    self.save_metadata()
+            finally:
+                self.flush_lock.notify_all()
+
+    def check_flush_error(self):
+        ''' (self) -> None
+        Raises FlushFailedError if a flush failed, as the memtables frozen after
+        the one it was flushing can't be flushed before it.
+
+        Note: the caller must hold flush_lock.
+        '''
+        if self.flush_error is not None:
+            raise FlushFailedError('An earlier flush failed: {}'.format(self.flush_error)) from self.flush_error
 
     # Metadata and initialization helpers
     def load_metadata(self):
         ''' (self) -> None
-        Checks to see if any metadata or memtable logs are present from the previous
-        session, and load them into the system.
+        Restores the segments, settings, index and filters of the previous session
+        from the manifest.
+
+        DBs saved before the manifest existed are loaded from their metadata file
+        once, and checkpointed into a manifest.
         '''
-        if Path(self.metadata_path()).exists():
+        if self.manifest.exists():
+            self.load_manifest()
+        elif Path(self.metadata_path()).exists():
             with open(self.metadata_path(), 'rb') as s:
                 metadata = pickle.load(s)
                 self.segments = metadata['segments']
                 self.current_segment = metadata['current_segment']
-                self.bloom_filter = metadata['bloom_filter']
                 self.bf_num_items = metadata['bf_num_items']
                 self.bf_false_pos_prob = metadata['bf_false_pos']
                 self.index = metadata['index']
+                self.filter_type = metadata.get('filter_type', 'bloom')
+
+                # Metadata from before filters had their own file holds the filter
+                if Path(self.bloom_filter_path()).exists():
+                    self.bloom_filter = load_bloom_filter(self.bloom_filter_path())
+                elif 'bloom_filter' in metadata:
+                    self.bloom_filter = metadata['bloom_filter']
+
+                if self.filter_type == 'xor':
+                    self.bloom_filter = None
+                    for segment in self.segments:
+                        if Path(self.segment_filter_path(segment)).exists():
+                            self.segment_filters[segment] = load_xor_filter(self.segment_filter_path(segment))
+
+            self.save_metadata()
+            remove_file(self.metadata_path())
+
+    def load_manifest(self):
+        ''' (self) -> None
+        Replays the manifest: its snapshot, then the edits made since.
+
+        Opening only costs a pass over the manifest. The index is built on first
+        use, and filters are memory mapped. The bloom filter file is only saved
+        with snapshots, so the keys of the segments added since are added to it
+        again in the background, or the whole filter is rebuilt if its settings
+        changed. Xor filters that are missing are built in the background too.
+        The filters are saved by the next checkpoint.
+        '''
+        started = time.perf_counter()
+        records, _ = self.manifest.replay()
+
+        segments, index_entries = [], {}
+        added, settings_changed = [], False
+        deferred_deletions = []
+        segment_expiries = {}
+        for record in records:
+            op = record['op']
+            if op == 'snapshot':
+                segments = list(record['segments'])
+                self.current_segment = record['current_segment']
+                self.bf_num_items = record['bf_num_items']
+                self.bf_false_pos_prob = record['bf_false_pos_prob']
+                self.filter_type = record['filter_type']
+                index_entries = {
+                    key: (value, offset, segment) for key, value, offset, segment in record['index']}
+                deferred_deletions = record.get('deferred_deletions', [])
+                segment_expiries = {
+                    segment: tuple(expiry) for segment, expiry in record.get('segment_expiries', {}).items()}
+            elif op == 'add_segment':
+                segments.append(record['segment'])
+                if record.get('expiry'):
+                    segment_expiries[record['segment']] = tuple(record['expiry'])
+                self.current_segment = record['current_segment']
+                for key, value, offset in record['index']:
+                    index_entries[key] = (value, offset, record['segment'])
+                added.append(record['segment'])
+            elif op == 'remove_segment':
+                segments.remove(record['segment'])
+                segment_expiries.pop(record['segment'], None)
+                if record['segment'] in added:
+                    added.remove(record['segment'])
+
+                # The segment a segment was merged into was rewritten with keys the
+                # saved bloom filter may not hold
+                target = record.get('merged_into')
+                if target is not None:
+                    if target not in added:
+                        added.append(target)
+                    if record.get('expiry'):
+                        segment_expiries[target] = tuple(record['expiry'])
+                index_entries = {
+                    key: entry for key, entry in index_entries.items() if entry[2] != record['segment']}
+            elif op == 'set':
+                setattr(self, record['name'], record['value'])
+                settings_changed = True
+            elif op == 'deferred_deletions':
+                deferred_deletions = record['deletions']
+
+        self.segments = segments
+        self.segment_expiries = segment_expiries
+
+        # Snapshots don't outlive a session, so the records compaction kept for
+        # them are deleted straight away
+        if deferred_deletions:
+            for _, keys, deferred_segments in deferred_deletions:
+                self.delete_keys_from_segments(
+                    set(keys), [segment for segment in deferred_segments if segment in segments])
+            self.set_deferred_deletions([])
+        self.index = RedBlackTree()
+        if index_entries:
+            self.unloaded_index_entries = index_entries
+        loaded = time.perf_counter()
+
+        if self.filter_type == 'xor':
+            self.bloom_filter = None
+            missing = []
+            for segment in segments:
+                if Path(self.segment_filter_path(segment)).exists():
+                    self.segment_filters[segment] = load_xor_filter(self.segment_filter_path(segment))
+                else:
+                    missing.append(segment)
+            catch_up = partial(self.build_missing_segment_filters, missing) if missing else None
+        elif settings_changed or not Path(self.bloom_filter_path()).exists():
+            self.bloom_filter = self.new_bloom_filter()
+            catch_up = self.rebuild_bloom_filter if segments else None
+        else:
+            self.bloom_filter = load_bloom_filter(self.bloom_filter_path())
+            catch_up = partial(self.add_segments_to_bloom_filter, added) if added else None
+
+        self.startup_timings['manifest_ms'] = round((loaded - started) * 1000, 3)
+        self.startup_timings['filters_ms'] = round((time.perf_counter() - loaded) * 1000, 3)
+
+        if catch_up is not None:
+            self.filters_ready.clear()
+            self.filters_settled.clear()
+            threading.Thread(target=self.catch_up_filters, args=(catch_up,), daemon=True).start()
+
+    def catch_up_filters(self, catch_up):
+        ''' (self, function) -> None
+        Brings the filters restored from the manifest up to date by calling catch_up.
+
+        If that fails, a bloom filter is rebuilt from every segment instead, as it
+        may only cover some of their keys. Xor filters that couldn't be built are
+        left missing, which lets every key through their segments. Reads keep
+        letting every key through the bloom filter if the rebuild fails too.
+        '''
+        try:
+            try:
+                catch_up()
+            except Exception:
+                if self.filter_type == 'xor':
+                    logger.exception('Failed to build the missing xor filters')
+                else:
+                    logger.exception('Failed to catch the bloom filter up, rebuilding it')
+                    self.rebuild_bloom_filter()
+            self.filters_ready.set()
+        except Exception:
+            logger.exception('Failed to rebuild the bloom filter, reads will not use it')
+        finally:
+            self.filters_settled.set()
+
+    def build_missing_segment_filters(self, segments):
+        ''' (self, [str]) -> None
+        Builds the xor filters of segments. Segments that were merged away in the
+        meantime are skipped.
+        '''
+        for segment in segments:
+            with self.flush_lock:
+                if segment in self.segments and segment not in self.segment_filters:
+                    self.build_segment_filter(segment, self.segment_keys(segment))
+
+    def add_segments_to_bloom_filter(self, segments):
+        ''' (self, [str]) -> None
+        Adds the keys of segments to the bloom filter. Segments that were merged
+        away in the meantime are skipped.
+        '''
+        for segment in segments:
+            # Holding the flush lock, flushes don't add to the filter at the same time
+            with self.flush_lock:
+                if Path(self.segment_path(segment)).exists():
+                    self.bloom_filter.add_many(self.segment_keys(segment))
 
     def save_metadata(self):
         ''' (self) -> None
-        Save necessary bookkeeping information.
+        Checkpoints the manifest. The bloom filter is saved to a file of its own,
+        which can be memory mapped when it is loaded, and the manifest is replaced
+        by a snapshot of the segments, settings and index it covers.
+        '''
+        # The filter is only saved once it covers every segment in the snapshot. A
+        # filter that failed to catch up is removed instead, so that the next
+        # session rebuilds it rather than trusting it.
+        self.filters_settled.wait()
+
+        # Holding the flush lock, no segment is added between the two
+        with self.flush_lock:
+            if self.bloom_filter is not None and self.filters_ready.is_set():
+                self.bloom_filter.save(self.bloom_filter_path())
+            elif Path(self.bloom_filter_path()).exists():
+                remove_file(self.bloom_filter_path())
+
+            self.manifest.checkpoint(self.manifest_snapshot(self.segments))
+
+    def manifest_snapshot(self, segments):
+        ''' (self, [str]) -> dict
+        Returns a manifest record of the whole state of the DB, with segments on disk.
+
+        Note: the caller must hold flush_lock.
         '''
-        bookkeeping_info = {
+        unloaded_index_entries = self.unloaded_index_entries
+        if unloaded_index_entries is not None:
+            index = [[key, value, offset, segment]
+                     for key, (value, offset, segment) in unloaded_index_entries.items()]
+        else:
+            with self.index_lock.read():
+                index = [[node.key, node.value, node.offset, node.segment] for node in self.index.in_order()]
+
+        return {
+            'op': 'snapshot',
             'current_segment': self.current_segment,
-            'segments': self.segments,
-            'bloom_filter': self.bloom_filter,
+            'segments': list(segments),
             'bf_num_items': self.bf_num_items,
-            'bf_false_pos': self.bf_false_pos_prob,
-            'index': self.index
+            'bf_false_pos_prob': self.bf_false_pos_prob,
+            'filter_type': self.filter_type,
+            'index': index,
+            'deferred_deletions': self.deferred_deletions_record(),
+            'segment_expiries': {
+                segment: list(expiry) for segment, expiry in self.segment_expiries.items()
+                if segment in segments},
         }
 
-        with open(self.metadata_path(), 'wb') as s:
-            pickle.dump(bookkeeping_info, s)
+    def checkpoint(self, directory):
+        ''' (self, str) -> dict
+        Writes a checkpoint of the DB to directory, which must be empty or not
+        exist, while reads and writes carry on. Opening a DB in directory, or in
+        a copy made by restore_checkpoint, restores the DB as it was.
+
+        The memtable is flushed first. Segment files are never modified in place,
+        so the segments, their checksums and filters are hard linked into
+        directory rather than copied, as are the files of the value log, which is
+        moved on to a new file so that the linked ones are never appended to. A
+        manifest covering them is written next to them. Returns the number of
+        segments and files in the checkpoint and the time it took.
+        '''
+        started = time.perf_counter()
+        prepare_directory(directory)
+        self.flush()
+
+        # The filter is only saved once it covers every segment in the checkpoint.
+        # Without it, a DB opened from the checkpoint rebuilds it.
+        self.filters_settled.wait()
+
+        # Holding the flush lock, no segment is added or compacted in the meantime,
+        # and the pinned version keeps merged segments from being deleted
+        files = 0
+        with self.flush_lock:
+            version = self.acquire_version()
+            try:
+                for segment in version.segments:
+                    path = self.segment_path(segment)
+                    for source in (path, checksums_path(path), self.segment_filter_path(segment)):
+                        if Path(source).exists():
+                            link_or_copy(source, os.path.join(directory, Path(source).name))
+                            files += 1
+
+                self.value_log.seal()
+                for number in self.value_log.file_numbers():
+                    source = self.value_log.path(number)
+                    link_or_copy(source, os.path.join(directory, Path(source).name))
+                    files += 1
+
+                if self.bloom_filter is not None and self.filters_ready.is_set():
+                    self.bloom_filter.save(os.path.join(directory, Path(self.bloom_filter_path()).name))
+                    files += 1
+
+                manifest = Manifest(os.path.join(directory, MANIFEST_NAME))
+                manifest.checkpoint(self.manifest_snapshot(version.segments))
+                manifest.close()
+                files += 1
+            finally:
+                self.release_version(version)
+
+        elapsed_ms = round((time.perf_counter() - started) * 1000, 3)
+        logger.info('Checkpointed %d segments of %s to %s in %.1fms',
+                    len(version.segments), self.segments_directory, directory, elapsed_ms)
+        return {'segments': len(version.segments), 'files': files, 'elapsed_ms': elapsed_ms}
+
+    def record_setting(self, name):
+        ''' (self, str) -> None
+        Logs the current value of the setting called name to the manifest.
+        '''
+        self.manifest.append({'op': 'set', 'name': name, 'value': getattr(self, name)})
 
     def restore_memtable(self):
         ''' (self) -> None
         Re-populates the memtable from the disk backup.
+
+        Logs of memtables that were frozen but never finished flushing are
+        replayed first, oldest to newest. Only the last write of each key is
+        kept, and the memtable is built from them in one go.
+
+        Logs left by versions that wrote key,value lines are rewritten as binary
+        records once, before they are replayed.
         '''
-        if Path(self.memtable_wal_path()).exists():
-            with open(self.memtable_wal_path(), 'r') as s:
-                for line in s:
-                    key, value = line.strip().split(',')
-                    self.memtable.add(key, value)
-                    self.memtable.total_bytes += len(key) + len(value)
+        wal_paths = sorted(
+            Path(self.segments_directory).glob(self.wal_basename + '.*'),
+            key=lambda p: int(p.name.split('-')[-1]))
+        wal_paths = [str(p) for p in wal_paths] + [self.memtable_wal_path()]
+
+        values = {}
+        for wal_path in wal_paths:
+            if Path(wal_path).exists():
+                if is_legacy_log(wal_path):
+                    upgrade_legacy_log(wal_path)
+                    if wal_path == self.memtable_wal_path():
+                        self.memtable_wal().reopen()
+                values.update(read_records(wal_path))
+
+        # Writes already in the memtable are older than the ones in the logs
+        for node in self.memtable.in_order():
+            values.setdefault(node.key, node.value)
+
+        memtable = RedBlackTree.from_sorted(sorted(values.items()))
+        for node in memtable.in_order():
+            self.sequence += 1
+            node.sequence = self.sequence
+        memtable.total_bytes = sum(len(key) + len(value) for key, value in values.items())
+        self.memtable = memtable
 
     # Write helpers
 
-    def flush_memtable_to_disk(self, path):
-        ''' (self, str) -> None
-        Writes the contents of the current memtable to disk and wipes the current memtable.
+    def flush_memtable_to_disk(self, path, memtable=None, segment=None):
+        ''' (self, str, RedBlackTree, str) -> [(str, str, int)]
+        Writes the contents of memtable (the current memtable by default) to disk as
+        segment (the current segment by default).
+
+        Adds keys to the bloom filter and updates the index. Index entries are only
+        published once the segment has been written in full, so that readers never
+        follow them into a partial file. Returns the index entries added.
 
-        Updates the index and adds keys to the bloom filter.
+        Records that have already expired are left out, unless older records of
+        their key were kept on disk for snapshots. Values of at least
+        value_separation_threshold bytes are moved to the value log, which is
+        synced before the segment is written in full.
         '''
         print("Flushing memtable to disk")
+        memtable = self.memtable if memtable is None else memtable
+        segment = self.current_segment if segment is None else segment
         sparsity_counter = self.sparsity()
+        now = now_ms()
 
         # We track the offset for each key ourself, instead of checking the file's size as we
         # write, since its faster than making sure that every new write is flushed to disk.
         key_offset = 0
+        index_entries = []
+        keys = []
+        expiry_times = []
+        separation_threshold = self.value_separation_threshold
+        separated = 0
 
         with open(path, 'w') as s:
-            for node in self.memtable.in_order():
-                log = self.to_log_entry(node.key, node.value)
+            for node in memtable.in_order():
+                value, expires_at = split_expiry(node.value)
+                if expires_at is not None:
+                    if expires_at <= now and not self.is_shadowed(node.key):
+                        self.expired_records_dropped += 1
+                        continue
+                    expiry_times.append(expires_at)
+
+                stored = node.value
+                if separation_threshold and len(value) >= separation_threshold:
+                    stored = self.value_log.append(node.key, value) + node.value[len(value):]
+                    separated += 1
+
+                log = self.to_log_entry(node.key, stored)
 
                 # Update sparse index
                 if sparsity_counter == 1:
-                    self.index.add(node.key, node.value,
-                                   offset=key_offset, segment=self.current_segment)
+                    index_entries.append((node.key, stored, key_offset))
                     sparsity_counter = self.sparsity() + 1
 
-                # Add to bloom filters
-                self.bloom_filter.add(node.key)
+                keys.append(node.key)
                 s.write(log)
                 key_offset += len(log)
                 sparsity_counter -= 1
+        if separated:
+            self.value_log.sync()
+            self.separated_values += separated
+        self.io_counters['flush_bytes'] += key_offset
+        write_checksums(path)
+
+        expiry = expiry_range(expiry_times, len(keys))
+        if expiry is not None:
+            self.segment_expiries[segment] = expiry
+
+        # Add to the filters, all at once
+        if self.filter_type == 'xor':
+            self.build_segment_filter(segment, keys)
+        else:
+            self.bloom_filter.add_many(keys)
+        rebuilding_bloom_filter = self.rebuilding_bloom_filter
+        if rebuilding_bloom_filter is not None:
+            rebuilding_bloom_filter.add_many(keys)
+
+        with self.index_lock.write():
+            for key, value, offset in index_entries:
+                self.index.add(key, value, offset=offset, segment=segment)
+
+        return index_entries
 
     def to_log_entry(self, key, value):
         '''(str, str) -> str
@@ -263,91 +1835,232 @@ class LSMTree():
 
     # Compact and merge
 
-    def compact(self):
-        ''' (self) -> None
-        Reads the keys from the memtable, determines which ones probably
-        have pre-existing records on disk and reclaims disk space accordingly.
+    def compact(self, memtable=None):
+        ''' (self, RedBlackTree) -> None
+        Reads the keys from memtable (the current memtable by default), determines
+        which ones probably have pre-existing records on disk and reclaims disk
+        space accordingly.
 
         Note: this will parse every segment in self.segments. It is intended to be
         used BEFORE flushing the memtable to disk.
         '''
-        logger.info("Compacting segments...")
-        memtable_nodes = self.memtable.in_order()
-
-        keys_on_disk = []
-        for node in memtable_nodes:
-            if self.bloom_filter.check(node.key):
-                keys_on_disk.append(node.key)
-
-        keys_on_disk = set(keys_on_disk)
-
-        self.delete_keys_from_segments(keys_on_disk, self.segments)
-
-    def delete_keys_from_segments(self, deletion_keys, segment_names):
-        ''' (self, list) -> None
+        # Compactions run one at a time, and never during a flush, as they rewrite
+        # the same segments through the same temporary files
+        with self.flush_lock:
+            logger.info("Compacting segments...")
+
+            # Segments whose records have all expired are dropped, unless older records
+            # kept for snapshots would show through
+            now = now_ms()
+            expired, expiring = self.segments_with_expired_records(self.segments, now)
+            if self.drop_expired_segments and not self.deferred_deletions:
+                for segment in expired:
+                    logger.info('Dropping %s, every record of which has expired', segment)
+                    self.retire_segment(segment)
+                    self.expired_segments_dropped += 1
+            else:
+                expiring += expired
+
+            if memtable is None:
+                with self.memtable_lock.read():
+                    memtable_nodes = self.memtable.in_order()
+            else:
+                memtable_nodes = memtable.in_order()
+
+            segments = self.segments
+            keys = [node.key for node in memtable_nodes]
+            keys_on_disk = set(
+                key for key, on_disk in zip(keys, self.check_many_on_disk(keys, segments)) if on_disk)
+
+            # Records on disk stay there while a live snapshot predates every value of
+            # their key in the memtable, as the snapshot still reads them
+            sequences = self.snapshot_sequences()
+            if sequences:
+                first_sequences = {
+                    node.key: node.history[0][0] if node.history else node.sequence or 0
+                    for node in memtable_nodes if node.key in keys_on_disk}
+                kept = set(key for key, sequence in first_sequences.items() if sequence > sequences[0])
+                if kept:
+                    keys_on_disk -= kept
+                    self.set_deferred_deletions(self.deferred_deletions + [
+                        (max(first_sequences[key] for key in kept), kept, list(segments))])
+
+            self.delete_keys_from_segments(keys_on_disk, segments, expiring, now)
+
+    def segments_with_expired_records(self, segments, now):
+        ''' (self, [str], int) -> ([str], [str])
+        Returns the segments of segments whose records had all expired by now,
+        followed by those worth rewriting to drop their expired records: those
+        where EXPIRED_REWRITE_RATIO of the span of their expiry times has passed.
+        '''
+        expired, expiring = [], []
+        for segment in segments:
+            expiry = self.segment_expiries.get(segment)
+            if expiry is None:
+                continue
+
+            first, last, all_expire = expiry
+            if all_expire and last <= now:
+                expired.append(segment)
+            elif first <= now and now - first >= EXPIRED_REWRITE_RATIO * (last - first):
+                expiring.append(segment)
+
+        return expired, expiring
+
+    def delete_keys_from_segments(self, deletion_keys, segment_names, expiring=(), now=None):
+        ''' (self, list, [str], [str], int) -> None
         Deletes all keys stored in the set deletion_keys from each segment
-        listed in segment_names.
+        listed in segment_names. The records that expired by now are dropped
+        from the segments in expiring as well.
         '''
         for segment in segment_names:
             segment_path = self.segment_path(segment)
-            self.delete_keys_from_segment(deletion_keys, segment_path)
-
-    def delete_keys_from_segment(self, deletion_keys, segment_path):
-        ''' (self, set(keys), str) -> None
+            if segment not in expiring:
+                self.delete_keys_from_segment(deletion_keys, segment_path)
+                continue
+
+            expiry = self.delete_keys_from_segment(deletion_keys, segment_path, now)
+            if expiry is None:
+                self.segment_expiries.pop(segment, None)
+            else:
+                self.segment_expiries[segment] = expiry
+
+    def delete_keys_from_segment(self, deletion_keys, segment_path, now=None):
+        ''' (self, set(keys), str, int) -> (int, int, Boolean)
         Removes the lines with key in deletion_keys from the file stored at segment 
-        path.
+        path. If now is given, the lines holding records that expired by then are
+        removed too, except for keys with older records kept for snapshots, and
+        the expiry range of the records left is returned.
 
         The method achieves this by writing the desireable keys to a new 
         temporary file, then deleting the old version and replacing it with the
         temporary one. This strategy is chosen to avoid overloading memory.
         '''
-        temp_path = segment_path + '_temp'
-
-        with open(segment_path, "r") as input:
-            with open(temp_path, "w") as output:
-                for line in input:
-                    key, value = line.split(',')
-                    if not key in deletion_keys:
-                        output.write(line)
+        if not deletion_keys and now is None:
+            return
 
-        remove_file(segment_path)
-        rename_file(temp_path, segment_path)
+        temp_path = segment_path + '_temp'
+        deleted = False
+        separator = EXPIRY_SEPARATOR.encode()
+        expiry_times = []
+        count = 0
+
+        with self.segment_file(segment_path) as input:
+            with open(temp_path, "wb") as output:
+                for line in input.lines():
+                    key = line.split(b',')[0].decode()
+                    if key in deletion_keys:
+                        deleted = True
+                        continue
+
+                    if now is not None and separator in line:
+                        expires_at = split_expiry(line.rstrip(b'\n').decode())[1]
+                        if expires_at is not None:
+                            if expires_at <= now and not self.is_shadowed(key):
+                                self.expired_records_dropped += 1
+                                deleted = True
+                                continue
+                            expiry_times.append(expires_at)
+
+                    output.write(line)
+                    count += 1
+                self.io_counters['compaction_bytes'] += output.tell()
+
+        expiry = expiry_range(expiry_times, count) if now is not None else None
+
+        # Segments that don't hold any of the keys are left alone, which keeps
+        # their blocks in the block cache
+        if not deleted:
+            remove_file(temp_path)
+            return expiry
+        write_checksums(temp_path)
+
+        # Replacing the file in a single step means that readers always find
+        # either the old or the new version of the segment.
+        self.replace_segment(temp_path, segment_path)
+        return expiry
 
     def merge(self, segment1, segment2):
         ''' (self, str, str) -> str
         Concatenates the contents of the files represented byt segment1 and
         segment2, erases the second segment file and returns the name of the
         first segment. 
+
+        The second segment file is only erased once no reader is using it. The
+        segments aren't merged, and None is returned, while a live snapshot sees
+        the first segment but not the second, as the first is rewritten in place,
+        or while compaction holds records back for snapshots.
         '''
-        path1 = self.segments_directory + segment1
-        path2 = self.segments_directory + segment2
-        new_path = self.segments_directory + 'temp'
-
-        with open(new_path, 'w') as s0:
-            with open(path1, 'r') as s1:
-                with open(path2, 'r') as s2:
-                    line1, line2 = s1.readline(), s2.readline()
-                    while not (line1 == '' and line2 == ''):
-                        # At the end of the file stream we'll get the empty str
-                        key1, key2 = line1.split(',')[0], line2.split(',')[0]
-
-                        if key1 == '' or key1 == key2:
-                            s0.write(line2)
-                            line1 = s1.readline()
-                            line2 = s2.readline()
-                        elif key2 == '' or key1 < key2:
-                            s0.write(line1)
-                            line1 = s1.readline()
-                        else:
-                            s0.write(line2)
-                            line2 = s2.readline()
-
-        # Remove old segments and replaced first segment with the new one
-        remove_file(path1)
-        remove_file(path2)
-        rename_file(new_path, path1)
-
-        return segment1
+        # Merges run under the flush lock, so that flushes don't compact the same
+        # segments at the same time
+        with self.flush_lock:
+            with self.snapshots_lock:
+                if self.deferred_deletions or any(
+                        segment1 in snapshot.version.segments and segment2 not in snapshot.version.segments
+                        for snapshot in self.snapshots):
+                    logger.info('Deferring merge of %s and %s for a live snapshot', segment1, segment2)
+                    return None
+
+            path1 = self.segments_directory + segment1
+            path2 = self.segments_directory + segment2
+            new_path = self.segments_directory + 'temp'
+            keys = []
+
+            with open(new_path, 'w') as s0:
+                with open(path1, 'r') as s1:
+                    with open(path2, 'r') as s2:
+                        line1, line2 = s1.readline(), s2.readline()
+                        while not (line1 == '' and line2 == ''):
+                            # At the end of the file stream we'll get the empty str
+                            key1, key2 = line1.split(',')[0], line2.split(',')[0]
+
+                            if key1 == '' or key1 == key2:
+                                s0.write(line2)
+                                keys.append(key2)
+                                line1 = s1.readline()
+                                line2 = s2.readline()
+                            elif key2 == '' or key1 < key2:
+                                s0.write(line1)
+                                keys.append(key1)
+                                line1 = s1.readline()
+                            else:
+                                s0.write(line2)
+                                keys.append(key2)
+                                line2 = s2.readline()
+
+            # Replace the first segment with the new one and retire the second. The
+            # filter of the first segment covers both before the second is retired.
+            self.io_counters['merge_bytes'] += self.get_file_size(new_path)
+            write_checksums(new_path)
+            self.replace_segment(new_path, path1)
+            if self.filter_type == 'xor':
+                self.build_segment_filter(segment1, keys)
+
+            expiry = merge_expiry_ranges(
+                [self.segment_expiries.get(segment1), self.segment_expiries.get(segment2)])
+            if expiry is not None:
+                self.segment_expiries[segment1] = expiry
+            self.retire_segment(segment2, merged_into=segment1)
+
+            return segment1
+
+    def retire_segment(self, segment, merged_into=None):
+        ''' (self, str, str) -> None
+        Removes segment from the DB. Its files are only deleted once no reader is
+        using them. merged_into is the segment its records were merged into, if any,
+        which the manifest records along with its new expiry range.
+        '''
+        with self.version_lock:
+            if segment in self.segments:
+                self.segments = [s for s in self.segments if s != segment]
+                record = {'op': 'remove_segment', 'segment': segment}
+                if merged_into is not None:
+                    record['merged_into'] = merged_into
+                    record['expiry'] = self.segment_expiries.get(merged_into)
+                self.manifest.append(record)
+            self.segment_expiries.pop(segment, None)
+            self.obsolete_segments.add(segment)
+            self.delete_obsolete_segments()
 
     def get_file_size(self, path):
         return Path(path).stat().st_size
@@ -363,44 +2076,198 @@ class LSMTree():
     def repopulate_index(self):
         '''(self) -> None
         Repopulates the index stored in the database by parsing each segment
-        on disk.
+        on disk. Segments are parsed in parallel, over scan_processes processes.
         '''
-        self.index = RedBlackTree()
-        for segment in self.segments:
-            path = self.segment_path(segment)
-
-            counter = self.sparsity()
-            bytes = 0
-            with open(path, 'r') as s:
-                for line in s:
-                    key, val = line.strip().split(',')
-                    if counter == 1:
-                        self.index.add(key, val, offset=bytes, segment=segment)
-                        counter = self.sparsity() + 1
-
-                    bytes += len(line)
-                    counter -= 1
+        version = self.acquire_version()
+        try:
+            paths = [self.segment_path(segment) for segment in version.segments]
+            samples = scan_segments(paths, self.sparsity(), processes=self.scan_processes)
+        finally:
+            self.release_version(version)
+
+        index = RedBlackTree()
+        for segment, segment_samples in zip(version.segments, samples):
+            for key, value, offset in segment_samples:
+                index.add(key, value, offset=offset, segment=segment)
+        self.index = index
+
+    def set_scan_processes(self, processes):
+        ''' (self, int) -> None
+        Sets the number of processes segments are scanned with when rebuilding
+        the index or the bloom filter.
+        '''
+        self.scan_processes = processes
 
     # Bloom filter
     def set_bloom_filter_num_items(self, num_items):
         ''' (self, int) -> None
         Sets the number of expected item for the bloom filter.
 
-        Warning - this operation re-initializes structure.
+        The filter is rebuilt from the segments in the background. The current
+        filter keeps answering until the new one is ready.
         '''
         self.bf_num_items = num_items
-        self.bloom_filter = BloomFilter(
-            self.bf_num_items, self.bf_false_pos_prob)
+        self.record_setting('bf_num_items')
+        if self.filter_type == 'bloom':
+            self.rebuild_bloom_filter_in_background()
 
     def set_bloom_filter_false_pos_prob(self, probability):
         ''' (self, int) -> None
         Sets the desired probability of generating a false positive for the bloom filter.
 
-        Warning - this operation re-initializes the structure.
+        The filter is rebuilt from the segments in the background. The current
+        filter keeps answering until the new one is ready.
         '''
         self.bf_false_pos_prob = probability
-        self.bloom_filter = BloomFilter(
-            self.bf_num_items, self.bf_false_pos_prob)
+        self.record_setting('bf_false_pos_prob')
+        if self.filter_type == 'bloom':
+            self.rebuild_bloom_filter_in_background()
+
+    def set_filter_type(self, filter_type):
+        ''' (self, str) -> None
+        Sets the kind of filter used to skip segments that can't hold a key: 'bloom',
+        for a single bloom filter, or 'xor', for an xor filter per segment.
+
+        Xor filters are built for the existing segments right away. Switching back
+        to a bloom filter rebuilds it from the segments. Flushes are paused for the
+        whole switch, so that every segment gets a filter of the new type.
+
+        The new filters are complete before the type changes, and readers that
+        checked the old type meanwhile treat the filter it left behind as letting
+        every key through, so no read misses a key on disk.
+        '''
+        if filter_type not in FILTER_TYPES:
+            raise ValueError('Unknown filter type {}, expected one of {}'.format(filter_type, FILTER_TYPES))
+
+        with self.flush_lock:
+            if filter_type == self.filter_type:
+                return
+
+            if filter_type == 'xor':
+                for segment in self.segments:
+                    self.build_segment_filter(segment, self.segment_keys(segment))
+                self.filter_type = filter_type
+                self.bloom_filter = None
+                # A rebuild still running in the background is dropped when it ends
+                self.rebuilding_bloom_filter = None
+            else:
+                self.rebuild_bloom_filter()
+                self.filter_type = filter_type
+                self.segment_filters = {}
+            self.record_setting('filter_type')
+
+    def build_segment_filter(self, segment, keys):
+        ''' (self, str, [str]) -> None
+        Builds the xor filter of segment, which holds keys, and saves it next to
+        the segment.
+        '''
+        xor_filter = XorFilter(keys)
+        xor_filter.save(self.segment_filter_path(segment))
+        self.segment_filters[segment] = xor_filter
+        self.filter_counters.pop(segment, None)
+
+    def segments_that_may_contain(self, key, segments, counted=True):
+        ''' (self, str, [str], Boolean) -> [str]
+        Returns the segments, in order, whose xor filter doesn't rule out key.
+        Segments without a filter may hold any key. The checks are counted in
+        the filter statistics if counted is set.
+        '''
+        segment_filters = self.segment_filters
+        candidates = []
+        for segment in segments:
+            if segment not in segment_filters:
+                candidates.append(segment)
+                continue
+
+            counters = self.filter_counters[segment] if counted else Counter()
+            counters['checks'] += 1
+            if segment_filters[segment].check(key):
+                candidates.append(segment)
+            else:
+                counters['negatives'] += 1
+
+        return candidates
+
+    def bloom_filter_check(self, key, counted=True):
+        ''' (self, str, Boolean) -> Boolean
+        Checks key against the bloom filter, counting the check if counted is set.
+        Every key gets through while there is no bloom filter, as when the filter
+        type was switched to xor since the caller checked it.
+        '''
+        bloom_filter = self.bloom_filter
+        if bloom_filter is None or not self.filters_ready.is_set():
+            return True
+
+        counters = self.filter_counters['bloom'] if counted else Counter()
+        counters['checks'] += 1
+        if bloom_filter.check(key):
+            return True
+
+        counters['negatives'] += 1
+        return False
+
+    def check_many_on_disk(self, keys, segments):
+        ''' (self, [str], [str]) -> [Boolean]
+        Returns, for each key, whether the filters say it may be in one of segments.
+        '''
+        if self.filter_type != 'xor':
+            bloom_filter = self.bloom_filter
+            if bloom_filter is None or not self.filters_ready.is_set():
+                return [True] * len(keys)
+            return bloom_filter.check_many(keys)
+
+        on_disk = [False] * len(keys)
+        segment_filters = self.segment_filters
+        for segment in segments:
+            if segment not in segment_filters:
+                return [True] * len(keys)
+            in_segment = segment_filters[segment].check_many(keys)
+            on_disk = [a or b for a, b in zip(on_disk, in_segment)]
+        return on_disk
+
+    def new_bloom_filter(self):
+        ''' (self) -> BloomFilter
+        Returns an empty bloom filter sized for the current settings.
+        '''
+        return ScalableBloomFilter(self.bf_num_items, self.bf_false_pos_prob)
+
+    def rebuild_bloom_filter_in_background(self):
+        ''' (self) -> Thread
+        Starts rebuilding the bloom filter in a background thread, and returns it.
+        '''
+        thread = threading.Thread(target=self.rebuild_bloom_filter, daemon=True)
+        thread.start()
+        return thread
+
+    def rebuild_bloom_filter(self):
+        ''' (self) -> None
+        Replaces the bloom filter with a new one, built with the current settings
+        from the keys of every segment.
+
+        If the settings change again during the rebuild, the newer rebuild wins.
+        '''
+        bloom_filter = self.new_bloom_filter()
+
+        # Holding the flush lock, no flush is half way through adding its keys to
+        # the filter: earlier flushes are in the version, later ones add to both.
+        with self.flush_lock:
+            self.rebuilding_bloom_filter = bloom_filter
+            version = self.acquire_version()
+
+        try:
+            paths = [self.segment_path(segment) for segment in version.segments]
+            samples = scan_segments(paths, self.sparsity(), with_keys=True, processes=self.scan_processes)
+        finally:
+            self.release_version(version)
+
+        for segment_samples in samples:
+            bloom_filter.add_many(segment_samples.all_keys)
+
+        with self.flush_lock:
+            if self.rebuilding_bloom_filter is bloom_filter:
+                self.bloom_filter = bloom_filter
+                self.rebuilding_bloom_filter = None
+                self.filter_counters.pop('bloom', None)
 
     # Path generators
     def current_segment_path(self):
@@ -412,6 +2279,13 @@ class LSMTree():
         '''
         return self.segments_directory + self.wal_basename
 
+    def immutable_wal_path(self, segment_name):
+        ''' (self, str) -> str
+        Returns the path to the write ahead log of the frozen memtable that
+        will be flushed to segment_name.
+        '''
+        return self.memtable_wal_path() + '.' + segment_name
+
     def segment_path(self, segment_name):
         ''' (self, str) -> str
         Returns the path to the given segment_name.
@@ -420,6 +2294,24 @@ class LSMTree():
 
     def metadata_path(self):
         ''' (self) -> str
-        Returns the path to the metadata backup file.
+        Returns the path to the metadata backup file of DBs saved before the manifest.
         '''
         return self.segments_directory + 'database_metadata'
+
+    def manifest_path(self):
+        ''' (self) -> str
+        Returns the path to the manifest.
+        '''
+        return self.segments_directory + MANIFEST_NAME
+
+    def segment_filter_path(self, segment):
+        ''' (self, str) -> str
+        Returns the path to the xor filter of segment.
+        '''
+        return self.segment_path(segment) + '.xor'
+
+    def bloom_filter_path(self):
+        ''' (self) -> str
+        Returns the path to the bloom filter file.
+        '''
+        return self.segments_directory + 'bloom_filter'
@@ -0,0 +1,138 @@
+from pathlib import Path
+import json
+import logging
+import os
+import threading
+import zlib
+
+
+logger = logging.getLogger(__name__)
+
+# Number of edits appended to a manifest before it is rewritten as a single snapshot
+MANIFEST_CHECKPOINT_INTERVAL = 64
+
+
+class Manifest:
+    def __init__(self, path):
+        ''' (self, str) -> Manifest
+        Opens the manifest at path: a log of the changes made to the set of
+        segments and the settings of a tree, so that the tree can be restored
+        after a crash without rebuilding anything.
+
+        The log starts with a snapshot of the whole state, followed by the edits
+        made since. Each record is a line of JSON preceded by its CRC32, so that
+        a record torn by a crash is detected and ignored.
+        '''
+        self.path = path
+        self.stream = None
+        self.edits = 0
+        self.lock = threading.Lock()
+
+    def exists(self):
+        ''' (self) -> Boolean
+        Returns whether the manifest has been written.
+        '''
+        return Path(self.path).exists()
+
+    def replay(self):
+        ''' (self) -> ([dict], Boolean)
+        Returns the records of the manifest, in order, along with whether the
+        manifest ended with a torn record. A torn record is cut off the end of
+        the manifest, so that later records can be appended after the valid ones.
+        '''
+        records = []
+        valid_size = 0
+        torn = False
+        with open(self.path, 'rb') as s:
+            for line in s:
+                checksum, _, body = line.rstrip(b'\n').partition(b' ')
+                try:
+                    valid = line.endswith(b'\n') and int(checksum, 16) == zlib.crc32(body)
+                except ValueError:
+                    valid = False
+
+                if not valid:
+                    logger.warning('Dropping torn record at the end of %s', self.path)
+                    torn = True
+                    break
+                records.append(json.loads(body))
+                valid_size += len(line)
+
+        if torn:
+            with open(self.path, 'r+b') as s:
+                s.truncate(valid_size)
+                s.flush()
+                os.fsync(s.fileno())
+
+        self.edits = max(len(records) - 1, 0)
+        return records, torn
+
+    def append(self, record):
+        ''' (self, dict) -> None
+        Appends record to the manifest, and waits for it to reach the disk.
+        '''
+        body = json.dumps(record, separators=(',', ':')).encode()
+        with self.lock:
+            if self.stream is None:
+                self.stream = open(self.path, 'ab')
+            self.stream.write(b'%08x %s\n' % (zlib.crc32(body), body))
+            self.stream.flush()
+            os.fsync(self.stream.fileno())
+            self.edits += 1
+
+    def checkpoint(self, snapshot):
+        ''' (self, dict) -> None
+        Replaces the manifest with snapshot, a record of the whole state.
+
+        The snapshot is written to a new file that is renamed over the manifest,
+        so that a crash leaves either the old or the new manifest in place.
+        '''
+        body = json.dumps(snapshot, separators=(',', ':')).encode()
+        temp_path = self.path + '_temp'
+
+        with self.lock:
+            with open(temp_path, 'wb') as s:
+                s.write(b'%08x %s\n' % (zlib.crc32(body), body))
+                s.flush()
+                os.fsync(s.fileno())
+
+            if self.stream is not None:
+                self.stream.close()
+            os.replace(temp_path, self.path)
+            sync_directory(os.path.dirname(self.path) or '.')
+
+            self.stream = open(self.path, 'ab')
+            self.edits = 0
+
+    def close(self):
+        ''' (self) -> None
+        Closes the manifest file, if it was opened for appending.
+        '''
+        with self.lock:
+            if self.stream is not None:
+                self.stream.close()
+                self.stream = None
+
+    def needs_checkpoint(self):
+        ''' (self) -> Boolean
+        Returns whether enough edits were appended to rewrite the manifest.
+        '''
+        return self.edits >= MANIFEST_CHECKPOINT_INTERVAL
+
+
+def sync_directory(path):
+    ''' (str) -> None
+    Makes the renames made in the directory at path durable.
+    '''
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+
+    try:
+        os.fsync(fd)
+    except OSError:
+        # Not every platform can sync a directory
+        pass
+    finally:
+        os.close(fd)
@@ -0,0 +1,87 @@
+from collections import OrderedDict
+from mmh3 import hash64
+import threading
+
+
+# Default number of absent keys remembered
+NEGATIVE_CACHE_SIZE = 10000
+
+# Number of stripes keys are spread over to detect writes racing with reads
+INVALIDATION_STRIPES = 1024
+
+
+class NegativeCache:
+    def __init__(self, max_keys=NEGATIVE_CACHE_SIZE):
+        ''' (self, int) -> NegativeCache
+        Creates a cache of up to max_keys keys that were recently looked for on
+        disk and not found, dropping the least recently used keys first.
+        '''
+        self.max_keys = max_keys
+        self.keys = OrderedDict()
+        self.stamps = [0] * INVALIDATION_STRIPES
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.additions = 0
+
+    def contains(self, key):
+        ''' (self, str) -> Boolean
+        Returns whether key is known to be absent from disk.
+        '''
+        with self.lock:
+            if key not in self.keys:
+                return False
+
+            self.keys.move_to_end(key)
+            self.hits += 1
+            return True
+
+    def stamp(self, key):
+        ''' (self, str) -> int
+        Returns a stamp that changes whenever key is invalidated. Read it before
+        looking the key up, and pass it to add if the key isn't found.
+        '''
+        return self.stamps[hash64(key, signed=False)[0] % INVALIDATION_STRIPES]
+
+    def add(self, key, stamp):
+        ''' (self, str, int) -> None
+        Records that key is absent from disk, unless it was invalidated since
+        stamp was read.
+        '''
+        with self.lock:
+            if self.stamp(key) != stamp:
+                return
+
+            self.keys[key] = None
+            self.keys.move_to_end(key)
+            self.additions += 1
+            while len(self.keys) > self.max_keys:
+                self.keys.popitem(last=False)
+
+    def invalidate(self, key):
+        ''' (self, str) -> None
+        Forgets that key is absent, as it has just been written.
+        '''
+        with self.lock:
+            self.stamps[hash64(key, signed=False)[0] % INVALIDATION_STRIPES] += 1
+            self.keys.pop(key, None)
+
+    def set_max_keys(self, max_keys):
+        ''' (self, int) -> None
+        Sets the number of absent keys remembered. 0 turns the cache off.
+        '''
+        with self.lock:
+            self.max_keys = max_keys
+            while len(self.keys) > max_keys:
+                self.keys.popitem(last=False)
+
+    def stats(self):
+        ''' (self) -> dict
+        Returns the hit count of the cache along with its occupancy.
+        '''
+        return {
+            'hits': self.hits,
+            'additions': self.additions,
+            'keys': len(self.keys),
+            'max_keys': self.max_keys,
+        }
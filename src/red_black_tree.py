@@ -10,11 +10,16 @@ RED = 'RED'
 NIL = 'NIL'
 
 class Node:
-    def __init__(self, key, color, parent, left=None, right=None, value=None, offset=None, segment=None):
+    def __init__(self, key, color, parent, left=None, right=None, value=None, offset=None, segment=None,
+                 sequence=None):
         self.key = key
         self.value = value
         self.offset = offset
         self.segment = segment
+        # The sequence number of the write that set value, and the older values
+        # kept for snapshots as (sequence, value), oldest first
+        self.sequence = sequence
+        self.history = None
         self.color = color
         self.parent = parent
         self.left = left
@@ -89,7 +94,7 @@ class RedBlackTree:
             return list()
         yield from self.root.__iter__()
 
-    def add(self, key, value=None, offset=None, segment=None):
+    def add(self, key, value=None, offset=None, segment=None, sequence=None):
         # add the node
         if not self.root:
             self.root = Node(
@@ -100,13 +105,15 @@ class RedBlackTree:
                 right=self.NIL_LEAF,
                 value=value,
                 offset=offset,
-                segment=segment
+                segment=segment,
+                sequence=sequence
                 )
             self.count += 1
             return
         parent, node_dir = self._find_parent(key)
         if node_dir is None:
             parent.value = value
+            parent.sequence = sequence
             return  # key is in the tree
 
         new_node = Node(
@@ -117,7 +124,8 @@ class RedBlackTree:
             right=self.NIL_LEAF, 
             value=value, 
             offset=offset, 
-            segment=segment)
+            segment=segment,
+            sequence=sequence)
 
         if node_dir == 'L':
             parent.left = new_node
@@ -127,6 +135,36 @@ class RedBlackTree:
         self._try_rebalance(new_node)
         self.count += 1
 
+    @classmethod
+    def from_sorted(cls, items):
+        ''' ([(str, str)]) -> RedBlackTree
+        Builds a tree from key value pairs sorted by key, without duplicate keys,
+        in linear time.
+
+        The tree is balanced by splitting items at their middle. Every level but the
+        deepest is then full, so the deepest nodes are colored red when that level
+        is only partly filled, and every other node black.
+        '''
+        tree = cls()
+        count = len(items)
+        red_depth = count.bit_length() - 1 if count & (count + 1) else None
+
+        def build(low, high, parent, depth):
+            if low >= high:
+                return cls.NIL_LEAF
+
+            middle = (low + high) // 2
+            key, value = items[middle]
+            node = Node(key, color=RED if depth == red_depth else BLACK, parent=parent, value=value)
+            node.left = build(low, middle, node, depth + 1)
+            node.right = build(middle + 1, high, node, depth + 1)
+            return node
+
+        if count:
+            tree.root = build(0, count, None, 0)
+        tree.count = count
+        return tree
+
     def remove(self, key):
         """
         Try to get a node with 0 or 1 children.
@@ -0,0 +1,252 @@
+from collections import deque
+from contextlib import ExitStack
+from itertools import islice
+import logging
+import socket
+import threading
+import time
+import uuid
+from expiry import split_expiry
+
+
+logger = logging.getLogger(__name__)
+
+# Number of recent records a leader keeps for followers that fall behind. A follower
+# that falls further behind than this is re-synchronised from a snapshot.
+REPLICATION_BUFFER_SIZE = 100000
+
+# Seconds between heartbeats sent to followers while no writes happen
+HEARTBEAT_INTERVAL = 1.0
+
+# Seconds a follower waits before reconnecting to its leader
+RECONNECT_INTERVAL = 1.0
+
+
+class ReplicationLog:
+    def __init__(self, trees, buffer_size=REPLICATION_BUFFER_SIZE):
+        ''' (self, [LSMTree], int) -> ReplicationLog
+        Numbers every record written to the write ahead logs of trees and keeps the
+        most recent buffer_size of them, so they can be shipped to followers.
+
+        Each log gets a new random id, so followers can tell when the numbering
+        they have applied belongs to a previous run of the leader.
+        '''
+        self.trees = trees
+        self.log_id = uuid.uuid4().hex
+        self.position = 0
+        self.records = deque(maxlen=buffer_size)
+        self.followers = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+        for tree in trees:
+            tree.memtable_wal().subscribe(self.append)
+
+    def append(self, key, value):
+        ''' (self, str, str) -> None
+        Records the write of value to key as the next position in the log.
+        '''
+        with self.condition:
+            self.position += 1
+            self.records.append((self.position, '{},{}'.format(key, value)))
+            self.condition.notify_all()
+
+    def close(self):
+        ''' (self) -> None
+        Stops recording the writes to the write ahead logs and ends the streams to followers.
+        '''
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.condition.notify_all()
+
+        for tree in self.trees:
+            tree.memtable_wal().unsubscribe(self.append)
+
+    def records_after(self, position, timeout=HEARTBEAT_INTERVAL):
+        ''' (self, int, float) -> [(int, str)]
+        Returns the records after position, waiting up to timeout seconds for one
+        to be written. Returns None if the records have been dropped from the buffer.
+        '''
+        with self.condition:
+            self.condition.wait_for(lambda: self.position > position or self.closed, timeout)
+            if self.position == position:
+                return []
+
+            first = self.records[0][0] if self.records else self.position + 1
+            if first > position + 1:
+                return None
+
+            return list(islice(self.records, position + 1 - first, None))
+
+    def stream(self, wfile, log_id, position, scan):
+        ''' (self, file, str, int, function) -> None
+        Ships the log to a follower through wfile, until the follower disconnects.
+
+        A follower that has applied the log of this leader up to position resumes from
+        there. Any other follower is first sent a snapshot of the DB, read from scan.
+        '''
+        with self.condition:
+            self.followers += 1
+            resumable = log_id == self.log_id and self.records_after(position, 0) is not None
+
+        try:
+            if not resumable:
+                position = self.snapshot_position()
+                wfile.write('snapshot {} {}\n'.format(self.log_id, position).encode())
+
+                # Writes made during the scan are shipped again afterwards, in order
+                for key, value in scan():
+                    wfile.write('row {},{}\n'.format(key, value).encode())
+
+            wfile.write('tail {} {}\n'.format(self.log_id, position).encode())
+
+            while not self.closed:
+                records = self.records_after(position)
+                if records is None:
+                    logger.info('Follower fell behind the replication buffer')
+                    return
+
+                if records:
+                    lines = ['record {} {}\n'.format(*record) for record in records]
+                    position = records[-1][0]
+                else:
+                    lines = ['heartbeat {}\n'.format(self.position)]
+                wfile.write(''.join(lines).encode())
+        except (BrokenPipeError, ConnectionResetError):
+            return
+        finally:
+            with self.condition:
+                self.followers -= 1
+
+    def snapshot_position(self):
+        ''' (self) -> int
+        Returns the position of the last record that is visible to a scan started now.
+
+        Records reach the log before the memtable, so the position is read while
+        holding the write locks of every tree, once no write is half done.
+        '''
+        with ExitStack() as stack:
+            for tree in self.trees:
+                stack.enter_context(tree.write_lock)
+            return self.position
+
+    def status(self):
+        ''' (self) -> str
+        Describes the replication state of the leader.
+        '''
+        return 'role=leader log={} position={} followers={}'.format(
+            self.log_id, self.position, self.followers)
+
+
+class Follower:
+    def __init__(self, engine, leader):
+        ''' (self, LSMTree, str) -> Follower
+        Creates a follower that keeps engine up to date with the leader at "host:port".
+        '''
+        self.engine = engine
+        self.leader = leader
+        self.running = False
+        self.connection = None
+
+        self.log_id = None
+        self.applied = 0
+        self.leader_position = 0
+        self.syncing = False
+        self.last_contact = None
+
+    def start(self):
+        ''' (self) -> None
+        Starts following the leader in the background.
+        '''
+        self.running = True
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def stop(self):
+        ''' (self) -> None
+        Stops following the leader.
+        '''
+        self.running = False
+        if self.connection:
+            try:
+                self.connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def run(self):
+        ''' (self) -> None
+        Applies the leader's log, reconnecting whenever the connection drops.
+        '''
+        host, port = self.leader.rsplit(':', 1)
+        while self.running:
+            try:
+                with socket.create_connection((host, int(port))) as connection:
+                    self.connection = connection
+                    connection.sendall('REPLICATE {} {}\n'.format(
+                        self.log_id or '-', self.applied).encode())
+
+                    with connection.makefile('r') as stream:
+                        for line in stream:
+                            if not self.running:
+                                return
+                            self.apply(line)
+            except OSError as e:
+                logger.info('Lost connection to leader %s: %s', self.leader, e)
+            finally:
+                self.connection = None
+
+            if self.running:
+                time.sleep(RECONNECT_INTERVAL)
+
+    def apply(self, line):
+        ''' (self, str) -> None
+        Applies one line of the leader's replication stream.
+        '''
+        kind, _, rest = line.rstrip('\n').partition(' ')
+        self.last_contact = time.time()
+
+        if kind == 'record':
+            position, entry = rest.split(' ', 1)
+            key, value = entry.split(',', 1)
+            self.set_stored(key, value)
+            self.applied = int(position)
+            self.leader_position = max(self.leader_position, self.applied)
+        elif kind == 'heartbeat':
+            self.leader_position = int(rest)
+        elif kind == 'row':
+            key, value = rest.split(',', 1)
+            self.set_stored(key, value)
+        elif kind == 'snapshot':
+            self.log_id, position = rest.split(' ')
+            self.leader_position = int(position)
+            self.syncing = True
+        elif kind == 'tail':
+            self.log_id, position = rest.split(' ')
+            self.applied = int(position)
+            self.leader_position = max(self.leader_position, self.applied)
+            self.syncing = False
+
+    def set_stored(self, key, value):
+        ''' (self, str, str) -> None
+        Writes value, as stored by the leader, to key.
+        '''
+        value, expires_at = split_expiry(value)
+        self.engine.db_set(key, value, expires_at=expires_at)
+
+    def lag(self):
+        ''' (self) -> int
+        Returns the number of records the follower is known to be behind its leader.
+        '''
+        return self.leader_position - self.applied
+
+    def status(self):
+        ''' (self) -> str
+        Describes the replication state of the follower.
+        '''
+        since_contact = 'never' if self.last_contact is None else \
+            '{:.2f}s'.format(time.time() - self.last_contact)
+
+        return 'role=follower leader={} log={} applied={} leader_position={} lag={} syncing={} last_contact={}'.format(
+            self.leader, self.log_id, self.applied, self.leader_position,
+            self.lag(), self.syncing, since_contact)
@@ -0,0 +1,182 @@
+from collections import OrderedDict
+from mmh3 import hash64
+import numpy as np
+import threading
+
+
+# Approximate memory taken by a cached row on top of its key and value, in bytes
+ROW_OVERHEAD = 64
+
+# Number of counters rows of the frequency sketch, and the largest count they hold
+SKETCH_DEPTH = 4
+SKETCH_MAX_COUNT = 15
+
+# Number of stripes keys are spread over to detect writes racing with reads
+INVALIDATION_STRIPES = 1024
+
+# Returned by RowCache.get for keys that aren't cached. Keys cached as absent
+# from the DB are returned as None.
+MISSING = object()
+
+
+class FrequencySketch:
+    def __init__(self, width):
+        ''' (self, int) -> FrequencySketch
+        Creates a count-min sketch that estimates how often keys were seen recently,
+        with SKETCH_DEPTH rows of width small counters.
+
+        Once 10 times width keys have been recorded, every counter is halved, so
+        that the estimates favour recent accesses.
+        '''
+        self.width = max(1 << (width - 1).bit_length(), 16)
+        self.counters = bytearray(SKETCH_DEPTH * self.width)
+        self.additions = 0
+        self.sample_size = 10 * self.width
+
+    def increment(self, key):
+        ''' (self, str) -> None
+        Records an access to key.
+        '''
+        counters = self.counters
+        for slot in self.slots(key):
+            if counters[slot] < SKETCH_MAX_COUNT:
+                counters[slot] += 1
+
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            self.age()
+
+    def estimate(self, key):
+        ''' (self, str) -> int
+        Returns the estimated number of recent accesses to key.
+        '''
+        counters = self.counters
+        return min(counters[slot] for slot in self.slots(key))
+
+    def age(self):
+        ''' (self) -> None
+        Halves every counter.
+        '''
+        np.frombuffer(self.counters, dtype=np.uint8)[:] >>= 1
+        self.additions //= 2
+
+    def slots(self, key):
+        ''' (self, str) -> [int]
+        Returns the counter of key in each row of the sketch.
+        '''
+        h1, h2 = hash64(key, signed=False)
+        mask = self.width - 1
+        return [row * self.width + ((h1 + row * h2) & mask) for row in range(SKETCH_DEPTH)]
+
+
+class RowCache:
+    def __init__(self, capacity=0):
+        ''' (self, int) -> RowCache
+        Creates a cache of the values of recently read keys, including keys that
+        were found to be absent, holding up to capacity bytes. A capacity of 0
+        turns the cache off.
+
+        Rows are evicted least recently used first, but a new row only takes the
+        place of the row that would be evicted if its key has been read more
+        often recently (TinyLFU admission), so that keys read once don't push
+        out the hot ones.
+        '''
+        self.capacity = capacity
+        self.rows = OrderedDict()
+        self.size = 0
+        self.sketch = FrequencySketch(capacity // ROW_OVERHEAD)
+        self.stamps = [0] * INVALIDATION_STRIPES
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.rejections = 0
+        self.evictions = 0
+
+    def get(self, key):
+        ''' (self, str) -> str
+        Returns the cached value of key, None if key is cached as absent, or
+        MISSING if it isn't cached.
+        '''
+        with self.lock:
+            self.sketch.increment(key)
+            row = self.rows.get(key)
+            if row is None:
+                self.misses += 1
+                return MISSING
+
+            self.rows.move_to_end(key)
+            self.hits += 1
+            return row[0]
+
+    def stamp(self, key):
+        ''' (self, str) -> int
+        Returns a stamp that changes whenever key is invalidated. Read it before
+        looking the key up in the DB, and pass it to put along with the result.
+        '''
+        return self.stamps[hash64(key, signed=False)[0] % INVALIDATION_STRIPES]
+
+    def put(self, key, value, stamp):
+        ''' (self, str, str, int) -> None
+        Caches value, or None for an absent key, as the value of key, unless key
+        was invalidated since stamp was read or loses out on admission.
+        '''
+        size = len(key) + len(value or '') + ROW_OVERHEAD
+        if size > self.capacity:
+            return
+
+        with self.lock:
+            if key in self.rows or self.stamp(key) != stamp:
+                return
+
+            frequency = self.sketch.estimate(key)
+            while self.size + size > self.capacity:
+                victim = next(iter(self.rows))
+                if frequency <= self.sketch.estimate(victim):
+                    self.rejections += 1
+                    return
+
+                self.size -= self.rows.pop(victim)[1]
+                self.evictions += 1
+
+            self.rows[key] = (value, size)
+            self.size += size
+
+    def invalidate(self, key):
+        ''' (self, str) -> None
+        Drops the cached value of key, which has just been written.
+        '''
+        with self.lock:
+            self.stamps[hash64(key, signed=False)[0] % INVALIDATION_STRIPES] += 1
+            row = self.rows.pop(key, None)
+            if row is not None:
+                self.size -= row[1]
+
+    def set_capacity(self, capacity):
+        ''' (self, int) -> None
+        Sets the memory budget of the cache, in bytes, evicting rows as needed.
+        '''
+        with self.lock:
+            if capacity // ROW_OVERHEAD > self.sketch.width:
+                self.sketch = FrequencySketch(capacity // ROW_OVERHEAD)
+
+            self.capacity = capacity
+            while self.size > capacity:
+                self.size -= self.rows.popitem(last=False)[1][1]
+                self.evictions += 1
+
+    def stats(self):
+        ''' (self) -> dict
+        Returns the hit and miss counts of the cache along with its occupancy.
+        '''
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 6) if lookups else 0.0,
+            'rejections': self.rejections,
+            'evictions': self.evictions,
+            'rows': len(self.rows),
+            'bytes': self.size,
+            'capacity': self.capacity,
+        }
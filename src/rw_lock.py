@@ -0,0 +1,52 @@
+import threading
+from contextlib import contextmanager
+
+
+class RWLock:
+    def __init__(self):
+        ''' (self) -> RWLock
+        Creates a new readers-writer lock. Any number of readers may hold the
+        lock at the same time, while a writer holds it exclusively.
+
+        Note: waiting writers block new readers, so a steady stream of reads
+        cannot starve a writer.
+        '''
+        self.condition = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer = False
+        self.writers_waiting = 0
+
+    @contextmanager
+    def read(self):
+        ''' (self) -> None
+        Holds the lock in shared mode for the duration of the with block.
+        '''
+        with self.condition:
+            while self.writer or self.writers_waiting:
+                self.condition.wait()
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.readers -= 1
+                if not self.readers:
+                    self.condition.notify_all()
+
+    @contextmanager
+    def write(self):
+        ''' (self) -> None
+        Holds the lock in exclusive mode for the duration of the with block.
+        '''
+        with self.condition:
+            self.writers_waiting += 1
+            while self.writer or self.readers:
+                self.condition.wait()
+            self.writers_waiting -= 1
+            self.writer = True
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.writer = False
+                self.condition.notify_all()
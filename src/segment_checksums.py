@@ -0,0 +1,118 @@
+from array import array
+from pathlib import Path
+import mmap
+import os
+import struct
+import zlib
+
+from block_cache import BLOCK_SIZE, block_bounds
+
+
+# The checksums of a segment are kept next to it, in a file with this suffix
+CHECKSUMS_SUFFIX = '.crc'
+
+# Checksum files start with a header: magic bytes, a version, and the size of
+# the segment the checksums were computed from
+CHECKSUMS_FILE_MAGIC = b'SCRC'
+CHECKSUMS_FILE_VERSION = 1
+CHECKSUMS_FILE_HEADER = struct.Struct('<4sIQ')
+
+
+class CorruptSegmentError(Exception):
+    pass
+
+
+def checksums_path(path):
+    ''' (str) -> str
+    Returns the path to the checksums of the segment at path.
+    '''
+    return path + CHECKSUMS_SUFFIX
+
+
+def block_checksums(data):
+    ''' (bytes) -> array
+    Returns the CRC32 of the records of each block of data, a segment's contents.
+    '''
+    checksums = array('I')
+    for number in range(-(-len(data) // BLOCK_SIZE)):
+        first, stop = block_bounds(data, number)
+        checksums.append(zlib.crc32(data[first:stop]))
+    return checksums
+
+
+def write_checksums(path):
+    ''' (str) -> None
+    Computes the checksums of the blocks of the segment at path, which has just
+    been written, and saves them next to it.
+    '''
+    with open(path, 'rb') as s:
+        try:
+            data = mmap.mmap(s.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files can't be mapped
+            data = b''
+
+    try:
+        checksums = block_checksums(data)
+        size = len(data)
+    finally:
+        if isinstance(data, mmap.mmap):
+            data.close()
+
+    header = CHECKSUMS_FILE_HEADER.pack(CHECKSUMS_FILE_MAGIC, CHECKSUMS_FILE_VERSION, size)
+    temp_path = checksums_path(path) + '_temp'
+    with open(temp_path, 'wb') as s:
+        s.write(header)
+        s.write(checksums.tobytes())
+    os.replace(temp_path, checksums_path(path))
+
+
+def load_checksums(path, size):
+    ''' (str, int) -> array
+    Returns the checksums saved for the segment at path, or None if there are
+    none or they were computed for a file of another size than size, such as
+    an older version of the segment left in place by a crash.
+    '''
+    saved = read_checksums_file(path)
+    if saved is None or saved[0] != size:
+        return None
+    return saved[1]
+
+
+def checksummed_size(path):
+    ''' (str) -> int
+    Returns the size of the segment at path when its checksums were computed,
+    or None if it has no checksums.
+    '''
+    saved = read_checksums_file(path)
+    return None if saved is None else saved[0]
+
+
+def read_checksums_file(path):
+    ''' (str) -> (int, array)
+    Returns the segment size and the checksums saved for the segment at path,
+    or None if there are none.
+    '''
+    try:
+        with open(checksums_path(path), 'rb') as s:
+            contents = s.read()
+    except FileNotFoundError:
+        return None
+
+    if len(contents) < CHECKSUMS_FILE_HEADER.size:
+        return None
+    magic, version, segment_size = CHECKSUMS_FILE_HEADER.unpack_from(contents)
+    if magic != CHECKSUMS_FILE_MAGIC or version != CHECKSUMS_FILE_VERSION:
+        return None
+
+    checksums = array('I')
+    checksums.frombytes(contents[CHECKSUMS_FILE_HEADER.size:])
+    return segment_size, checksums
+
+
+def remove_checksums(path):
+    ''' (str) -> None
+    Deletes the checksums of the segment at path, if it has any.
+    '''
+    if Path(checksums_path(path)).exists():
+        os.remove(checksums_path(path))
@@ -0,0 +1,100 @@
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+import mmap
+import multiprocessing
+import os
+
+
+# Default number of processes segments are scanned with
+SCAN_PROCESSES = os.cpu_count() or 1
+
+
+class SegmentSamples:
+    def __init__(self, keys, values, offsets, all_keys=None):
+        ''' (self, [str], [str], array, [str]) -> SegmentSamples
+        Holds the records sampled from a segment for its sparse index: their keys,
+        values, and offsets in the segment, along with every key of the segment
+        if they were asked for.
+        '''
+        self.keys = keys
+        self.values = values
+        self.offsets = offsets
+        self.all_keys = all_keys
+
+    def __iter__(self):
+        return zip(self.keys, self.values, self.offsets)
+
+    def __reduce__(self):
+        # Keys and values travel back from worker processes as single strings,
+        # which pickle much faster than lists of small strings
+        return (unpack_samples, (
+            '\n'.join(self.keys), '\n'.join(self.values), self.offsets,
+            None if self.all_keys is None else '\n'.join(self.all_keys), len(self.keys)))
+
+
+def unpack_samples(keys, values, offsets, all_keys, count):
+    ''' (str, str, array, str, int) -> SegmentSamples
+    Rebuilds samples packed by SegmentSamples.__reduce__.
+    '''
+    if count == 0:
+        keys, values = [], []
+    else:
+        keys, values = keys.split('\n'), values.split('\n')
+
+    if all_keys is not None:
+        all_keys = all_keys.split('\n') if all_keys else []
+
+    return SegmentSamples(keys, values, offsets, all_keys)
+
+
+def scan_segment(path, sparsity, with_keys=False):
+    ''' (str, int, Boolean) -> SegmentSamples
+    Reads the segment at path, sampling every sparsity-th record for the sparse
+    index the way flushes do, starting with record number sparsity. Every key
+    of the segment is returned as well if with_keys is set.
+    '''
+    keys, values, offsets = [], [], array('q')
+    all_keys = [] if with_keys else None
+
+    with open(path, 'rb') as s:
+        try:
+            data = mmap.mmap(s.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files can't be mapped
+            return SegmentSamples(keys, values, offsets, all_keys)
+
+    with data:
+        offset = 0
+        counter = sparsity
+        for line in iter(data.readline, b''):
+            if counter == 1 or with_keys:
+                key, _, value = line.decode().strip().partition(',')
+                if with_keys:
+                    all_keys.append(key)
+                if counter == 1:
+                    keys.append(key)
+                    values.append(value)
+                    offsets.append(offset)
+                    counter = sparsity + 1
+
+            offset += len(line)
+            counter -= 1
+
+    return SegmentSamples(keys, values, offsets, all_keys)
+
+
+def scan_segments(paths, sparsity, with_keys=False, processes=SCAN_PROCESSES):
+    ''' ([str], int, Boolean, int) -> [SegmentSamples]
+    Scans the segments at paths with scan_segment, spread over up to processes
+    worker processes, and returns their samples in the order of paths.
+    '''
+    processes = min(processes, len(paths))
+    if processes <= 1:
+        return [scan_segment(path, sparsity, with_keys) for path in paths]
+
+    # Trees run several threads, which forked processes would inherit the
+    # locks of, so workers are spawned
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=processes, mp_context=context) as executor:
+        return list(executor.map(
+            scan_segment, paths, [sparsity] * len(paths), [with_keys] * len(paths)))
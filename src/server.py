@@ -1,12 +1,25 @@
 import socketserver
 import os, sys
+from functools import partial
+from multiprocessing.connection import Listener
+from pathlib import Path
 
-from lsm_tree import LSMTree
+from checkpoint import restore_checkpoint
+from lsm_tree import CHECKSUM_VERIFICATION_MODES, LSMTree
+from replication import Follower, ReplicationLog
+from sharded_lsm_tree import ShardedLSMTree
+from workers import WorkerEngine
 import click
 
 file_directory = sys.path[0]
 path = file_directory + '/segments/'
-engine = LSMTree('test_file-1', path, 'bkup')
+
+# Created by start_server, so that forked workers don't share a memtable
+engine = None
+
+# Only set up when running as a single process
+replication_log = None
+follower = None
 
 def get_folder_size(folder_path, exclude):
     total_size = 0
@@ -38,6 +51,13 @@ def get_folder_size(folder_path, exclude):
 
 
 class MyTCPRequestHandler(socketserver.StreamRequestHandler):
+    def reply(self, message):
+        '''
+        Sends a single line reply. Replies end with a newline, so that clients
+        can tell where each one stops.
+        '''
+        self.wfile.write(f"{message}\n".encode())
+
     def handle(self):
         while True:
             # print("Recieved one request from {}".format(self.client_address[0]))
@@ -48,58 +68,248 @@ class MyTCPRequestHandler(socketserver.StreamRequestHandler):
             command, *args = msg.split(" ")
             if command.lower() == "diskusage":
                 size = get_folder_size(engine.segments_directory, engine.wal_basename)
-                self.wfile.write(size.encode())
+                self.reply(size)
             elif command.lower() == "getall":
                 result = []
-                for arg in args:
-                    value = engine.db_get(arg)
+                for value in engine.db_get_many(args):
                     if value is not None:
-                        result.append(value.encode())
+                        result.append(value)
                     else:
-                        result.append("null".encode())
-                self.wfile.write("^".join(result.encode()))
+                        result.append("null")
+                self.reply("^".join(result))
             elif command.lower() == "get":
                 value = engine.db_get(args[0])
                 if value is not None:
-                    self.wfile.write(value.encode())
+                    self.reply(value)
                 else:
-                    self.wfile.write(f"ERROR: Key {args[0]} does not exist!".encode())
+                    self.reply(f"ERROR: Key {args[0]} does not exist!")
             elif command.lower() == "set":
-                key, value = args
-                engine.db_set(key, value)
-                self.wfile.write(f"Wrote {key}={value}".encode())
+                if follower and follower.running:
+                    self.reply(f"ERROR: Read-only follower of {follower.leader}")
+                    continue
+                # SET key value, or SET key value EX seconds to have the pair expire,
+                # or SET key value PXAT milliseconds to have it expire at a given time
+                ttl = expires_at = None
+                if len(args) == 4 and args[2].lower() in ("ex", "pxat"):
+                    try:
+                        if args[2].lower() == "ex":
+                            ttl = int(args[3])
+                            if ttl <= 0:
+                                raise ValueError
+                        else:
+                            expires_at = int(args[3])
+                            if expires_at < 0:
+                                raise ValueError
+                    except ValueError:
+                        self.reply(f"ERROR: Invalid expire time {args[3]}")
+                        continue
+                elif len(args) != 2:
+                    self.reply("ERROR: Expected SET key value [EX seconds | PXAT milliseconds]")
+                    continue
+                key, value = args[:2]
+                try:
+                    engine.db_set(key, value, ttl, expires_at)
+                except Exception as e:
+                    # Records the segments can't hold, such as keys with commas
+                    self.reply(f"ERROR: {str(e)}")
+                    continue
+                self.reply(f"Wrote {key}={value}")
+            elif command.lower() == "scan":
+                # Streams one key,value line per record, ending with an empty line.
+                # SCAN start end EXPIRY sends values as stored, with their expiry time.
+                with_expiry = len(args) == 3 and args[2].lower() == "expiry"
+                bounds = [arg or None for arg in args[:2]]
+                for key, value in engine.scan(*bounds, with_expiry=with_expiry):
+                    self.wfile.write(f"{key},{value}\n".encode())
+                self.wfile.write(b"\n")
+            elif command.lower() == "stats":
+                # Streams one name=value line per statistic, ending with an empty line.
+                # STATS SPACE measures space amplification too, which reads every record.
+                measure_space = [arg.lower() for arg in args] == ["space"]
+                for name, value in sorted(engine.stats(measure_space).items()):
+                    self.wfile.write(f"{name}={value}\n".encode())
+                self.wfile.write(b"\n")
+            elif command.lower() == "verify":
+                # Streams one name=value line per result, ending with an empty line
+                try:
+                    report = engine.verify()
+                except Exception as e:
+                    self.wfile.write(f"ERROR: {str(e)}\n".encode())
+                    continue
+                for name, value in sorted(report.items()):
+                    self.wfile.write(f"{name}={value}\n".encode())
+                self.wfile.write(b"\n")
+            elif command.lower() == "checkpoint":
+                # Streams one name=value line per result, ending with an empty line
+                try:
+                    report = engine.checkpoint(args[0])
+                except Exception as e:
+                    self.wfile.write(f"ERROR: {str(e)}\n".encode())
+                    continue
+                for name, value in sorted(report.items()):
+                    self.wfile.write(f"{name}={value}\n".encode())
+                self.wfile.write(b"\n")
+            elif command.lower() == "replicate":
+                if replication_log is None:
+                    self.reply("ERROR: Replication needs a single worker")
+                    continue
+                # Streams the log to the follower until it disconnects
+                log_id, position = args
+                # Followers are sent values along with their expiry times
+                replication_log.stream(self.wfile, log_id, int(position), partial(engine.scan, with_expiry=True))
+                break
+            elif command.lower() == "status":
+                if follower and follower.running:
+                    self.reply(follower.status())
+                elif replication_log:
+                    self.reply(replication_log.status())
+                else:
+                    self.reply("ERROR: Replication needs a single worker")
+            elif command.lower() == "promote":
+                if follower and follower.running:
+                    follower.stop()
+                    self.reply(f"Promoted to leader at position {follower.applied}")
+                else:
+                    self.reply("Already a leader")
             elif command.lower() == "ping":
-                self.wfile.write("Pong!".encode())
+                self.reply("Pong!")
             elif command.lower() == "flush":
                 try:
-                    engine.flush_memtable_to_disk(engine.current_segment_path())
-                    self.wfile.write("Done flushing".encode())
+                    engine.flush()
+                    self.reply("Done flushing")
                 except Exception as e:
-                    self.wfile.write(f"Error while flushing {str(e)}".encode())
+                    self.reply(f"Error while flushing {str(e)}")
             elif command.lower() == "compact":
                 try:
                     engine.compact()
-                    self.wfile.write("Done compacting".encode())
+                    self.reply("Done compacting")
                 except Exception as e:
-                    self.wfile.write(f"Error while compacting {str(e)}".encode())
+                    self.reply(f"Error while compacting {str(e)}")
             else:
-                self.wfile.write(f"Unknown command".encode())
+                self.reply("Unknown command")
+
+
+def open_engine(segments_directory: str, memtable_threshold: int, shards: int, row_cache_size: int,
+                checksum_verification: str = 'always', value_log_threshold: int = 0):
+    '''
+    Opens the DB stored in segments_directory, split into the given number of shards,
+    with a row cache of row_cache_size bytes, checking blocks read from disk against
+    their checksums as often as checksum_verification says, and moving values of at
+    least value_log_threshold bytes to the value log when that is above 0.
+    '''
+    if shards > 1:
+        db = ShardedLSMTree('test_file-1', segments_directory, 'bkup', shards)
+    else:
+        db = LSMTree('test_file-1', segments_directory, 'bkup')
+    db.set_threshold(memtable_threshold)
+    db.set_row_cache_capacity(row_cache_size)
+    db.set_checksum_verification(checksum_verification)
+    if value_log_threshold:
+        db.set_value_separation_threshold(value_log_threshold)
+    return db
+
+
+def start_workers(address: str, port: int, segments_directory: str, memtable_threshold: int,
+                  workers: int, shards: int, row_cache_size: int, checksum_verification: str = 'always',
+                  value_log_threshold: int = 0):
+    '''
+    Pre-forks workers that accept connections on a shared listening socket. Each
+    worker owns the keys that hash to it, keeping them in its own LSMTree under
+    segments_directory/worker-{id}/, and forwards requests for other keys to their owner.
+    '''
+    global engine
+    Path(segments_directory).mkdir(exist_ok=True)
+    authkey = os.urandom(16)
+    listeners = [Listener(family='AF_UNIX', authkey=authkey) for _ in range(workers)]
+    addresses = [listener.address for listener in listeners]
+    db_server = socketserver.ThreadingTCPServer((address, port), MyTCPRequestHandler)
+
+    pids = []
+    for worker_id in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            worker_db = open_engine(
+                segments_directory + f'worker-{worker_id}/', memtable_threshold, shards, row_cache_size,
+                checksum_verification, value_log_threshold)
+            engine = WorkerEngine(
+                worker_id, worker_db, listeners[worker_id], addresses, authkey, segments_directory)
+            engine.serve()
+            try:
+                db_server.serve_forever()
+            except KeyboardInterrupt:
+                worker_db.flush()
+                worker_db.save_metadata()
+                worker_db.close()
+            os._exit(0)
+
+        pids.append(pid)
+
+    print(f"Starting DB Server with {workers} workers")
+    try:
+        for pid in pids:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        # The workers receive the interrupt too and back up their own metadata
+        print("Backing up metadata...")
+        for pid in pids:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
 
 
 @click.option("--address", "-a", default="127.0.0.1")
 @click.option("--port", "-p", default=8080)
+@click.option("--segments-directory", "-d", default=path)
 @click.option("--memtable-threshold", "-t", default=3000)
+@click.option("--workers", "-w", default=1)
+@click.option("--shards", "-s", default=1)
+@click.option("--replicate-from", "-r", default=None, help="Follow the leader at host:port")
+@click.option("--row-cache-size", default=0, help="Bytes of hot rows to cache in memory, 0 for none")
+@click.option("--checksum-verification", default="always", type=click.Choice(CHECKSUM_VERIFICATION_MODES),
+              help="How often blocks read from disk are checked against their checksums")
+@click.option("--restore-from", default=None,
+              help="Restore the checkpoint in this directory into an empty segments directory first")
+@click.option("--value-log-threshold", default=0,
+              help="Bytes from which values are moved out of segments into the value log, 0 for never")
 @click.command()
-def start_server(address: str, port: int, memtable_threshold):
-    engine.set_threshold(memtable_threshold)
+def start_server(address: str, port: int, segments_directory, memtable_threshold, workers, shards,
+                 replicate_from, row_cache_size, checksum_verification, restore_from, value_log_threshold):
+    global engine, replication_log, follower
+    if restore_from:
+        try:
+            files = restore_checkpoint(restore_from, segments_directory)
+        except ValueError as e:
+            raise click.UsageError(f"Can't restore {restore_from}: {str(e)}")
+        print(f"Restored {files} files from {restore_from}")
+    if workers > 1:
+        if replicate_from:
+            raise click.UsageError("--replicate-from needs a single worker")
+        start_workers(address, port, segments_directory, memtable_threshold, workers, shards,
+                      row_cache_size, checksum_verification, value_log_threshold)
+        return
+
+    engine = open_engine(segments_directory, memtable_threshold, shards, row_cache_size,
+                         checksum_verification, value_log_threshold)
+
+    # Followers keep a log too, so that they can take over once promoted
+    replication_log = ReplicationLog(getattr(engine, 'shards', [engine]))
+    if replicate_from:
+        follower = Follower(engine, replicate_from)
+        follower.start()
+
     db_server = socketserver.ThreadingTCPServer((address, port), MyTCPRequestHandler)
     print("Starting DB Server")
     try:
         db_server.serve_forever()
     except KeyboardInterrupt:
         print("Backing up metadata...")
-        engine.flush_memtable_to_disk(engine.current_segment_path())
+        if follower:
+            follower.stop()
+        replication_log.close()
+        engine.flush()
         engine.save_metadata()
+        engine.close()
 
 
 if __name__ == "__main__":
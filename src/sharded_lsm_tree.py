@@ -0,0 +1,332 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from pathlib import Path
+import heapq
+from mmh3 import hash
+from amplification import combined_amplification
+from block_cache import BlockCache
+from file_handle_cache import FileHandleCache
+from lsm_tree import LSMTree
+from negative_cache import NegativeCache
+from row_cache import RowCache
+
+
+# Workers already partition keys by their plain hash. Shards use a different seed,
+# otherwise every key of a worker would land in the same shard.
+SHARD_SEED = 0x5eed
+
+
+class ShardedLSMTree():
+    def __init__(self, segment_basename, segments_directory, wal_basename, num_shards):
+        ''' (self, str, str, str, int) -> ShardedLSMTree
+        Initialize a DB that partitions keys by hash across num_shards independent
+        LSM Trees. Each shard lives in segments_directory/shard-{number}/ and has its
+        own memtable, write ahead log, segments and locks, so that writes to different
+        shards proceed in parallel and each flush or compaction only touches one shard.
+
+        The shards share a single block cache, file handle cache, row cache and
+        negative cache, so that their memory and open files go to whichever shards
+        are read the most.
+        '''
+        self.segments_directory = segments_directory
+        self.wal_basename = wal_basename
+        self.shards = []
+
+        # Create the segments directory
+        if not (Path(segments_directory).exists() and Path(segments_directory).is_dir()):
+            Path(segments_directory).mkdir()
+
+        self.block_cache = BlockCache()
+        self.file_handle_cache = FileHandleCache()
+        self.row_cache = RowCache()
+        self.negative_cache = NegativeCache()
+        for number in range(num_shards):
+            self.shards.append(LSMTree(
+                segment_basename, self.shard_directory(number), wal_basename,
+                self.block_cache, self.file_handle_cache, self.row_cache, self.negative_cache))
+
+        self.executor = ThreadPoolExecutor(num_shards)
+
+    def db_set(self, key, value, ttl=None, expires_at=None):
+        ''' (self, str, str, float, int) -> None
+        Stores a new key value pair in the shard that owns key, expiring ttl
+        seconds from now if given, or at expires_at.
+        '''
+        self.shard(key).db_set(key, value, ttl, expires_at)
+
+    def db_get(self, key, snapshot=None):
+        ''' (self, str, ShardedSnapshot) -> str
+        Retrieve the value associated with key from the shard that owns it, as of
+        snapshot if given.
+        '''
+        number = self.shard_number(key)
+        return self.shards[number].db_get(key, self.shard_snapshot(snapshot, number))
+
+    def db_get_many(self, keys, snapshot=None):
+        ''' (self, [str], ShardedSnapshot) -> [str]
+        Retrieve the values associated with keys, in order, as of snapshot if given
+        or of a snapshot taken for the lookup otherwise. The keys of each shard
+        are looked up as one batch, and the shards are searched in parallel.
+        '''
+        if snapshot is None:
+            with self.snapshot() as snapshot:
+                return self.db_get_many(keys, snapshot)
+
+        batches = {}
+        for i, key in enumerate(keys):
+            batches.setdefault(self.shard_number(key), []).append(i)
+
+        futures = {
+            number: self.executor.submit(
+                self.shards[number].db_get_many, [keys[i] for i in positions], snapshot.snapshots[number])
+            for number, positions in batches.items()
+        }
+
+        values = [None] * len(keys)
+        for number, positions in batches.items():
+            for i, value in zip(positions, futures[number].result()):
+                values[i] = value
+
+        return values
+
+    def scan(self, start=None, end=None, snapshot=None, with_expiry=False):
+        ''' (self, str, str, ShardedSnapshot, Boolean) -> generator
+        Yields the key value pairs with start <= key < end across all shards,
+        in key order, as of snapshot if given. Values are yielded as stored,
+        along with their expiry time, if with_expiry is set.
+        '''
+        return heapq.merge(*[
+            shard.scan(start, end, self.shard_snapshot(snapshot, number), with_expiry)
+            for number, shard in enumerate(self.shards)])
+
+    def snapshot(self):
+        ''' (self) -> ShardedSnapshot
+        Returns a snapshot of every shard as of the same point in time. Writes are
+        held off on every shard while the snapshot is taken.
+        '''
+        with ExitStack() as stack:
+            for shard in self.shards:
+                stack.enter_context(shard.write_lock)
+            return ShardedSnapshot(
+                [shard.take_snapshot() for shard in self.shards], self.release_snapshot)
+
+    def release_snapshot(self, snapshot):
+        ''' (self, ShardedSnapshot) -> None
+        Releases the snapshot of every shard.
+        '''
+        for shard, shard_snapshot in zip(self.shards, snapshot.snapshots):
+            shard.release_snapshot(shard_snapshot)
+
+    def flush(self):
+        ''' (self) -> None
+        Flushes the memtable of every shard to disk.
+        '''
+        self.for_each_shard(LSMTree.flush)
+
+    def compact(self):
+        ''' (self) -> None
+        Compacts the segments of every shard.
+        '''
+        self.for_each_shard(LSMTree.compact)
+
+    def collect_value_log(self):
+        ''' (self) -> int
+        Collects the garbage of the value log of every shard. Returns the number of
+        bytes of garbage found in the files collected.
+        '''
+        futures = [self.executor.submit(shard.collect_value_log) for shard in self.shards]
+        return sum(future.result() for future in futures)
+
+    def verify(self):
+        ''' (self) -> dict
+        Checks the segments of every shard against their checksums. Returns the
+        report of every shard, prefixed with the shard's directory name.
+        '''
+        report = {}
+        for number, shard in enumerate(self.shards):
+            for name, value in shard.verify().items():
+                report['shard-{}.{}'.format(number, name)] = value
+        return report
+
+    def checkpoint(self, directory):
+        ''' (self, str) -> dict
+        Writes a checkpoint of every shard to its own directory under directory,
+        laid out like the DB's, in parallel. Returns the report of every shard,
+        prefixed with the shard's directory name.
+        '''
+        futures = [
+            self.executor.submit(shard.checkpoint, '{}/shard-{}/'.format(directory.rstrip('/'), number))
+            for number, shard in enumerate(self.shards)
+        ]
+
+        report = {}
+        for number, future in enumerate(futures):
+            for name, value in future.result().items():
+                report['shard-{}.{}'.format(number, name)] = value
+        return report
+
+    def stats(self, measure_space=False):
+        ''' (self, Boolean) -> dict
+        Returns the statistics of every shard, prefixed with the shard's directory name,
+        followed by those of the shared caches and the amplification of the whole
+        DB, with space amplification if measure_space is set.
+        '''
+        shared = ('block_cache.', 'file_handle_cache.', 'row_cache.', 'negative_cache.')
+        stats = {}
+        shard_stats = [shard.stats(measure_space) for shard in self.shards]
+        for number, shard in enumerate(shard_stats):
+            for name, value in shard.items():
+                if not name.startswith(shared):
+                    stats['shard-{}.{}'.format(number, name)] = value
+
+        for name, value in self.block_cache.stats().items():
+            stats['block_cache.' + name] = value
+        for name, value in self.file_handle_cache.stats().items():
+            stats['file_handle_cache.' + name] = value
+        for name, value in self.row_cache.stats().items():
+            stats['row_cache.' + name] = value
+        for name, value in self.negative_cache.stats().items():
+            stats['negative_cache.' + name] = value
+        for name, value in combined_amplification(shard_stats).items():
+            stats['amplification.' + name] = value
+        return stats
+
+    # Configuration methods
+    def set_threshold(self, threshold):
+        ''' (self, int) -> None
+        Sets the threshold for the DB as a whole, in bytes. Each shard flushes once
+        its memtable reaches its share of the threshold.
+        '''
+        for shard in self.shards:
+            shard.set_threshold(max(threshold // len(self.shards), 1))
+
+    def set_sparsity_factor(self, factor):
+        ''' (self, int) -> None
+        Sets the sparsity factor of each shard's index.
+        '''
+        for shard in self.shards:
+            shard.set_sparsity_factor(factor)
+
+    def set_scan_processes(self, processes):
+        ''' (self, int) -> None
+        Sets the number of processes each shard scans its segments with when
+        rebuilding its index or bloom filter.
+        '''
+        for shard in self.shards:
+            shard.set_scan_processes(processes)
+
+    def set_block_cache_capacity(self, capacity):
+        ''' (self, int) -> None
+        Sets the memory budget of the block cache shared by the shards, in bytes.
+        '''
+        self.block_cache.set_capacity(capacity)
+
+    def set_max_open_files(self, max_open_files):
+        ''' (self, int) -> None
+        Sets the number of segment files the shards keep open between reads, in total.
+        '''
+        self.file_handle_cache.set_max_open_files(max_open_files)
+
+    def set_row_cache_capacity(self, capacity):
+        ''' (self, int) -> None
+        Sets the memory budget of the row cache shared by the shards, in bytes.
+        0 turns it off.
+        '''
+        self.row_cache.set_capacity(capacity)
+
+    def set_negative_cache_size(self, max_keys):
+        ''' (self, int) -> None
+        Sets the number of keys missing from disk the shards remember, in total.
+        '''
+        self.negative_cache.set_max_keys(max_keys)
+
+    def set_checksum_verification(self, mode):
+        ''' (self, str) -> None
+        Sets how often each shard checks the blocks it reads against their checksums.
+        '''
+        for shard in self.shards:
+            shard.set_checksum_verification(mode)
+
+    def set_drop_expired_segments(self, enabled):
+        ''' (self, Boolean) -> None
+        Sets whether each shard's compaction drops segments whose records have all expired.
+        '''
+        for shard in self.shards:
+            shard.set_drop_expired_segments(enabled)
+
+    def set_value_separation_threshold(self, threshold):
+        ''' (self, int) -> None
+        Sets the size from which each shard moves values to its value log.
+        '''
+        for shard in self.shards:
+            shard.set_value_separation_threshold(threshold)
+
+    def set_filter_type(self, filter_type):
+        ''' (self, str) -> None
+        Sets the kind of filter each shard uses to skip segments.
+        '''
+        self.for_each_shard(lambda shard: shard.set_filter_type(filter_type))
+
+    # Metadata
+    def save_metadata(self):
+        ''' (self) -> None
+        Save the bookkeeping information of every shard.
+        '''
+        self.for_each_shard(LSMTree.save_metadata)
+
+    def close(self):
+        ''' (self) -> None
+        Closes every shard, and stops the threads shards are used from.
+        '''
+        self.for_each_shard(LSMTree.close)
+        self.executor.shutdown()
+
+    ### Helper methods
+
+    def shard_number(self, key):
+        ''' (self, str) -> int
+        Returns the number of the shard that owns key.
+        '''
+        return hash(key, SHARD_SEED) % len(self.shards)
+
+    def shard(self, key):
+        ''' (self, str) -> LSMTree
+        Returns the shard that owns key.
+        '''
+        return self.shards[self.shard_number(key)]
+
+    def shard_snapshot(self, snapshot, number):
+        ''' (self, ShardedSnapshot, int) -> Snapshot
+        Returns the part of snapshot that covers the given shard, or None.
+        '''
+        return None if snapshot is None else snapshot.snapshots[number]
+
+    def for_each_shard(self, method):
+        ''' (self, function) -> None
+        Calls method on every shard in parallel, waiting for all of them to finish.
+        '''
+        for future in [self.executor.submit(method, shard) for shard in self.shards]:
+            future.result()
+
+    def shard_directory(self, number):
+        ''' (self, int) -> str
+        Returns the path to the segments directory of the given shard.
+        '''
+        return self.segments_directory + 'shard-{}/'.format(number)
+
+
+class ShardedSnapshot:
+    def __init__(self, snapshots, release):
+        ''' (self, [Snapshot], function) -> ShardedSnapshot
+        Holds the snapshots of every shard, taken at the same point in time, in
+        shard order. They are released together by release, which also happens
+        when leaving a with block.
+        '''
+        self.snapshots = snapshots
+        self.release = release
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.release(self)
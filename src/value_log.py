@@ -0,0 +1,222 @@
+from pathlib import Path
+import logging
+import os
+import threading
+import zlib
+from append_log import RECORD_HEADER, encode_record
+
+
+logger = logging.getLogger(__name__)
+
+# Values moved to the value log are replaced in segments by a pointer to them:
+# this prefix, followed by the number of the value log file, and the offset and
+# length of the record in it. Values can't start with it otherwise. It must not
+# be whitespace, as segment records are stripped when they are read.
+VALUE_POINTER_PREFIX = '\x1a'
+
+# Value log files are called VALUE_LOG_PREFIX followed by their number, and a new
+# one is started once the current one reaches VALUE_LOG_FILE_SIZE bytes
+VALUE_LOG_PREFIX = 'vlog-'
+VALUE_LOG_FILE_SIZE = 64 * 1024 * 1024
+
+
+class CorruptValueLogError(Exception):
+    pass
+
+
+class ValueLog:
+    def __init__(self, directory):
+        ''' (self, str) -> ValueLog
+        Opens the value log kept in directory: the files large values are moved to
+        when memtables are flushed, so that segments only hold pointers to them
+        and compacting or merging segments doesn't copy the values again.
+
+        Records are appended to the newest file. A new file is started whenever
+        the log is opened, so that files are only ever appended to by the session
+        that created them, and never once they are linked into a checkpoint.
+        '''
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.readers = {}
+
+        numbers = self.file_numbers()
+        self.current = numbers[-1] + 1 if numbers else 1
+        # Whether any value was ever moved to the log, so that segments may hold
+        # pointers to it
+        self.used = bool(numbers)
+        self.stream = None
+        self.size = 0
+        self.bytes_written = 0
+
+    def append(self, key, value):
+        ''' (self, str, str) -> str
+        Appends value, stored under key, to the log, and returns a pointer to it.
+        The value can only be read back once the log is synced.
+        '''
+        record = encode_record(key, value)
+        with self.lock:
+            if self.stream is not None and self.size >= VALUE_LOG_FILE_SIZE:
+                self.seal_current()
+            if self.stream is None:
+                self.stream = open(self.path(self.current), 'ab')
+                self.size = 0
+
+            offset = self.size
+            self.used = True
+            self.stream.write(record)
+            self.size += len(record)
+            self.bytes_written += len(record)
+
+        return '{}{}:{}:{}'.format(VALUE_POINTER_PREFIX, self.current, offset, len(record))
+
+    def sync(self):
+        ''' (self) -> None
+        Waits for the values appended so far to reach the disk.
+        '''
+        with self.lock:
+            if self.stream is not None:
+                self.stream.flush()
+                os.fsync(self.stream.fileno())
+
+    def seal(self):
+        ''' (self) -> None
+        Closes the current file, so that the next value is appended to a new one.
+        '''
+        with self.lock:
+            self.seal_current()
+
+    def close(self):
+        ''' (self) -> None
+        Closes the current file and the files opened for reading.
+        '''
+        with self.lock:
+            if self.stream is not None:
+                self.stream.flush()
+                os.fsync(self.stream.fileno())
+                self.stream.close()
+                self.stream = None
+            for fd in self.readers.values():
+                os.close(fd)
+            self.readers = {}
+
+    def read(self, pointer):
+        ''' (self, str) -> str
+        Returns the value pointer points to. Raises CorruptValueLogError if its
+        record fails its checksum.
+        '''
+        number, offset, length = parse_pointer(pointer)
+        with self.lock:
+            fd = self.readers.get(number)
+            if fd is None:
+                fd = self.readers[number] = os.open(self.path(number), os.O_RDONLY)
+
+        data = os.pread(fd, length, offset)
+        if len(data) < RECORD_HEADER.size:
+            raise CorruptValueLogError('Record at {} of {} is cut short'.format(offset, self.path(number)))
+
+        checksum, key_size, _ = RECORD_HEADER.unpack_from(data)
+        if len(data) != length or zlib.crc32(data[4:]) != checksum:
+            raise CorruptValueLogError('Record at {} of {} failed its checksum'.format(offset, self.path(number)))
+        return data[RECORD_HEADER.size + key_size:].decode()
+
+    def records(self, number):
+        ''' (self, int) -> generator
+        Yields the key, value and pointer of every record of file number, in order,
+        stopping at a record cut short or failing its checksum.
+        '''
+        with open(self.path(number), 'rb') as s:
+            data = s.read()
+
+        header_size = RECORD_HEADER.size
+        position = 0
+        while position + header_size <= len(data):
+            checksum, key_size, value_size = RECORD_HEADER.unpack_from(data, position)
+            end = position + header_size + key_size + value_size
+            if end > len(data) or zlib.crc32(data[position + 4:end]) != checksum:
+                logger.warning('Ignoring corrupt record at %d of %s', position, self.path(number))
+                return
+
+            key_end = position + header_size + key_size
+            pointer = '{}{}:{}:{}'.format(VALUE_POINTER_PREFIX, number, position, end - position)
+            yield data[position + header_size:key_end].decode(), data[key_end:end].decode(), pointer
+            position = end
+
+    def sealed_files(self):
+        ''' (self) -> [int]
+        Returns the numbers of the files that are no longer appended to, oldest first.
+        '''
+        with self.lock:
+            return [number for number in self.file_numbers() if number != self.current]
+
+    def remove(self, number):
+        ''' (self, int) -> None
+        Deletes file number.
+        '''
+        with self.lock:
+            fd = self.readers.pop(number, None)
+            if fd is not None:
+                os.close(fd)
+
+        if Path(self.path(number)).exists():
+            os.remove(self.path(number))
+
+    def file_numbers(self):
+        ''' (self) -> [int]
+        Returns the numbers of the files of the log, in increasing order.
+        '''
+        return sorted(
+            int(path.name[len(VALUE_LOG_PREFIX):])
+            for path in Path(self.directory).glob(VALUE_LOG_PREFIX + '*')
+            if path.name[len(VALUE_LOG_PREFIX):].isdigit())
+
+    def disk_size(self):
+        ''' (self) -> int
+        Returns the number of bytes the files of the log take up.
+        '''
+        return sum(self.file_size(number) for number in self.file_numbers())
+
+    def file_size(self, number):
+        ''' (self, int) -> int
+        Returns the number of bytes file number takes up, or 0 if it is gone.
+        '''
+        try:
+            return Path(self.path(number)).stat().st_size
+        except FileNotFoundError:
+            return 0
+
+    def path(self, number):
+        ''' (self, int) -> str
+        Returns the path to file number.
+        '''
+        return os.path.join(self.directory, VALUE_LOG_PREFIX + str(number))
+
+    # Helpers
+    def seal_current(self):
+        ''' (self) -> None
+        Closes the current file and moves on to the next number.
+
+        Note: the caller must hold lock.
+        '''
+        if self.stream is None:
+            return
+
+        self.stream.flush()
+        os.fsync(self.stream.fileno())
+        self.stream.close()
+        self.stream = None
+        self.current += 1
+
+
+def is_pointer(value):
+    ''' (str) -> Boolean
+    Returns whether value, as stored in a segment, points into the value log.
+    '''
+    return value.startswith(VALUE_POINTER_PREFIX)
+
+
+def parse_pointer(pointer):
+    ''' (str) -> (int, int, int)
+    Returns the file number, offset and length of the record pointer points to.
+    '''
+    number, offset, length = pointer[len(VALUE_POINTER_PREFIX):].split(':')
+    return int(number), int(offset), int(length)
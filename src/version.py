@@ -0,0 +1,71 @@
+class Version:
+    def __init__(self, memtable, immutable_memtables, segments):
+        ''' (self, RedBlackTree, [RedBlackTree], [str]) -> Version
+        Creates a snapshot of the tree's state: the active memtable, the
+        memtables waiting to be flushed (newest first) and the segments on disk
+        (oldest first).
+
+        A version is never modified once it has been installed. Readers hold a
+        reference to it for the duration of a lookup, which keeps the segment
+        files it points to from being deleted underneath them.
+        '''
+        self.memtable = memtable
+        self.immutable_memtables = tuple(immutable_memtables)
+        self.segments = list(segments)
+        self.refs = 0
+
+    def memtables(self):
+        ''' (self) -> (RedBlackTree)
+        Returns every memtable in the version, newest first.
+        '''
+        return (self.memtable,) + self.immutable_memtables
+
+    def ref(self):
+        ''' (self) -> None
+        Registers a new holder of the version.
+        '''
+        self.refs += 1
+
+    def unref(self):
+        ''' (self) -> int
+        Drops a holder of the version and returns the remaining number of holders.
+        '''
+        self.refs -= 1
+        return self.refs
+
+
+class Snapshot:
+    def __init__(self, sequence, version, release):
+        ''' (self, int, Version, function) -> Snapshot
+        Creates a handle on the state of a tree as of the write numbered sequence.
+        Reads made through it don't see later writes, even once they have been
+        flushed or compacted.
+
+        The snapshot pins version until release is called with it, which also
+        happens when leaving a with block.
+        '''
+        self.sequence = sequence
+        self.version = version
+        self.release = release
+        self.released = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.release(self)
+
+
+def visible_value(node, sequence):
+    ''' (Node, int) -> (Boolean, str)
+    Returns whether the memtable node holds a value written at or before sequence,
+    and the latest such value. Every value is visible if sequence is None.
+    '''
+    if sequence is None or (node.sequence or 0) <= sequence:
+        return True, node.value
+
+    for value_sequence, value in reversed(node.history or ()):
+        if value_sequence <= sequence:
+            return True, value
+
+    return False, None
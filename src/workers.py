@@ -0,0 +1,234 @@
+from itertools import islice
+from multiprocessing.connection import Client
+from mmh3 import hash
+from amplification import combined_amplification
+import heapq
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+# Number of records fetched from another worker at a time while scanning
+SCAN_PAGE_SIZE = 1000
+
+
+class WorkerException(Exception):
+    pass
+
+
+class WorkerEngine:
+    # The engine methods that other workers may invoke
+    REMOTE_METHODS = (
+        'db_get', 'db_get_many', 'db_set', 'scan_page', 'flush', 'compact', 'stats', 'verify', 'checkpoint')
+
+    def __init__(self, worker_id, engine, listener, worker_addresses, authkey, segments_directory):
+        ''' (self, int, LSMTree, Listener, [str], bytes, str) -> WorkerEngine
+        Wraps engine, the LSMTree of worker number worker_id, so that it can be used
+        in place of a single LSMTree by a server running in several processes.
+
+        Every key is owned by exactly one worker. Requests for keys owned by other
+        workers are forwarded to them through the listeners at worker_addresses,
+        which are listed in worker order. listener is this worker's own listener.
+        '''
+        self.worker_id = worker_id
+        self.engine = engine
+        self.listener = listener
+        self.worker_addresses = worker_addresses
+        self.authkey = authkey
+        self.segments_directory = segments_directory
+        self.wal_basename = engine.wal_basename
+
+        # Connections aren't thread safe, so each server thread gets its own
+        self.connections = threading.local()
+
+    def db_get(self, key):
+        ''' (self, str) -> str
+        Retrieve the value associated with key from the worker that owns it.
+        '''
+        return self.call(self.owner(key), 'db_get', key)
+
+    def db_get_many(self, keys):
+        ''' (self, [str]) -> [str]
+        Retrieve the values associated with keys, in order, asking each worker
+        once for all of the keys it owns.
+        '''
+        batches = {}
+        for i, key in enumerate(keys):
+            batches.setdefault(self.owner(key), []).append(i)
+
+        values = [None] * len(keys)
+        for worker_id, positions in batches.items():
+            found = self.call(worker_id, 'db_get_many', [keys[i] for i in positions])
+            for i, value in zip(positions, found):
+                values[i] = value
+
+        return values
+
+    def db_set(self, key, value, ttl=None, expires_at=None):
+        ''' (self, str, str, float, int) -> None
+        Stores a new key value pair with the worker that owns key, expiring ttl
+        seconds from now if given, or at expires_at.
+        '''
+        return self.call(self.owner(key), 'db_set', key, value, ttl, expires_at)
+
+    def scan(self, start=None, end=None, with_expiry=False):
+        ''' (self, str, str, Boolean) -> generator
+        Yields the key value pairs with start <= key < end across all workers,
+        in key order, with values as stored, along with their expiry time, if
+        with_expiry is set.
+        '''
+        return heapq.merge(*[
+            self.scan_worker(worker_id, start, end, with_expiry)
+            for worker_id in range(len(self.worker_addresses))
+        ])
+
+    def flush(self):
+        ''' (self) -> None
+        Flushes the memtable of every worker to disk.
+        '''
+        for worker_id in range(len(self.worker_addresses)):
+            self.call(worker_id, 'flush')
+
+    def compact(self):
+        ''' (self) -> None
+        Compacts the segments of every worker.
+        '''
+        for worker_id in range(len(self.worker_addresses)):
+            self.call(worker_id, 'compact')
+
+    def verify(self):
+        ''' (self) -> dict
+        Checks the segments of every worker against their checksums. Returns the
+        report of every worker, prefixed with the worker's id.
+        '''
+        report = {}
+        for worker_id in range(len(self.worker_addresses)):
+            for name, value in self.call(worker_id, 'verify').items():
+                report['worker-{}.{}'.format(worker_id, name)] = value
+        return report
+
+    def checkpoint(self, directory):
+        ''' (self, str) -> dict
+        Writes a checkpoint of every worker to its own directory under directory,
+        laid out like the DB's. Returns the report of every worker, prefixed with
+        the worker's id.
+        '''
+        report = {}
+        for worker_id in range(len(self.worker_addresses)):
+            worker_directory = '{}/worker-{}/'.format(directory.rstrip('/'), worker_id)
+            for name, value in self.call(worker_id, 'checkpoint', worker_directory).items():
+                report['worker-{}.{}'.format(worker_id, name)] = value
+        return report
+
+    def stats(self, measure_space=False):
+        ''' (self, Boolean) -> dict
+        Returns the statistics of every worker, prefixed with the worker's id,
+        followed by the amplification of the whole DB, with space amplification
+        if measure_space is set.
+        '''
+        stats = {}
+        worker_stats = [self.call(worker_id, 'stats', measure_space)
+                        for worker_id in range(len(self.worker_addresses))]
+        for worker_id, worker in enumerate(worker_stats):
+            for name, value in worker.items():
+                stats['worker-{}.{}'.format(worker_id, name)] = value
+        for name, value in combined_amplification(worker_stats).items():
+            stats['amplification.' + name] = value
+        return stats
+
+    # Routing helpers
+    def owner(self, key):
+        ''' (self, str) -> int
+        Returns the id of the worker that owns key.
+        '''
+        return hash(key) % len(self.worker_addresses)
+
+    def scan_worker(self, worker_id, start, end, with_expiry=False):
+        ''' (self, int, str, str, Boolean) -> generator
+        Yields the key value pairs of the worker worker_id with start <= key < end,
+        fetching them a page at a time.
+        '''
+        while True:
+            page = self.call(worker_id, 'scan_page', start, end, SCAN_PAGE_SIZE, with_expiry)
+            yield from page
+            if len(page) < SCAN_PAGE_SIZE:
+                return
+
+            # The smallest key that sorts after the last one we've seen
+            start = page[-1][0] + '\0'
+
+    def call(self, worker_id, method, *args):
+        ''' (self, int, str, ...) -> any
+        Invokes method on the engine of the worker worker_id.
+        '''
+        if worker_id == self.worker_id:
+            return self.execute(method, args)
+
+        connection = self.connection(worker_id)
+        connection.send((method, args))
+        ok, result = connection.recv()
+        if not ok:
+            raise WorkerException(result)
+
+        return result
+
+    def connection(self, worker_id):
+        ''' (self, int) -> Connection
+        Returns the current thread's connection to the worker worker_id.
+        '''
+        if not hasattr(self.connections, 'by_worker'):
+            self.connections.by_worker = {}
+
+        by_worker = self.connections.by_worker
+        if worker_id not in by_worker:
+            by_worker[worker_id] = Client(self.worker_addresses[worker_id], authkey=self.authkey)
+
+        return by_worker[worker_id]
+
+    # Serving other workers
+    def execute(self, method, args):
+        ''' (self, str, tuple) -> any
+        Runs method with args against this worker's engine.
+        '''
+        if method == 'scan_page':
+            start, end, limit, with_expiry = args
+            return list(islice(self.engine.scan(start, end, with_expiry=with_expiry), limit))
+
+        return getattr(self.engine, method)(*args)
+
+    def serve(self):
+        ''' (self) -> None
+        Starts accepting requests from other workers in the background.
+        '''
+        threading.Thread(target=self.accept_connections, daemon=True).start()
+
+    def accept_connections(self):
+        ''' (self) -> None
+        Accepts connections from other workers, serving each in its own thread.
+        '''
+        while True:
+            connection = self.listener.accept()
+            threading.Thread(
+                target=self.serve_connection, args=(connection,), daemon=True).start()
+
+    def serve_connection(self, connection):
+        ''' (self, Connection) -> None
+        Executes the requests received over connection until it is closed.
+        '''
+        with connection:
+            while True:
+                try:
+                    method, args = connection.recv()
+                except EOFError:
+                    return
+
+                if method not in self.REMOTE_METHODS:
+                    connection.send((False, 'Unknown method {}'.format(method)))
+                    continue
+
+                try:
+                    connection.send((True, self.execute(method, args)))
+                except Exception as e:
+                    logger.exception('Error while serving %s', method)
+                    connection.send((False, str(e)))
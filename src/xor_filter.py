@@ -0,0 +1,211 @@
+from mmh3 import hash64
+import mmap
+import numpy as np
+import os
+import struct
+
+# Xor filter files hold a header followed by the fingerprints, as is, so that
+# they can be memory mapped. The header holds the magic, the format version,
+# the hash seed and the length of each of the three blocks of fingerprints.
+XOR_FILTER_FILE_MAGIC = b'LSXF'
+XOR_FILTER_FILE_VERSION = 1
+XOR_FILTER_FILE_HEADER = struct.Struct('<4sHIQ')
+XOR_FILTER_FILE_HEADER_SIZE = 64
+
+# Number of seeds tried before giving up on building a filter. Each attempt
+# succeeds with a probability close to 1 for the table sizes used.
+MAX_ATTEMPTS = 100
+
+MASK_64 = (1 << 64) - 1
+
+
+class XorFilterException(Exception):
+    pass
+
+
+class XorFilter:
+    def __init__(self, keys, seed=0):
+        ''' (self, [str], int) -> XorFilter
+        Creates a filter for the static set of keys, with a false positive
+        probability of 1/256 and about 9.84 bits per key, which is 30% less
+        than a BloomFilter with the same probability.
+
+        Each key maps to three slots, one in each third of a table of 8 bit
+        fingerprints, and the table is filled in so that the xor of the three
+        slots is the fingerprint of the key (Graf and Lemire's xor filter).
+        Checks read exactly those three slots.
+        '''
+        hashes = np.unique(np.array(
+            [hash64(key, signed=False)[0] for key in keys], dtype=np.uint64))
+
+        self.block_length = (int(len(hashes) * 1.23) + 32) // 3
+        for attempt in range(MAX_ATTEMPTS):
+            self.seed = seed + attempt
+            fingerprints = self.build(self.mix(hashes))
+            if fingerprints is not None:
+                self.fingerprints = fingerprints
+                return
+
+        raise XorFilterException('Could not build a filter for {} keys'.format(len(hashes)))
+
+    def check(self, item):
+        ''' (self, str) -> Boolean
+        Check for existence of an item in filter
+        '''
+        # A scalar version of check_many, as NumPy's overhead dominates for one item
+        h = (hash64(item, signed=False)[0] + self.seed) & MASK_64
+        h ^= h >> 33
+        h = (h * 0xff51afd7ed558ccd) & MASK_64
+        h ^= h >> 33
+        h = (h * 0xc4ceb9fe1a85ec53) & MASK_64
+        h ^= h >> 33
+
+        block_length = self.block_length
+        fingerprints = self.fingerprints
+        found = fingerprints[((h >> 32) * block_length) >> 32] \
+            ^ fingerprints[block_length + ((((h << 21 | h >> 43) & MASK_64) >> 32) * block_length >> 32)] \
+            ^ fingerprints[2 * block_length + ((((h << 42 | h >> 22) & MASK_64) >> 32) * block_length >> 32)]
+        return found == (h ^ (h >> 32)) & 0xff
+
+    def check_many(self, items):
+        ''' (self, [str]) -> [Boolean]
+        Check for existence of every item in items in the filter, in order.
+        '''
+        hashes = self.mix(np.array([hash64(item, signed=False)[0] for item in items], dtype=np.uint64))
+        h0, h1, h2 = self.slots(hashes)
+
+        found = self.fingerprints[h0] ^ self.fingerprints[h1] ^ self.fingerprints[h2]
+        return (found == self.fingerprint(hashes)).tolist()
+
+    def estimated_false_positive_prob(self):
+        ''' (self) -> float
+        Returns the false positive probability: an absent item is let through when
+        its fingerprint happens to match, 1 time in 256.
+        '''
+        return 1 / 256
+
+    def num_bits(self):
+        ''' (self) -> int
+        Returns the size of the filter in bits.
+        '''
+        return len(self.fingerprints) * 8
+
+    def save(self, path):
+        ''' (self, str) -> None
+        Writes the filter to path in the xor filter file format.
+        '''
+        header = XOR_FILTER_FILE_HEADER.pack(
+            XOR_FILTER_FILE_MAGIC, XOR_FILTER_FILE_VERSION, self.seed, self.block_length)
+
+        temp_path = path + '_temp'
+        with open(temp_path, 'wb') as s:
+            s.write(header.ljust(XOR_FILTER_FILE_HEADER_SIZE, b'\0'))
+            s.write(self.fingerprints.tobytes())
+        os.replace(temp_path, path)
+
+    # Helpers
+    def build(self, hashes):
+        ''' (self, ndarray) -> ndarray
+        Returns the fingerprint table for hashes, or None if the current seed
+        maps them to slots that can't be peeled apart.
+        '''
+        h0, h1, h2 = (slots.tolist() for slots in self.slots(hashes))
+        hash_values = hashes.tolist()
+        capacity = 3 * self.block_length
+
+        # For each slot, the number of keys using it and the xor of their indices
+        counts = np.zeros(capacity, dtype=np.int64)
+        np.add.at(counts, np.concatenate(self.slots(hashes)), 1)
+        counts = counts.tolist()
+        members = [0] * capacity
+        for i in range(len(hash_values)):
+            members[h0[i]] ^= i
+            members[h1[i]] ^= i
+            members[h2[i]] ^= i
+
+        # Peel keys off slots that only they use, until none are left
+        queue = [slot for slot in range(capacity) if counts[slot] == 1]
+        stack = []
+        while queue:
+            slot = queue.pop()
+            if counts[slot] != 1:
+                continue
+
+            i = members[slot]
+            stack.append((i, slot))
+            for other in (h0[i], h1[i], h2[i]):
+                members[other] ^= i
+                counts[other] -= 1
+                if counts[other] == 1:
+                    queue.append(other)
+
+        if len(stack) < len(hash_values):
+            return None
+
+        # Assign each key's slot, in the reverse order of peeling, so that the
+        # other two slots of the key are final by the time its own is set
+        fingerprints = [0] * capacity
+        fingerprint = self.fingerprint(hashes).tolist()
+        for i, slot in reversed(stack):
+            fingerprints[slot] = fingerprint[i] ^ fingerprints[h0[i]] ^ fingerprints[h1[i]] ^ fingerprints[h2[i]]
+
+        return np.array(fingerprints, dtype=np.uint8)
+
+    def mix(self, hashes):
+        ''' (self, ndarray) -> ndarray
+        Mixes the seed into hashes (the finaliser of MurmurHash3), so that each
+        seed maps the keys to different slots.
+        '''
+        h = hashes + np.uint64(self.seed)
+        h ^= h >> np.uint64(33)
+        h *= np.uint64(0xff51afd7ed558ccd)
+        h ^= h >> np.uint64(33)
+        h *= np.uint64(0xc4ceb9fe1a85ec53)
+        h ^= h >> np.uint64(33)
+        return h
+
+    def slots(self, hashes):
+        ''' (self, ndarray) -> (ndarray, ndarray, ndarray)
+        Returns the slot of each hash in each third of the table.
+        '''
+        block_length = np.uint64(self.block_length)
+        return tuple(
+            (np.uint64(i) * block_length + (rotate_left(hashes, 21 * i) >> np.uint64(32)) * block_length
+             // np.uint64(1 << 32)).astype(np.int64)
+            for i in range(3))
+
+    def fingerprint(self, hashes):
+        ''' (self, ndarray) -> ndarray
+        Returns the 8 bit fingerprint of each hash.
+        '''
+        return ((hashes ^ (hashes >> np.uint64(32))) & np.uint64(0xff)).astype(np.uint8)
+
+
+def rotate_left(values, bits):
+    ''' (ndarray, int) -> ndarray
+    Rotates 64 bit values left by bits.
+    '''
+    if bits == 0:
+        return values
+    return (values << np.uint64(bits)) | (values >> np.uint64(64 - bits))
+
+
+def load(path):
+    ''' (str) -> XorFilter
+    Opens the filter saved at path by XorFilter.save. The fingerprints are
+    memory mapped rather than read.
+    '''
+    with open(path, 'rb') as s:
+        mapping = mmap.mmap(s.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, version, seed, block_length = XOR_FILTER_FILE_HEADER.unpack_from(mapping)
+    if magic != XOR_FILTER_FILE_MAGIC or version != XOR_FILTER_FILE_VERSION:
+        raise ValueError('{} is not a version {} xor filter file'.format(path, XOR_FILTER_FILE_VERSION))
+
+    xor_filter = XorFilter.__new__(XorFilter)
+    xor_filter.seed = seed
+    xor_filter.block_length = block_length
+    xor_filter.fingerprints = np.frombuffer(
+        mapping, dtype=np.uint8, count=3 * block_length, offset=XOR_FILTER_FILE_HEADER_SIZE)
+
+    return xor_filter
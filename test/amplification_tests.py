@@ -0,0 +1,54 @@
+import unittest
+from src.amplification import amplification_ratios, combined_amplification
+
+COUNTERS = {
+    'user_bytes': 100, 'wal_bytes': 120, 'flush_bytes': 100, 'value_log_bytes': 0,
+    'compaction_bytes': 60, 'merge_bytes': 20, 'reads': 4, 'segment_probes': 6, 'disk_bytes': 150,
+}
+
+class AmplificationTests(unittest.TestCase):
+    def test_ratios_divide_counters(self):
+        '''
+        Tests that write and read amplification are worked out from the counters.
+        '''
+        ratios = amplification_ratios(COUNTERS)
+
+        self.assertEqual(ratios['write'], 3.0)
+        self.assertEqual(ratios['read'], 1.5)
+        self.assertNotIn('space', ratios)
+        self.assertEqual(ratios['flush_bytes'], 100)
+
+    def test_space_amplification_needs_live_bytes(self):
+        '''
+        Tests that space amplification is only given along with live bytes.
+        '''
+        ratios = amplification_ratios(dict(COUNTERS, live_bytes=100))
+
+        self.assertEqual(ratios['space'], 1.5)
+
+    def test_ratios_are_zero_without_activity(self):
+        '''
+        Tests that ratios of a fresh DB don't divide by zero.
+        '''
+        ratios = amplification_ratios(dict.fromkeys(COUNTERS, 0))
+
+        self.assertEqual(ratios['write'], 0.0)
+        self.assertEqual(ratios['read'], 0.0)
+
+    def test_combined_amplification_sums_parts(self):
+        '''
+        Tests that the amplification of a split DB is worked out from the sums of
+        the counters of its parts, as listed in their statistics.
+        '''
+        part = {'amplification.' + name: value for name, value in COUNTERS.items()}
+        part['amplification.write'] = 3.0
+        other = dict(part, **{'amplification.reads': '0', 'amplification.user_bytes': '0'})
+
+        combined = combined_amplification([part, other])
+        self.assertEqual(combined['user_bytes'], 100)
+        self.assertEqual(combined['write'], 6.0)
+        self.assertEqual(combined['read'], 3.0)
+        self.assertEqual(combined_amplification([]), {})
+
+if __name__ == '__main__':
+    unittest.main()
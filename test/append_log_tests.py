@@ -1,6 +1,6 @@
 import unittest
 from os import remove
-from src.append_log import AppendLog
+from src.append_log import AppendLog, encode_record, is_legacy_log, read_records, upgrade_legacy_log
 
 FILENAME = 'testfile'
 
@@ -12,45 +12,110 @@ class AppendLogTests(unittest.TestCase):
         '''
         Tests that a single value can be written to disk.
         '''
-        output = 'test,test string\n'
         a = AppendLog.instance(FILENAME)
-        a.write(output)
+        a.write('test', 'test string')
 
-        with open(FILENAME, 'r') as s:
-            input = s.readline()
-        
-        self.assertEqual(output, input)
+        self.assertEqual(list(read_records(FILENAME)), [('test', 'test string')])
 
     def test_write_writes_multiple_values_to_disk(self):
         '''
         Tests that mutliple values can be written to disk.
         '''
-        output1 = 'test,test string\n'
-        output2 = 'write,writer\n'
         a = AppendLog.instance(FILENAME)
-        a.write(output1)
-        a.write(output2)
+        a.write('test', 'test string')
+        a.write('write', 'writer')
 
-        with open(FILENAME, 'r') as s:
-            input = s.readlines()
+        self.assertEqual(list(read_records(FILENAME)), [('test', 'test string'), ('write', 'writer')])
 
-        self.assertEqual(output1, input[0])
-        self.assertEqual(output2, input[1])
+    def test_write_keeps_commas_and_newlines(self):
+        '''
+        Tests that values holding separators are read back unchanged.
+        '''
+        a = AppendLog.instance(FILENAME)
+        a.write('chris', 'lessard,\nhemsworth')
+
+        self.assertEqual(list(read_records(FILENAME)), [('chris', 'lessard,\nhemsworth')])
+
+    def test_read_records_stops_at_torn_record(self):
+        '''
+        Tests that a record cut short by a crash is ignored.
+        '''
+        a = AppendLog.instance(FILENAME)
+        a.write('test1', 'test2')
+        with open(FILENAME, 'ab') as s:
+            s.write(encode_record('test3', 'test4')[:-2])
+
+        self.assertEqual(list(read_records(FILENAME)), [('test1', 'test2')])
+
+    def test_read_records_stops_at_corrupt_record(self):
+        '''
+        Tests that replay stops at a record that fails its checksum.
+        '''
+        a = AppendLog.instance(FILENAME)
+        a.write('test1', 'test2')
+        record = bytearray(encode_record('test3', 'test4'))
+        record[-1] ^= 0xff
+        with open(FILENAME, 'ab') as s:
+            s.write(bytes(record) + encode_record('test5', 'test6'))
+
+        self.assertEqual(list(read_records(FILENAME)), [('test1', 'test2')])
+
+    def test_read_records_across_chunks(self):
+        '''
+        Tests that records running over the end of a chunk are read whole.
+        '''
+        a = AppendLog.instance(FILENAME)
+        records = [('key{}'.format(i), 'value{}'.format(i) * 5000) for i in range(300)]
+        for key, value in records:
+            a.write(key, value)
+
+        self.assertEqual(list(read_records(FILENAME)), records)
+
+    def test_legacy_log_is_upgraded_to_binary_records(self):
+        '''
+        Tests that logs of key,value lines are told apart from binary logs, and
+        rewritten as binary records.
+        '''
+        a = AppendLog.instance(FILENAME)
+        a.write('test1', 'test2')
+        self.assertFalse(is_legacy_log(FILENAME))
+
+        with open(FILENAME, 'w') as s:
+            s.write('test1,test2\ntest3,test4,test5\n')
+        self.assertTrue(is_legacy_log(FILENAME))
+
+        upgrade_legacy_log(FILENAME)
+        a.reopen()
+        a.write('test6', 'test7')
+        self.assertFalse(is_legacy_log(FILENAME))
+        self.assertEqual(
+            list(read_records(FILENAME)), [('test1', 'test2'), ('test3', 'test4,test5'), ('test6', 'test7')])
 
     def test_clear_clears_file_on_disk(self):
         '''
         Tests that the disk contents can be cleared.
         '''
         a = AppendLog.instance(FILENAME)
-        a.write('test1,test2\n')
-        a.write('test3,test4\n')
-        a.write('test5,test6\n')
+        a.write('test1', 'test2')
+        a.write('test3', 'test4')
+        a.write('test5', 'test6')
         a.clear()
 
-        with open(FILENAME, 'r') as s:
-            input = s.readlines()
+        self.assertEqual(list(read_records(FILENAME)), [])
+
+    def test_subscribers_hear_about_writes(self):
+        '''
+        Tests that subscribers are called with the key and value of each write.
+        '''
+        a = AppendLog.instance(FILENAME)
+        writes = []
+        a.subscribe(lambda key, value: writes.append((key, value)))
+        try:
+            a.write('test1', 'test2')
+        finally:
+            a.subscribers.clear()
 
-        self.assertTrue(len(input) == 0)
+        self.assertEqual(writes, [('test1', 'test2')])
 
     def test_singleton_returns_same_instance(self):
         '''
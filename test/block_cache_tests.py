@@ -0,0 +1,67 @@
+import unittest
+from src.block_cache import BlockCache, read_block
+
+class BlockCacheTests(unittest.TestCase):
+    def test_get_counts_hits_and_misses(self):
+        '''
+        Tests that lookups are counted as hits or misses.
+        '''
+        cache = BlockCache(100)
+        cache.put(('segment', 0, 0), {'a': '1'}, 10)
+
+        self.assertEqual(cache.get(('segment', 0, 0)), {'a': '1'})
+        self.assertIsNone(cache.get(('segment', 0, 1)))
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_least_recently_used_block_is_evicted(self):
+        '''
+        Tests that the cache evicts the block that was used least recently
+        once it goes over its capacity.
+        '''
+        cache = BlockCache(30)
+        for number in range(3):
+            cache.put(('segment', 0, number), {}, 10)
+        cache.get(('segment', 0, 0))
+        cache.put(('segment', 0, 3), {}, 10)
+
+        self.assertIsNotNone(cache.get(('segment', 0, 0)))
+        self.assertIsNone(cache.get(('segment', 0, 1)))
+        self.assertEqual(cache.stats()['bytes'], 30)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_invalidate_drops_blocks_of_one_segment(self):
+        '''
+        Tests that invalidating a segment leaves the blocks of others cached.
+        '''
+        cache = BlockCache(100)
+        cache.put(('segment1', 0, 0), {}, 10)
+        cache.put(('segment2', 0, 0), {}, 10)
+        cache.invalidate('segment1')
+
+        self.assertIsNone(cache.get(('segment1', 0, 0)))
+        self.assertIsNotNone(cache.get(('segment2', 0, 0)))
+        self.assertEqual(cache.stats()['bytes'], 10)
+
+    def test_read_block_assigns_records_to_the_block_they_start_in(self):
+        '''
+        Tests that a record that crosses a block boundary is only read as part
+        of the block it starts in.
+        '''
+        records = ['key{:04},{}\n'.format(i, 'v' * 50) for i in range(200)]
+        data = ''.join(records).encode()
+
+        keys = []
+        number = 0
+        while True:
+            block, _ = read_block(data, number)
+            if not block:
+                break
+            keys.extend(block)
+            number += 1
+
+        self.assertGreater(number, 1)
+        self.assertEqual(keys, ['key{:04}'.format(i) for i in range(200)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,7 @@
 import unittest
-from src.bloom_filter import BloomFilter
+import os
+import tempfile
+from src.bloom_filter import BLOCK_BITS, BloomFilter, BlockedBloomFilter, ScalableBloomFilter, load
 
 class BloomFilterTests(unittest.TestCase):
     def test_add_item_one_item(self):
@@ -140,3 +142,191 @@ class BloomFilterTests(unittest.TestCase):
         prob = 0.02
         bf = BloomFilter(num_items, prob)
         self.assertEqual(bf.bit_array_size, 81423)
+
+    def test_add_many_sets_the_same_bits_as_add(self):
+        '''
+        Tests that adding a batch of items matches adding them one at a time.
+        '''
+        keys = ['key{}'.format(i) for i in range(500)]
+        bf1 = BloomFilter(500, 0.05)
+        bf2 = BloomFilter(500, 0.05)
+        for key in keys:
+            bf1.add(key)
+        bf2.add_many(keys)
+
+        self.assertEqual(bf1.bit_array, bf2.bit_array)
+
+    def test_check_many_matches_check(self):
+        '''
+        Tests that checking a batch of items gives the answers of check, in order.
+        '''
+        bf = BloomFilter(100, 0.05)
+        bf.add_many(['key{}'.format(i) for i in range(100)])
+
+        keys = ['key{}'.format(i) for i in range(0, 200, 3)]
+        self.assertEqual(bf.check_many(keys), [bf.check(key) for key in keys])
+        self.assertEqual(bf.check_many([]), [])
+
+class BlockedBloomFilterTests(unittest.TestCase):
+    def test_add_item_multiple_items(self):
+        '''
+        Tests that multiple items can be added to the blocked Bloom Filter.
+        '''
+        bf = BlockedBloomFilter(1000, 0.05)
+        for i in range(1000):
+            bf.add('key{}'.format(i))
+
+        for i in range(1000):
+            self.assertTrue(bf.check('key{}'.format(i)))
+
+    def test_bit_array_size_is_a_whole_number_of_blocks(self):
+        '''
+        Tests that the bit array is rounded up to whole 512 bit blocks.
+        '''
+        bf = BlockedBloomFilter(20, 0.05)
+        self.assertEqual(bf.bit_array_size, BLOCK_BITS)
+        self.assertEqual(bf.num_hash_fns, 4)
+
+        bf = BlockedBloomFilter(10000, 0.02)
+        self.assertEqual(bf.num_blocks, 160)
+        self.assertEqual(bf.bit_array_size, 160 * BLOCK_BITS)
+
+    def test_bits_of_an_item_are_in_one_block(self):
+        '''
+        Tests that all of the bits set for an item fall in the same block.
+        '''
+        bf = BlockedBloomFilter(10000, 0.01)
+        for i in range(100):
+            blocks = {digest // BLOCK_BITS for digest in bf.digests('key{}'.format(i))}
+            self.assertEqual(len(blocks), 1)
+
+    def test_false_positive_rate_is_close_to_target(self):
+        '''
+        Tests that the measured false positive rate stays near the requested one.
+        '''
+        bf = BlockedBloomFilter(10000, 0.05)
+        for i in range(10000):
+            bf.add('key{}'.format(i))
+
+        false_positives = sum(bf.check('missing{}'.format(i)) for i in range(10000))
+        self.assertLess(false_positives / 10000, 0.08)
+
+    def test_add_many_and_check_many_match_add_and_check(self):
+        '''
+        Tests that the batch operations of the blocked Bloom Filter match the single ones.
+        '''
+        keys = ['key{}'.format(i) for i in range(500)]
+        bf1 = BlockedBloomFilter(500, 0.05)
+        bf2 = BlockedBloomFilter(500, 0.05)
+        for key in keys:
+            bf1.add(key)
+        bf2.add_many(keys)
+        self.assertEqual(bf1.bit_array, bf2.bit_array)
+
+        others = ['other{}'.format(i) for i in range(500)]
+        self.assertEqual(bf2.check_many(others), [bf2.check(key) for key in others])
+
+class ScalableBloomFilterTests(unittest.TestCase):
+    def test_adds_sub_filters_as_it_fills(self):
+        '''
+        Tests that the filter grows past its initial capacity without losing items.
+        '''
+        bf = ScalableBloomFilter(100, 0.05)
+        keys = ['key{}'.format(i) for i in range(1000)]
+        for key in keys[:500]:
+            bf.add(key)
+        bf.add_many(keys[500:])
+
+        self.assertEqual(len(bf.filters), 4)
+        self.assertTrue(all(bf.check_many(keys)))
+        for key in keys:
+            self.assertTrue(bf.check(key))
+
+    def test_false_positive_rate_stays_under_target(self):
+        '''
+        Tests that the measured false positive rate stays under the requested one
+        after growing well past the initial capacity.
+        '''
+        bf = ScalableBloomFilter(100, 0.05)
+        bf.add_many(['key{}'.format(i) for i in range(5000)])
+
+        false_positives = sum(bf.check_many(['missing{}'.format(i) for i in range(10000)]))
+        self.assertLess(false_positives / 10000, 0.05)
+
+    def test_repeated_items_do_not_grow_the_filter(self):
+        '''
+        Tests that adding the same items again doesn't add sub-filters.
+        '''
+        bf = ScalableBloomFilter(100, 0.05)
+        for _ in range(10):
+            bf.add_many(['key{}'.format(i) for i in range(50)])
+
+        self.assertEqual(len(bf.filters), 1)
+
+class FilterFileTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'bloom_filter')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_load_returns_an_equivalent_filter(self):
+        '''
+        Tests that a saved filter loads back with the same type, parameters and bits.
+        '''
+        for cls in (BloomFilter, BlockedBloomFilter):
+            bf = cls(100, 0.05)
+            bf.add_many(['key{}'.format(i) for i in range(100)])
+            bf.save(self.path)
+
+            loaded = load(self.path)
+            self.assertIs(type(loaded), cls)
+            self.assertEqual(loaded.bit_array_size, bf.bit_array_size)
+            self.assertEqual(loaded.num_hash_fns, bf.num_hash_fns)
+            self.assertEqual(loaded.false_positive_prob, 0.05)
+            for i in range(200):
+                self.assertEqual(loaded.check('key{}'.format(i)), bf.check('key{}'.format(i)))
+
+    def test_load_returns_an_equivalent_scalable_filter(self):
+        '''
+        Tests that a saved scalable filter loads back with all of its sub-filters.
+        '''
+        bf = ScalableBloomFilter(100, 0.05)
+        bf.add_many(['key{}'.format(i) for i in range(300)])
+        bf.save(self.path)
+
+        loaded = load(self.path)
+        self.assertIs(type(loaded), ScalableBloomFilter)
+        self.assertEqual(len(loaded.filters), len(bf.filters))
+        self.assertEqual(loaded.initial_capacity, 100)
+        self.assertTrue(all(loaded.check_many(['key{}'.format(i) for i in range(300)])))
+
+        loaded.add_many(['more{}'.format(i) for i in range(300)])
+        self.assertTrue(loaded.check('more299'))
+
+    def test_adding_to_a_loaded_filter_leaves_the_file_unchanged(self):
+        '''
+        Tests that items added to a loaded filter stay in memory until it is saved.
+        '''
+        BlockedBloomFilter(100, 0.05).save(self.path)
+
+        loaded = load(self.path)
+        loaded.add('chris')
+        loaded.add_many(['daniel'])
+        self.assertTrue(loaded.check('chris'))
+        self.assertEqual(loaded.check_many(['daniel']), [True])
+        self.assertFalse(load(self.path).check('chris'))
+
+        loaded.save(self.path)
+        self.assertTrue(load(self.path).check('chris'))
+
+    def test_load_rejects_other_files(self):
+        '''
+        Tests that files in other formats aren't taken for filters.
+        '''
+        with open(self.path, 'wb') as s:
+            s.write(b'not a filter'.ljust(64, b'\0'))
+
+        with self.assertRaises(ValueError):
+            load(self.path)
@@ -0,0 +1,61 @@
+import unittest
+import os
+import tempfile
+from src.checkpoint import link_or_copy, prepare_directory, restore_checkpoint
+
+class CheckpointTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.checkpoint = os.path.join(self.directory.name, 'checkpoint')
+        self.restored = os.path.join(self.directory.name, 'restored')
+        os.makedirs(os.path.join(self.checkpoint, 'shard-0'))
+        for name in ('MANIFEST', 'segment-1', os.path.join('shard-0', 'MANIFEST')):
+            with open(os.path.join(self.checkpoint, name), 'w') as s:
+                s.write(name)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_link_or_copy_links_file(self):
+        '''
+        Tests that files are hard linked rather than copied.
+        '''
+        source = os.path.join(self.checkpoint, 'segment-1')
+        destination = os.path.join(self.directory.name, 'segment-1')
+        link_or_copy(source, destination)
+
+        self.assertEqual(os.stat(source).st_ino, os.stat(destination).st_ino)
+
+    def test_prepare_directory_refuses_directory_with_files(self):
+        '''
+        Tests that checkpoints are only written to empty directories.
+        '''
+        prepare_directory(self.restored)
+        self.assertTrue(os.path.isdir(self.restored))
+
+        with self.assertRaises(ValueError):
+            prepare_directory(self.checkpoint)
+
+    def test_restore_checkpoint_links_segments_and_copies_manifests(self):
+        '''
+        Tests that restoring links every file, in every subdirectory, except
+        manifests, which are copied.
+        '''
+        self.assertEqual(restore_checkpoint(self.checkpoint, self.restored), 3)
+
+        for name in ('MANIFEST', 'segment-1', os.path.join('shard-0', 'MANIFEST')):
+            with open(os.path.join(self.restored, name)) as s:
+                self.assertEqual(s.read(), name)
+
+        def same_file(name):
+            return os.stat(os.path.join(self.checkpoint, name)).st_ino == \
+                os.stat(os.path.join(self.restored, name)).st_ino
+        self.assertTrue(same_file('segment-1'))
+        self.assertFalse(same_file('MANIFEST'))
+
+    def test_restore_checkpoint_needs_a_manifest(self):
+        '''
+        Tests that directories that don't hold a checkpoint are refused.
+        '''
+        with self.assertRaises(ValueError):
+            restore_checkpoint(self.restored, os.path.join(self.directory.name, 'other'))
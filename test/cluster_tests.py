@@ -0,0 +1,166 @@
+import unittest
+import shutil
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+from src.client import DbException, LSMDbClient, LSMDbClusterClient
+from src.expiry import split_expiry
+
+TEST_BASEPATH = 'test-cluster/'
+NUM_NODES = 3
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+class ClusterTests(unittest.TestCase):
+    '''
+    Runs each node as a local server process on its own port.
+    '''
+    def setUp(self):
+        Path(TEST_BASEPATH).mkdir(exist_ok=True)
+        self.servers = []
+        self.nodes = [self.start_node(i) for i in range(NUM_NODES)]
+
+    def tearDown(self):
+        for server in self.servers:
+            server.kill()
+            server.wait()
+        shutil.rmtree(TEST_BASEPATH)
+
+    def start_node(self, number):
+        port = free_port()
+        self.servers.append(subprocess.Popen(
+            [sys.executable, 'src/server.py', '-p', str(port), '-d', TEST_BASEPATH + 'node-{}/'.format(number)],
+            stdout=subprocess.DEVNULL))
+
+        # Wait for the server to accept connections
+        deadline = time.time() + 10
+        while True:
+            try:
+                LSMDbClient('127.0.0.1', port).close()
+                return '127.0.0.1:{}'.format(port)
+            except ConnectionRefusedError:
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.05)
+
+    def test_set_and_get_route_keys_to_their_owner(self):
+        '''
+        Tests that each key is stored only on the node that owns it.
+        '''
+        cluster = LSMDbClusterClient(self.nodes)
+        for i in range(30):
+            cluster.set('key{}'.format(i), 'value{}'.format(i))
+
+        for i in range(30):
+            key = 'key{}'.format(i)
+            self.assertEqual(cluster.get(key), 'value{}'.format(i))
+
+            for node in self.nodes:
+                host, port = node.split(':')
+                stored = dict(LSMDbClient(host, int(port)).scan())
+                self.assertEqual(key in stored, node == cluster.ring.node_for(key))
+
+    def test_getall_gathers_values_from_every_node(self):
+        '''
+        Tests that multi-key reads are split across nodes and reassembled in order.
+        '''
+        cluster = LSMDbClusterClient(self.nodes)
+
+        # Ports are picked at random, and so is the ring, so keys are added until
+        # every node owns some
+        pairs = []
+        while len(pairs) < 12 or len({cluster.ring.node_for(key) for key, _ in pairs}) < NUM_NODES:
+            pairs.append(('key{}'.format(len(pairs)), 'value{}'.format(len(pairs))))
+        cluster.set_many(pairs)
+
+        keys = [key for key, _ in pairs]
+        values = [value for _, value in pairs]
+        self.assertEqual(cluster.getall(*keys).split('^'), values)
+        self.assertEqual(cluster.getall('key5', 'missing', 'key0', 'key11'), 'value5^null^value0^value11')
+
+    def test_rebalance_moves_keys_to_new_node(self):
+        '''
+        Tests that adding a node streams the keys it now owns over to it.
+        '''
+        cluster = LSMDbClusterClient(self.nodes[:2])
+        pairs = [('key{}'.format(i), 'value{}'.format(i)) for i in range(50)]
+        cluster.set_many(pairs)
+
+        moved = cluster.rebalance(self.nodes)
+
+        self.assertTrue(moved > 0)
+        host, port = self.nodes[2].split(':')
+        stored = dict(LSMDbClient(host, int(port)).scan())
+        self.assertEqual(len(stored), moved)
+        for key, value in pairs:
+            self.assertEqual(cluster.get(key), value)
+
+    def test_rebalance_keeps_expiry_times(self):
+        '''
+        Tests that keys moved to a new node expire when they would have on their old one.
+        '''
+        cluster = LSMDbClusterClient(self.nodes[:2])
+        for i in range(50):
+            cluster.set('key{}'.format(i), 'value{}'.format(i), ttl=3600)
+        expected = {}
+        for node in self.nodes[:2]:
+            host, port = node.split(':')
+            expected.update(LSMDbClient(host, int(port)).scan(with_expiry=True))
+
+        moved = cluster.rebalance(self.nodes)
+
+        host, port = self.nodes[2].split(':')
+        stored = dict(LSMDbClient(host, int(port)).scan(with_expiry=True))
+        self.assertEqual(len(stored), moved)
+        for key, value in stored.items():
+            self.assertEqual(split_expiry(value), split_expiry(expected[key]))
+            self.assertIsNotNone(split_expiry(value)[1])
+
+    def test_set_rejects_keys_segments_cannot_hold(self):
+        '''
+        Tests that SET replies with an error for a key holding a comma, and keeps serving.
+        '''
+        host, port = self.nodes[0].split(':')
+        client = LSMDbClient(host, int(port))
+        self.assertTrue(client.set('chris,lessard', 'value').startswith('ERROR:'))
+        self.assertEqual(client.set('key', 'a,b'), 'Wrote key=a,b')
+        client.flush()
+        self.assertEqual(client.get('key'), 'a,b')
+        self.assertEqual(dict(client.scan()), {'key': 'a,b'})
+
+    def test_stats_reports_filter_statistics(self):
+        '''
+        Tests that the STATS command lists the statistics of a node.
+        '''
+        host, port = self.nodes[0].split(':')
+        client = LSMDbClient(host, int(port))
+        client.set('key', 'value')
+        client.flush()
+        with self.assertRaises(DbException):
+            client.get('missing')
+
+        stats = client.stats()
+        self.assertEqual(stats['filter_type'], 'bloom')
+        self.assertEqual(stats['filter.bloom.checks'], '1')
+        self.assertEqual(client.ping(), 'Pong!')
+
+    def test_stats_reports_amplification(self):
+        '''
+        Tests that the STATS command lists amplification, measuring space
+        amplification only when asked to.
+        '''
+        host, port = self.nodes[0].split(':')
+        client = LSMDbClient(host, int(port))
+        client.set('key', 'value')
+        client.flush()
+
+        stats = client.stats()
+        self.assertEqual(stats['amplification.user_bytes'], '8')
+        self.assertGreater(float(stats['amplification.write']), 1)
+        self.assertNotIn('amplification.space', stats)
+        self.assertIn('amplification.space', client.stats(measure_space=True))
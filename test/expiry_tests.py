@@ -0,0 +1,48 @@
+import unittest
+from src.expiry import expiry_range, live_value, merge_expiry_ranges, split_expiry, with_expiry, with_expiry_time
+
+class ExpiryTests(unittest.TestCase):
+    def test_with_expiry_stores_expiry_time(self):
+        '''
+        Tests that values are stored along with the time they expire at.
+        '''
+        stored = with_expiry('lessard', 2.5, now=1000)
+
+        self.assertEqual(split_expiry(stored), ('lessard', 3500))
+        self.assertEqual(with_expiry_time('lessard', 3500), stored)
+        self.assertEqual(split_expiry('lessard'), ('lessard', None))
+        self.assertEqual(split_expiry('chris,' + stored), ('chris,lessard', 3500))
+
+    def test_with_expiry_needs_positive_ttl(self):
+        '''
+        Tests that values can't be set to expire immediately or in the past.
+        '''
+        with self.assertRaises(ValueError):
+            with_expiry('lessard', 0)
+
+    def test_live_value_hides_expired_values(self):
+        '''
+        Tests that expired values read as absent.
+        '''
+        stored = with_expiry('lessard', 1, now=1000)
+
+        self.assertEqual(live_value(stored, now=1999), 'lessard')
+        self.assertIsNone(live_value(stored, now=2000))
+        self.assertEqual(live_value('lessard', now=2000), 'lessard')
+        self.assertIsNone(live_value(None))
+
+    def test_expiry_range_covers_expiring_records(self):
+        '''
+        Tests that the expiry range of a segment spans its expiring records.
+        '''
+        self.assertEqual(expiry_range([300, 100, 200], 3), (100, 300, True))
+        self.assertEqual(expiry_range([300, 100], 3), (100, 300, False))
+        self.assertIsNone(expiry_range([], 3))
+
+    def test_merge_expiry_ranges(self):
+        '''
+        Tests that merged segments only all expire if both did.
+        '''
+        self.assertEqual(merge_expiry_ranges([(100, 200, True), (50, 150, True)]), (50, 200, True))
+        self.assertEqual(merge_expiry_ranges([(100, 200, True), None]), (100, 200, False))
+        self.assertIsNone(merge_expiry_ranges([None, None]))
@@ -0,0 +1,64 @@
+import unittest
+import os
+import tempfile
+from src.file_handle_cache import FileHandleCache, SegmentFile
+
+class FileHandleCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.paths = []
+        for i in range(3):
+            path = os.path.join(self.directory.name, 'segment-{}'.format(i))
+            with open(path, 'w') as s:
+                s.write('key{},value{}\n'.format(i, i))
+            self.paths.append(path)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_get_returns_cached_file(self):
+        '''
+        Tests that a cached segment file is returned with a new reference.
+        '''
+        cache = FileHandleCache(2)
+        segment_file = SegmentFile(self.paths[0])
+        cache.put((self.paths[0], 0), segment_file)
+
+        self.assertIs(cache.get((self.paths[0], 0)), segment_file)
+        self.assertIsNone(cache.get((self.paths[0], 2)))
+        self.assertEqual(segment_file.refs, 3)
+
+    def test_least_recently_used_file_is_closed(self):
+        '''
+        Tests that the cache closes the least recently used file once more than
+        max_open_files are open.
+        '''
+        cache = FileHandleCache(2)
+        segment_files = [SegmentFile(path) for path in self.paths]
+        for path, segment_file in zip(self.paths, segment_files):
+            cache.put((path, 0), segment_file)
+            segment_file.unref()
+
+        self.assertTrue(segment_files[0].data.closed)
+        self.assertFalse(segment_files[2].data.closed)
+        self.assertEqual(cache.stats()['open_files'], 2)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_invalidated_file_stays_open_while_referenced(self):
+        '''
+        Tests that a reader can keep reading a file that is invalidated and
+        replaced while it holds it.
+        '''
+        cache = FileHandleCache(2)
+        segment_file = SegmentFile(self.paths[0])
+        cache.put((self.paths[0], 0), segment_file)
+
+        os.replace(self.paths[1], self.paths[0])
+        cache.invalidate(self.paths[0])
+
+        self.assertEqual(list(segment_file.lines()), [b'key0,value0\n'])
+        segment_file.unref()
+        self.assertTrue(segment_file.data.closed)
+
+if __name__ == '__main__':
+    unittest.main()
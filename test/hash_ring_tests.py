@@ -0,0 +1,65 @@
+import unittest
+from collections import Counter
+from src.hash_ring import HashRing
+
+NODES = ['127.0.0.1:9001', '127.0.0.1:9002', '127.0.0.1:9003']
+KEYS = ['key{}'.format(i) for i in range(3000)]
+
+class HashRingTests(unittest.TestCase):
+    def test_node_for_returns_none_on_empty_ring(self):
+        '''
+        Tests that no node owns a key when the ring is empty.
+        '''
+        self.assertIsNone(HashRing().node_for('chris'))
+
+    def test_node_for_is_stable(self):
+        '''
+        Tests that rings built from the same nodes agree on key ownership,
+        regardless of the order in which nodes were added.
+        '''
+        ring1 = HashRing(NODES)
+        ring2 = HashRing(list(reversed(NODES)))
+
+        for key in KEYS:
+            self.assertEqual(ring1.node_for(key), ring2.node_for(key))
+
+    def test_virtual_nodes_balance_keys(self):
+        '''
+        Tests that every node owns a reasonable share of the keys.
+        '''
+        ring = HashRing(NODES)
+        counts = Counter(ring.node_for(key) for key in KEYS)
+
+        self.assertEqual(set(counts), set(NODES))
+        for node in NODES:
+            self.assertGreater(counts[node], len(KEYS) / len(NODES) / 2)
+
+    def test_add_node_only_moves_keys_to_new_node(self):
+        '''
+        Tests that adding a node only moves keys onto that node.
+        '''
+        ring = HashRing(NODES[:2])
+        before = {key: ring.node_for(key) for key in KEYS}
+
+        ring.add_node(NODES[2])
+        moved = [key for key in KEYS if ring.node_for(key) != before[key]]
+
+        self.assertTrue(moved)
+        for key in moved:
+            self.assertEqual(ring.node_for(key), NODES[2])
+
+    def test_remove_node_only_moves_keys_of_removed_node(self):
+        '''
+        Tests that removing a node only moves the keys it owned.
+        '''
+        ring = HashRing(NODES)
+        before = {key: ring.node_for(key) for key in KEYS}
+
+        ring.remove_node(NODES[1])
+
+        self.assertEqual(ring.nodes(), [NODES[0], NODES[2]])
+        for key in KEYS:
+            if before[key] != NODES[1]:
+                self.assertEqual(ring.node_for(key), before[key])
+            else:
+                self.assertNotEqual(ring.node_for(key), NODES[1])
@@ -1,8 +1,14 @@
 import unittest
 import os
 import pickle
+import tempfile
+import threading
+from unittest import mock
 from pathlib import Path
-from src.lsm_tree import LSMTree
+from src.append_log import read_records
+from src.expiry import EXPIRY_SEPARATOR, now_ms
+from src.lsm_tree import CorruptSegmentError, FlushFailedError, LSMTree
+from src.manifest import Manifest
 from src.red_black_tree import RedBlackTree
 
 TEST_FILENAME = 'test_file-1'
@@ -73,10 +79,9 @@ class TestDatabase(unittest.TestCase):
         db.db_set('daniel', 'lessard')
 
         self.assertEqual(Path(TEST_BASEPATH + BKUP_NAME).exists(), True)
-        with open(TEST_BASEPATH + BKUP_NAME, 'r') as s:
-            lines = s.readlines()
+        records = list(read_records(TEST_BASEPATH + BKUP_NAME))
 
-        self.assertEqual(len(lines), 2)
+        self.assertEqual(records, [('chris', 'lessard'), ('daniel', 'lessard')])
 
     def test_db_set_key_update_does_not_increment_memtable_total_bytes(self):
         '''
@@ -315,12 +320,15 @@ class TestDatabase(unittest.TestCase):
         db.bf_num_items = 100
         db.save_metadata()
 
-        with open(db.segments_directory + 'database_metadata', 'rb') as s:
-            metadata = pickle.load(s)
-        
+        records, torn = Manifest(db.segments_directory + 'MANIFEST').replay()
+        metadata = records[0]
+
+        self.assertEqual(len(records), 1)
+        self.assertFalse(torn)
+        self.assertEqual(metadata['op'], 'snapshot')
         self.assertEqual(metadata['current_segment'], TEST_FILENAME)
         self.assertEqual(metadata['segments'], segments)
-        self.assertEqual(metadata['bf_false_pos'], 0.5)
+        self.assertEqual(metadata['bf_false_pos_prob'], 0.5)
         self.assertEqual(metadata['bf_num_items'], 100)
         self.assertIsNotNone(metadata['index'])
 
@@ -338,7 +346,7 @@ class TestDatabase(unittest.TestCase):
         db.bf_false_pos_prob = 0.5
         db.bf_num_items = 100
         db.index.add('john', offset=5, segment='segment-1')
-        db.save_metadata() # pickle will be saved
+        db.save_metadata() # manifest will be checkpointed
         del db
 
         db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
@@ -350,6 +358,219 @@ class TestDatabase(unittest.TestCase):
         self.assertEqual(db.bf_num_items, 100)
         self.assertTrue(db.index.contains('john'))
 
+    def test_save_metadata_saves_bloom_filter_to_its_own_file(self):
+        '''
+        Tests that the bloom filter is saved to a filter file and loaded back from it.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.bloom_filter.add('chris')
+        db.save_metadata()
+
+        records, _ = Manifest(db.segments_directory + 'MANIFEST').replay()
+        self.assertNotIn('bloom_filter', records[0])
+        self.assertTrue(os.path.exists(db.segments_directory + 'bloom_filter'))
+        del db
+
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        self.assertTrue(db.bloom_filter.check('chris'))
+
+    def test_set_bloom_filter_false_pos_prob_rebuilds_filter_from_segments(self):
+        '''
+        Tests that changing the bloom filter settings keeps the keys already on disk.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        for i in range(20):
+            db.db_set('key{}'.format(i), 'value{}'.format(i))
+        db.flush()
+
+        old_filter = db.bloom_filter
+        db.bf_false_pos_prob = 0.01
+        db.rebuild_bloom_filter_in_background().join()
+
+        self.assertIsNot(db.bloom_filter, old_filter)
+        self.assertEqual(db.bloom_filter.false_positive_prob, 0.01)
+        self.assertIsNone(db.rebuilding_bloom_filter)
+        for i in range(20):
+            self.assertEqual(db.db_get('key{}'.format(i)), 'value{}'.format(i))
+
+    def test_xor_filters_are_built_for_each_flushed_segment(self):
+        '''
+        Tests that with xor filters, each segment gets a filter that rules out other keys.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.set_filter_type('xor')
+        self.assertIsNone(db.bloom_filter)
+
+        for i in range(10):
+            db.db_set('key{}'.format(i), 'value{}'.format(i))
+        db.flush()
+
+        segment = db.segments[0]
+        self.assertTrue(os.path.exists(TEST_BASEPATH + segment + '.xor'))
+        self.assertEqual(db.segments_that_may_contain('key3', db.segments), [segment])
+        for i in range(10):
+            self.assertEqual(db.db_get('key{}'.format(i)), 'value{}'.format(i))
+
+        misses = [key for key in ('other{}'.format(i) for i in range(100))
+                  if db.segments_that_may_contain(key, db.segments)]
+        self.assertLess(len(misses), 10)
+
+    def test_set_filter_type_builds_filters_for_existing_segments(self):
+        '''
+        Tests that switching filter types keeps every key on disk reachable.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        for i in range(10):
+            db.db_set('key{}'.format(i), 'value{}'.format(i))
+        db.flush()
+
+        db.set_filter_type('xor')
+        self.assertEqual(list(db.segment_filters), db.segments)
+        db.db_set('key10', 'value10')
+        db.flush()
+
+        db.set_filter_type('bloom')
+        self.assertEqual(db.segment_filters, {})
+        for i in range(11):
+            self.assertEqual(db.db_get('key{}'.format(i)), 'value{}'.format(i))
+
+        with self.assertRaises(ValueError):
+            db.set_filter_type('cuckoo')
+
+    def test_read_racing_with_filter_type_switch_finds_key(self):
+        '''
+        Tests that a read that checked the filter type just before a switch to xor
+        filters still finds keys on disk.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.memtable_wal().clear()
+        db.db_set('chris', 'lessard')
+        db.flush()
+
+        bloom_filter_check = db.bloom_filter_check
+        def switch_and_check(*args):
+            db.set_filter_type('xor')
+            return bloom_filter_check(*args)
+
+        with mock.patch.object(db, 'bloom_filter_check', side_effect=switch_and_check):
+            self.assertEqual(db.db_get('chris'), 'lessard')
+        self.assertEqual(db.filter_type, 'xor')
+
+    def test_filter_type_switch_waits_for_flushes(self):
+        '''
+        Tests that switching filter types waits for flushes, so that no segment is
+        left without a filter of the new type.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.memtable_wal().clear()
+        db.db_set('chris', 'lessard')
+        db.flush()
+
+        with db.flush_lock:
+            switch = threading.Thread(target=db.set_filter_type, args=('xor',))
+            switch.start()
+            switch.join(0.2)
+            self.assertTrue(switch.is_alive())
+            self.assertEqual(db.filter_type, 'bloom')
+        switch.join()
+
+        db.db_set('john', 'smith')
+        db.flush()
+        self.assertEqual(sorted(db.segment_filters), sorted(db.segments))
+
+    def test_xor_filters_are_loaded_with_metadata(self):
+        '''
+        Tests that the filter type and xor filters are restored at init time.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.set_filter_type('xor')
+        db.db_set('chris', 'lessard')
+        db.flush()
+        db.save_metadata()
+        del db
+
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        self.assertEqual(db.filter_type, 'xor')
+        self.assertEqual(list(db.segment_filters), db.segments)
+        self.assertEqual(db.db_get('chris'), 'lessard')
+
+    def test_values_with_commas_survive_flush_and_reopen(self):
+        '''
+        Tests that values holding commas are read back whole from segments,
+        including by the filter catch-up at init time.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.set_filter_type('xor')
+        db.db_set('chris', 'lessard,toronto,ca')
+        db.db_set('sarah', ',')
+        db.flush()
+        del db
+
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        self.assertTrue(db.filters_ready.wait(10))
+        self.assertEqual(db.db_get('chris'), 'lessard,toronto,ca')
+        self.assertEqual(db.db_get('sarah'), ',')
+        self.assertEqual(db.segment_keys(db.segments[0]), ['chris', 'sarah'])
+        self.assertEqual(list(db.scan()), [('chris', 'lessard,toronto,ca'), ('sarah', ',')])
+
+    def test_db_set_rejects_records_segments_cannot_hold(self):
+        '''
+        Tests that line breaks in keys or values, and commas in keys, are rejected.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        for key, value in (('chris', 'less\nard'), ('chris', 'less\rard'), ('ch\nris', 'lessard'), ('ch,ris', 'lessard')):
+            with self.assertRaises(ValueError):
+                db.db_set(key, value)
+
+        db.flush()
+        del db
+
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        self.assertEqual(db.segments, [])
+        self.assertIsNone(db.db_get('chris'))
+
+    def test_stats_count_filter_checks_and_false_positives(self):
+        '''
+        Tests that lookups that reach the bloom filter are counted, along with
+        those it ruled out and those it let through for absent keys.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.db_set('chris', 'lessard')
+        db.flush()
+
+        # A key the filter lets through, but isn't on disk
+        db.bloom_filter.add('daniel')
+
+        db.db_get('chris')
+        db.db_get('daniel')
+        for i in range(20):
+            db.db_get('missing{}'.format(i))
+
+        stats = db.stats()
+        self.assertEqual(stats['filter_type'], 'bloom')
+        self.assertEqual(stats['filter.bloom.checks'], 22)
+        self.assertGreaterEqual(stats['filter.bloom.false_positives'], 1)
+        self.assertEqual(
+            stats['filter.bloom.negatives'] + stats['filter.bloom.false_positives'], 21)
+        self.assertGreater(stats['filter.bloom.fill_ratio'], 0)
+        self.assertGreater(stats['filter.bloom.bits'], 0)
+
+    def test_stats_count_checks_of_each_xor_filter(self):
+        '''
+        Tests that each segment's xor filter gets its own counters.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.set_filter_type('xor')
+        db.db_set('chris', 'lessard')
+        db.flush()
+        db.db_get('chris')
+
+        stats = db.stats()
+        prefix = 'filter.{}.'.format(db.segments[0])
+        self.assertEqual(stats[prefix + 'checks'], 1)
+        self.assertEqual(stats[prefix + 'negatives'], 0)
+        self.assertEqual(stats[prefix + 'estimated_false_positive_rate'], round(1 / 256, 6))
+
     def test_restore_memtable_loads_memtable_from_wal(self):
         '''
         Tests that the memtable can be restored from the write-ahead-log.
@@ -384,12 +605,9 @@ class TestDatabase(unittest.TestCase):
         db.db_set('chris', 'lessard')
         db.db_set('chris', 'hemsworth')
 
-        with open(db.memtable_wal_path(), 'r') as s:
-            lines = s.readlines()
-        
-        self.assertEqual(len(lines), 2)
-        self.assertEqual(lines[0], 'chris,lessard\n')
-        self.assertEqual(lines[1], 'chris,hemsworth\n')
+        records = list(read_records(db.memtable_wal_path()))
+
+        self.assertEqual(records, [('chris', 'lessard'), ('chris', 'hemsworth')])
 
         del db
         db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
@@ -771,6 +989,45 @@ class TestDatabase(unittest.TestCase):
         self.assertFalse(db.index.contains('cyan'))
         self.assertFalse(db.index.contains('yellow'))
 
+    def test_repopulate_index_in_processes_matches_flushed_index(self):
+        '''
+        Tests that the index rebuilt by several processes is the one built by flushes.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.memtable_wal().clear()
+        db.set_threshold(1000)
+        db.set_sparsity_factor(100)
+        for segment in range(3):
+            for i in range(30):
+                db.db_set('key{}-{:02}'.format(segment, i), 'value{}'.format(i))
+            db.flush()
+
+        flushed = [(node.key, node.value, node.offset, node.segment) for node in db.index.in_order()]
+        db.set_scan_processes(2)
+        db.repopulate_index()
+
+        self.assertEqual(
+            [(node.key, node.value, node.offset, node.segment) for node in db.index.in_order()], flushed)
+        self.assertEqual(db.db_get('key1-07'), 'value7')
+
+    def test_rebuild_bloom_filter_in_processes(self):
+        '''
+        Tests that the bloom filter rebuilt by several processes holds every key on disk.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.memtable_wal().clear()
+        for segment in range(2):
+            db.db_set('chris{}'.format(segment), 'lessard')
+            db.flush()
+
+        db.set_scan_processes(2)
+        db.bf_false_pos_prob = 0.01
+        db.rebuild_bloom_filter()
+
+        self.assertEqual(db.bloom_filter.false_positive_prob, 0.01)
+        self.assertTrue(db.bloom_filter.check('chris0'))
+        self.assertTrue(db.bloom_filter.check('chris1'))
+
     # compaction
     def test_delete_keys_from_segment_deletes_one_key_from_file(self):
         '''
@@ -957,5 +1214,1281 @@ class TestDatabase(unittest.TestCase):
 
         self.assertEqual(lines, ['sides,seeds\n'])
 
+    # Scans
+    def test_scan_yields_most_recent_values_in_order(self):
+        '''
+        Tests that scans merge the memtable and every segment, keeping the
+        most recent value of each key.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.set_threshold(20)
+
+        db.db_set('chris', 'lessard')
+        db.db_set('daniel', 'lessard')
+        db.db_set('adrian', 'lessard')
+        db.db_set('chris', 'martinez')
+        db.db_set('bob', 'dylan')
+
+        self.assertTrue(len(db.segments) > 1)
+        self.assertEqual(list(db.scan()), [
+            ('adrian', 'lessard'),
+            ('bob', 'dylan'),
+            ('chris', 'martinez'),
+            ('daniel', 'lessard'),
+        ])
+
+    def test_scan_respects_bounds(self):
+        '''
+        Tests that scans only yield keys within [start, end).
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.set_threshold(20)
+        for key in ['a', 'b', 'c', 'd', 'e', 'f']:
+            db.db_set(key, key.upper())
+
+        self.assertEqual([k for k, _ in db.scan('b', 'e')], ['b', 'c', 'd'])
+        self.assertEqual([k for k, _ in db.scan(start='e')], ['e', 'f'])
+        self.assertEqual([k for k, _ in db.scan(end='b')], ['a'])
+
+    # Concurrency
+    def test_db_get_does_not_wait_for_writers(self):
+        '''
+        Tests that reads complete while writers hold the write and flush locks.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.db_set('chris', 'lessard')
+        result = []
+
+        with db.write_lock, db.flush_lock:
+            reader = threading.Thread(target=lambda: result.append(db.db_get('chris')))
+            reader.start()
+            reader.join(timeout=5)
+
+            self.assertFalse(reader.is_alive())
+
+        self.assertEqual(result, ['lessard'])
+
+    def test_db_get_reads_frozen_memtable_before_flush(self):
+        '''
+        Tests that keys in a memtable waiting to be flushed remain readable.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.db_set('chris', 'lessard')
+
+        with db.write_lock:
+            memtable, segment = db.rotate_memtable()
+
+        self.assertEqual(db.memtable.count, 0)
+        self.assertEqual(db.db_get('chris'), 'lessard')
+
+        db.flush_immutable_memtable(memtable, segment)
+
+        self.assertEqual(db.version.immutable_memtables, ())
+        self.assertEqual(db.segments, [segment])
+        self.assertEqual(db.db_get('chris'), 'lessard')
+
+    def test_concurrent_reads_and_writes_return_latest_values(self):
+        '''
+        Tests that concurrent readers always see acknowledged writes while
+        writers trigger flushes and compactions.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.set_threshold(60)
+        written = {}
+        errors = []
+
+        def writer(thread_id):
+            for i in range(50):
+                key, value = 'k{}_{}'.format(thread_id, i % 10), 'v{}'.format(i)
+                db.db_set(key, value)
+                written[key] = value
+
+        def reader():
+            for _ in range(200):
+                for key in list(written):
+                    try:
+                        if db.db_get(key) is None:
+                            errors.append(key)
+                    except Exception as e:
+                        errors.append(e)
+
+        threads = [threading.Thread(target=writer, args=(i,)) for i in range(3)]
+        threads += [threading.Thread(target=reader) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        for key, value in written.items():
+            self.assertEqual(db.db_get(key), value)
+
+    def test_merge_keeps_segment_until_version_is_released(self):
+        '''
+        Tests that a merged segment is only deleted once no reader holds a
+        version that refers to it.
+        '''
+        segments = ['test_file-1', 'test_file-2']
+        with open(TEST_BASEPATH + segments[0], 'w') as s:
+            s.write('1,test1\n')
+        with open(TEST_BASEPATH + segments[1], 'w') as s:
+            s.write('2,test2\n')
+
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.segments = segments[:]
+
+        version = db.acquire_version()
+        db.merge(segments[0], segments[1])
+
+        self.assertEqual(db.segments, ['test_file-1'])
+        self.assertTrue(os.path.exists(TEST_BASEPATH + segments[1]))
+        self.assertEqual(db.search_segment('2', segments[1]), 'test2')
+
+        db.release_version(version)
+        self.assertFalse(os.path.exists(TEST_BASEPATH + segments[1]))
+
+    def test_restore_memtable_replays_frozen_memtable_wal(self):
+        '''
+        Tests that the log of a memtable that was frozen but never flushed
+        is replayed at startup.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.memtable_wal().clear()
+        db.db_set('chris', 'lessard')
+
+        with db.write_lock:
+            db.rotate_memtable()
+        db.db_set('daniel', 'lessard')
+
+        del db
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+
+        self.assertTrue(db.memtable.contains('chris'))
+        self.assertTrue(db.memtable.contains('daniel'))
+
+    def test_restore_memtable_upgrades_legacy_wal(self):
+        '''
+        Tests that logs holding key,value lines, as written before records were
+        binary, are replayed and rewritten as binary records.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.memtable_wal().clear()
+        wal_path = db.memtable_wal_path()
+        frozen_wal_path = db.immutable_wal_path(db.current_segment)
+        del db
+
+        with open(frozen_wal_path, 'w') as s:
+            s.write('chris,lessard\ndaniel,lessard\n')
+        with open(wal_path, 'w') as s:
+            s.write('daniel,martin\n')
+
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        self.assertEqual(db.db_get('chris'), 'lessard')
+        self.assertEqual(db.db_get('daniel'), 'martin')
+        self.assertEqual(list(read_records(wal_path)), [('daniel', 'martin')])
+
+        db.db_set('john', 'smith')
+        del db
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        self.assertEqual(db.db_get('chris'), 'lessard')
+        self.assertEqual(db.db_get('daniel'), 'martin')
+        self.assertEqual(db.db_get('john'), 'smith')
+
+    def test_restore_memtable_builds_balanced_memtable(self):
+        '''
+        Tests that the memtable rebuilt from the write ahead log holds every key,
+        in order, with the values last written.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.memtable_wal().clear()
+        for i in range(100):
+            db.db_set('key{:03}'.format(i), 'old')
+        for i in range(0, 100, 2):
+            db.db_set('key{:03}'.format(i), 'new')
+
+        del db
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+
+        nodes = db.memtable.in_order()
+        self.assertEqual([node.key for node in nodes], ['key{:03}'.format(i) for i in range(100)])
+        self.assertEqual(db.db_get('key010'), 'new')
+        self.assertEqual(db.db_get('key011'), 'old')
+        self.assertEqual(db.memtable.count, 100)
+        self.assertEqual(db.memtable.total_bytes, 50 * 9 + 50 * 9)
+
+        db.db_set('key100', 'added')
+        self.assertEqual(db.db_get('key100'), 'added')
+
+    # Checksums
+    def corrupt_segment(self, db, segment, key):
+        '''
+        Flips a bit in the record of key in segment, behind the back of the DB.
+        '''
+        path = db.segment_path(segment)
+        with open(path, 'rb') as s:
+            data = bytearray(s.read())
+        position = data.find(key.encode()) + len(key) + 2
+        data[position] ^= 1
+        with open(path, 'wb') as s:
+            s.write(data)
+
+    def write_segment(self, db, count):
+        db.memtable_wal().clear()
+        db.set_threshold(100000)
+        for i in range(count):
+            db.db_set('key{:04}'.format(i), 'value{}'.format(i))
+        db.flush()
+        return db.segments[-1]
+
+    def test_flush_writes_segment_checksums(self):
+        '''
+        Tests that flushed segments are written along with their checksums.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        segment = self.write_segment(db, 500)
+
+        self.assertTrue(os.path.exists(db.segment_path(segment) + '.crc'))
+        self.assertEqual(db.db_get('key0100'), 'value100')
+        self.assertGreater(db.stats()['checksums.verified_blocks'], 0)
+
+    def test_corrupt_block_is_detected_on_read(self):
+        '''
+        Tests that reading a block that fails its checksum raises an error
+        rather than returning wrong data.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        segment = self.write_segment(db, 500)
+        self.corrupt_segment(db, segment, 'key0100')
+
+        with self.assertRaises(CorruptSegmentError):
+            db.db_get('key0100')
+        self.assertEqual(db.stats()['checksums.failures'], 1)
+
+    def test_checksum_verification_can_be_turned_off(self):
+        '''
+        Tests that blocks aren't checked when verification is off.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        segment = self.write_segment(db, 500)
+        self.corrupt_segment(db, segment, 'key0100')
+
+        db.set_checksum_verification('off')
+        self.assertEqual(db.db_get('key0100'), 'v`lue100')
+        self.assertEqual(db.stats()['checksums.verified_blocks'], 0)
+
+        with self.assertRaises(ValueError):
+            db.set_checksum_verification('sometimes')
+
+    def test_sampled_checksum_verification(self):
+        '''
+        Tests that only some of the blocks read are checked when verification is sampled.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        self.write_segment(db, 2000)
+        db.set_checksum_verification('sampled')
+        db.set_block_cache_capacity(0)
+
+        for _ in range(5):
+            for i in range(0, 2000, 10):
+                self.assertEqual(db.db_get('key{:04}'.format(i)), 'value{}'.format(i))
+
+        self.assertLess(db.stats()['checksums.verified_blocks'], 500)
+
+    def test_rewritten_segments_keep_checksums(self):
+        '''
+        Tests that segments rewritten by compaction and merges come with
+        checksums that match them.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        self.write_segment(db, 500)
+        db.db_set('key0001', 'updated')
+        db.compact()
+        db.flush()
+        db.merge(*db.segments)
+
+        self.assertEqual(db.db_get('key0001'), 'updated')
+        self.assertEqual(db.db_get('key0300'), 'value300')
+        report = db.verify()
+        self.assertEqual(report['segments'], 1)
+        self.assertEqual(report['corrupt_blocks'], 0)
+        self.assertEqual(report['unchecked_segments'], 0)
+        self.assertFalse(os.path.exists(TEST_BASEPATH + 'temp.crc'))
+
+    def test_verify_reports_corrupt_blocks(self):
+        '''
+        Tests that verify finds the corrupt blocks of every segment, and the
+        segments written without checksums.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        segment = self.write_segment(db, 500)
+        self.write_segment(db, 10)
+        self.corrupt_segment(db, segment, 'key0100')
+
+        with open(TEST_BASEPATH + 'legacy-1', 'w') as s:
+            s.write('chris,lessard\n')
+        db.segments = db.segments + ['legacy-1']
+
+        report = db.verify()
+
+        self.assertEqual(report['segments'], 3)
+        self.assertEqual(report['corrupt_blocks'], 1)
+        self.assertEqual(report['unchecked_segments'], 1)
+        self.assertEqual(report['size_mismatches'], 0)
+        self.assertEqual(report['corrupt.' + segment], '0')
+
+    def test_verify_reports_truncated_segments(self):
+        '''
+        Tests that a segment cut short is reported rather than skipped.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        segment = self.write_segment(db, 500)
+        size = os.path.getsize(TEST_BASEPATH + segment)
+        with open(TEST_BASEPATH + segment, 'r+b') as s:
+            s.truncate(size - 100)
+
+        report = db.verify()
+
+        self.assertEqual(report['size_mismatches'], 1)
+        self.assertEqual(report['unchecked_segments'], 0)
+        self.assertEqual(report['size_mismatch.' + segment], '{},{}'.format(size - 100, size))
+
+    # Block cache
+    def test_search_segment_reads_blocks_through_the_cache(self):
+        '''
+        Tests that every key of a segment spanning several blocks is found, and
+        that repeated lookups are served by the block cache.
+        '''
+        with open(TESTPATH, 'w') as s:
+            for i in range(500):
+                s.write('key{:04},value{}\n'.format(i, i))
+
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        for i in range(500):
+            self.assertEqual(db.search_segment('key{:04}'.format(i), TEST_FILENAME), 'value{}'.format(i))
+        self.assertIsNone(db.search_segment('key9999', TEST_FILENAME))
+
+        stats = db.stats()
+        self.assertGreater(len(db.segment_block_index(TESTPATH)[1]), 1)
+        self.assertGreater(stats['block_cache.hits'], stats['block_cache.misses'])
+
+    def test_compaction_invalidates_cached_blocks(self):
+        '''
+        Tests that reads don't return values from cached blocks of a segment
+        that compaction has since rewritten.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.db_set('chris', 'lessard')
+        db.db_set('daniel', 'lessard')
+        db.flush()
+        self.assertEqual(db.db_get('chris'), 'lessard')
+
+        db.db_set('chris', 'martinez')
+        db.flush()
+
+        self.assertEqual(db.db_get('chris'), 'martinez')
+        self.assertEqual(db.search_segment('chris', db.segments[0]), None)
+        self.assertEqual(db.search_segment('daniel', db.segments[0]), 'lessard')
+
+    def test_scan_does_not_fill_block_cache(self):
+        '''
+        Tests that scans read segments without adding their blocks to the cache.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        for i in range(100):
+            db.db_set('key{:03}'.format(i), 'value')
+        db.flush()
+
+        self.assertEqual(len(list(db.scan('key050'))), 50)
+        self.assertEqual(db.stats()['block_cache.blocks'], 0)
+
+    # File handle cache
+    def test_segment_files_stay_open_between_reads(self):
+        '''
+        Tests that segment files are opened once, up to max_open_files.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.set_max_open_files(1)
+        for i in range(3):
+            db.db_set('key{}'.format(i), 'value{}'.format(i))
+            db.flush()
+
+        for _ in range(2):
+            for i in range(3):
+                db.search_segment('key{}'.format(i), db.segments[i])
+
+        stats = db.stats()
+        self.assertEqual(stats['file_handle_cache.open_files'], 1)
+        self.assertGreater(stats['file_handle_cache.hits'], 0)
+
+    def test_scan_survives_compaction(self):
+        '''
+        Tests that a scan keeps reading the segments it started with after
+        compaction replaces them.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        for i in range(100):
+            db.db_set('key{:03}'.format(i), 'old')
+        db.flush()
+
+        scan = db.scan()
+        self.assertEqual(next(scan), ('key000', 'old'))
+
+        for i in range(100):
+            db.db_set('key{:03}'.format(i), 'new')
+        db.flush()
+
+        self.assertEqual(len(list(scan)), 99)
+        self.assertEqual(db.db_get('key050'), 'new')
+
+    # Row cache
+    def test_db_get_serves_repeated_reads_from_row_cache(self):
+        '''
+        Tests that values and absent keys read from disk are cached.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.set_row_cache_capacity(10000)
+        db.db_set('chris', 'lessard')
+        db.flush()
+
+        for _ in range(3):
+            self.assertEqual(db.db_get('chris'), 'lessard')
+            self.assertIsNone(db.db_get('daniel'))
+
+        stats = db.stats()
+        self.assertEqual(stats['row_cache.hits'], 4)
+        self.assertEqual(stats['row_cache.rows'], 2)
+
+    def test_db_set_invalidates_row_cache(self):
+        '''
+        Tests that reads see writes to keys that are in the row cache.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.set_row_cache_capacity(10000)
+        db.db_set('chris', 'lessard')
+        db.flush()
+
+        self.assertEqual(db.db_get('chris'), 'lessard')
+        self.assertIsNone(db.db_get('daniel'))
+        db.db_set('chris', 'martinez')
+        db.db_set('daniel', 'lessard')
+
+        self.assertEqual(db.db_get('chris'), 'martinez')
+        self.assertEqual(db.db_get('daniel'), 'lessard')
+
+    # Negative cache
+    def test_repeated_misses_skip_the_filter_and_disk(self):
+        '''
+        Tests that a key the filter wrongly lets through is only searched for
+        on disk once, until it is written.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.db_set('chris', 'lessard')
+        db.flush()
+        db.bloom_filter.add('daniel')
+
+        for _ in range(3):
+            self.assertIsNone(db.db_get('daniel'))
+
+        stats = db.stats()
+        self.assertEqual(stats['filter.bloom.false_positives'], 1)
+        self.assertEqual(stats['negative_cache.hits'], 2)
+
+        db.db_set('daniel', 'lessard')
+        db.flush()
+        self.assertEqual(db.db_get('daniel'), 'lessard')
+
+    # Manifest
+    def test_segments_are_restored_without_save_metadata(self):
+        '''
+        Tests that segments flushed before a crash, without a clean shutdown,
+        are restored from the manifest along with their filter keys.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.save_metadata()
+        db.db_set('chris', 'lessard')
+        db.flush()
+        db.db_set('daniel', 'lessard')
+        db.flush()
+        segments = db.segments
+        del db
+
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+
+        self.assertEqual(db.segments, segments)
+        self.assertEqual(db.current_segment, 'test_file-3')
+        db.filters_ready.wait()
+        self.assertTrue(db.bloom_filter.check('chris'))
+        self.assertEqual(db.db_get('daniel'), 'lessard')
+
+    def test_merged_segments_are_removed_from_manifest(self):
+        '''
+        Tests that a segment merged away isn't restored.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.db_set('chris', 'lessard')
+        db.flush()
+        db.db_set('daniel', 'lessard')
+        db.flush()
+        db.merge(*db.segments)
+        del db
+
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+
+        self.assertEqual(db.segments, ['test_file-1'])
+        self.assertEqual(db.db_get('daniel'), 'lessard')
+
+    def test_merge_since_checkpoint_reaches_reloaded_bloom_filter(self):
+        '''
+        Tests that the keys merged into a segment after the last checkpoint are
+        added to the saved bloom filter when the DB is opened again.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.memtable_wal().clear()
+        db.db_set('a', '1')
+        db.flush()
+        db.save_metadata()
+        db.db_set('b', '2')
+        db.flush()
+        db.merge(*db.segments)
+        del db
+
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        self.assertTrue(db.filters_ready.wait(10))
+        self.assertEqual(db.db_get('a'), '1')
+        self.assertEqual(db.db_get('b'), '2')
+
+    def test_index_is_loaded_on_first_use(self):
+        '''
+        Tests that the index restored from the manifest is only built when it is
+        first used.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.memtable_wal().clear()
+        db.set_threshold(1000)
+        db.set_sparsity_factor(100)
+        for i in range(10):
+            db.db_set('key{}'.format(i), 'value{}'.format(i))
+        db.flush()
+        db.save_metadata()
+        del db
+
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+
+        self.assertIsNotNone(db.unloaded_index_entries)
+        self.assertEqual(db.db_get('key3'), 'value3')
+        self.assertIsNone(db.unloaded_index_entries)
+        self.assertTrue(db.index.contains('key9'))
+
+    def test_snapshot_keeps_unloaded_index(self):
+        '''
+        Tests that saving metadata before the index is used keeps its entries.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.memtable_wal().clear()
+        db.set_threshold(1000)
+        db.set_sparsity_factor(100)
+        for i in range(10):
+            db.db_set('key{}'.format(i), 'value{}'.format(i))
+        db.flush()
+        db.save_metadata()
+        del db
+
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.save_metadata()
+        del db
+
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        self.assertTrue(db.index.contains('key9'))
+
+    def test_startup_timings_are_reported(self):
+        '''
+        Tests that the time spent opening the database is part of its stats.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.db_set('chris', 'lessard')
+        db.flush()
+        db.save_metadata()
+        del db
+
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        stats = db.stats()
+
+        for name in ('startup.manifest_ms', 'startup.filters_ms', 'startup.memtable_ms', 'startup.total_ms'):
+            self.assertGreaterEqual(stats[name], 0)
+
+    def test_restore_memtable_keeps_latest_value(self):
+        '''
+        Tests that replaying the write ahead log keeps the last value of each key.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.memtable_wal().clear()
+        db.db_set('chris', 'lessard')
+        db.db_set('chris', 'martin')
+        del db
+
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        self.assertEqual(db.db_get('chris'), 'martin')
+        self.assertEqual(db.memtable.total_bytes, len('chris') + len('martin'))
+
+    def test_legacy_metadata_is_moved_to_manifest(self):
+        '''
+        Tests that metadata saved before the manifest existed is loaded and
+        checkpointed into a manifest.
+        '''
+        index = RedBlackTree()
+        index.add('john', offset=5, segment='segment-1')
+        with open(TEST_BASEPATH + 'database_metadata', 'wb') as s:
+            pickle.dump({
+                'current_segment': 'segment-2',
+                'segments': ['segment-1'],
+                'bf_num_items': 100,
+                'bf_false_pos': 0.5,
+                'index': index,
+            }, s)
+
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+
+        self.assertEqual(db.segments, ['segment-1'])
+        self.assertTrue(db.index.contains('john'))
+        self.assertTrue(os.path.exists(TEST_BASEPATH + 'MANIFEST'))
+        self.assertFalse(os.path.exists(TEST_BASEPATH + 'database_metadata'))
+
+    def test_snapshot_hides_later_writes(self):
+        '''
+        Tests that reads through a snapshot don't see the writes made after it.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.memtable_wal().clear()
+        db.db_set('chris', 'lessard')
+        snapshot = db.snapshot()
+        db.db_set('chris', 'martin')
+        db.db_set('john', 'smith')
+
+        self.assertEqual(db.db_get('chris', snapshot), 'lessard')
+        self.assertIsNone(db.db_get('john', snapshot))
+        self.assertEqual(db.db_get_many(['chris', 'john'], snapshot), ['lessard', None])
+        self.assertEqual(db.db_get('chris'), 'martin')
+        self.assertEqual(db.stats()['snapshots'], 1)
+
+        db.release_snapshot(snapshot)
+        self.assertEqual(db.stats()['snapshots'], 0)
+
+    def test_overwrites_keep_no_history_without_snapshots(self):
+        '''
+        Tests that older values are only kept while a snapshot sees them.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.memtable_wal().clear()
+        db.db_set('chris', 'lessard')
+        db.db_set('chris', 'martin')
+        self.assertIsNone(db.memtable.find_node('chris').history)
+
+        with db.snapshot():
+            db.db_set('chris', 'evans')
+            db.db_set('chris', 'pratt')
+            self.assertEqual(db.memtable.find_node('chris').history, [(2, 'martin')])
+
+        db.db_set('chris', 'pine')
+        self.assertIsNone(db.memtable.find_node('chris').history)
+
+    def test_snapshot_survives_flush_and_compaction(self):
+        '''
+        Tests that compaction keeps the records a snapshot still sees on disk, and
+        deletes them once the snapshot is released.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.memtable_wal().clear()
+        db.db_set('chris', 'lessard')
+        db.db_set('john', 'smith')
+        db.flush()
+        first_segment = db.segments[0]
+
+        snapshot = db.snapshot()
+        db.db_set('chris', 'martin')
+        db.flush()
+
+        self.assertEqual(db.db_get('chris', snapshot), 'lessard')
+        self.assertEqual(db.db_get('chris'), 'martin')
+        self.assertEqual(list(db.scan(snapshot=snapshot)), [('chris', 'lessard'), ('john', 'smith')])
+        self.assertEqual(list(db.scan()), [('chris', 'martin'), ('john', 'smith')])
+
+        db.release_snapshot(snapshot)
+        with open(TEST_BASEPATH + first_segment, 'r') as s:
+            self.assertEqual(s.readlines(), ['john,smith\n'])
+        self.assertEqual(db.db_get('chris'), 'martin')
+        self.assertEqual(db.deferred_deletions, [])
+
+    def test_deferred_deletions_are_applied_after_restart(self):
+        '''
+        Tests that the records compaction kept for a snapshot are deleted when the
+        DB is opened again, if it stopped before the snapshot was released.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.memtable_wal().clear()
+        db.db_set('chris', 'lessard')
+        db.db_set('john', 'smith')
+        db.flush()
+        first_segment = db.segments[0]
+
+        db.snapshot()
+        db.db_set('chris', 'martin')
+        db.flush()
+        del db
+
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        with open(TEST_BASEPATH + first_segment, 'r') as s:
+            self.assertEqual(s.readlines(), ['john,smith\n'])
+        self.assertEqual(db.deferred_deletions, [])
+        self.assertEqual(db.db_get('chris'), 'martin')
+
+    def test_checkpoint_links_segments_and_opens_as_db(self):
+        '''
+        Tests that a checkpoint holds the flushed memtable and links the segments,
+        and that a DB opened from it isn't affected by later writes.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.memtable_wal().clear()
+        db.db_set('chris', 'lessard')
+        db.flush()
+        db.db_set('john', 'smith')
+
+        with tempfile.TemporaryDirectory() as directory:
+            checkpoint = os.path.join(directory, 'checkpoint/')
+            report = db.checkpoint(checkpoint)
+            self.assertEqual(report['segments'], 2)
+            self.assertEqual(db.memtable.count, 0)
+
+            segment = db.segments[0]
+            self.assertEqual(
+                os.stat(TEST_BASEPATH + segment).st_ino, os.stat(checkpoint + segment).st_ino)
+
+            # Compaction replaces the segment, leaving the checkpoint's link alone
+            db.db_set('chris', 'martin')
+            db.flush()
+
+            restored = LSMTree(TEST_FILENAME, checkpoint, BKUP_NAME)
+            self.assertEqual(restored.db_get('chris'), 'lessard')
+            self.assertEqual(restored.db_get('john'), 'smith')
+            self.assertEqual(restored.segments, db.segments[:2])
+            self.assertEqual(db.db_get('chris'), 'martin')
+
+            with self.assertRaises(ValueError):
+                db.checkpoint(checkpoint)
+
+    def test_checkpoint_waits_for_memtables_being_flushed(self):
+        '''
+        Tests that with an empty memtable, a checkpoint still waits for the memtables
+        frozen before it to reach disk, and holds them.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.memtable_wal().clear()
+        db.db_set('chris', 'lessard')
+        with db.write_lock:
+            frozen = db.rotate_memtable()
+
+        with tempfile.TemporaryDirectory() as directory:
+            checkpoint = os.path.join(directory, 'checkpoint/')
+            reports = []
+            thread = threading.Thread(target=lambda: reports.append(db.checkpoint(checkpoint)))
+            thread.start()
+            thread.join(0.2)
+            self.assertTrue(thread.is_alive())
+
+            db.flush_immutable_memtable(*frozen)
+            thread.join()
+            self.assertEqual(reports[0]['segments'], 1)
+            self.assertEqual(LSMTree(TEST_FILENAME, checkpoint, BKUP_NAME).db_get('chris'), 'lessard')
+
+    def test_expired_values_read_as_absent(self):
+        '''
+        Tests that values read as absent once their TTL has passed.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.memtable_wal().clear()
+        db.db_set('chris', 'lessard', ttl=60)
+        db.db_set('john', 'smith', expires_at=now_ms() - 4000)
+
+        self.assertEqual(db.db_get('chris'), 'lessard')
+        self.assertIsNone(db.db_get('john'))
+        self.assertEqual(db.db_get_many(['chris', 'john']), ['lessard', None])
+        self.assertEqual(list(db.scan()), [('chris', 'lessard')])
+        self.assertTrue(list(db.scan(with_expiry=True))[0][1].startswith('lessard\x1f'))
+
+        with self.assertRaises(ValueError):
+            db.db_set('chris', 'lessard', ttl=0)
+
+    def test_values_cannot_pass_for_expiry_times(self):
+        '''
+        Tests that values holding the expiry separator are rejected rather than
+        read as expiring, and that expiry times can be given directly.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.memtable_wal().clear()
+        with self.assertRaises(ValueError):
+            db.db_set('chris', 'lessard' + EXPIRY_SEPARATOR + '1000')
+        with self.assertRaises(ValueError):
+            db.db_set('chris', 'lessard', ttl=60, expires_at=now_ms() + 60000)
+        self.assertIsNone(db.db_get('chris'))
+
+        db.db_set('chris', 'lessard', expires_at=now_ms() + 60000)
+        db.db_set('john', 'smith', expires_at=now_ms() - 1000)
+        self.assertEqual(db.db_get('chris'), 'lessard')
+        self.assertIsNone(db.db_get('john'))
+
+    def test_flush_drops_expired_records_and_records_expiry_range(self):
+        '''
+        Tests that expired records aren't flushed, and that the expiry range of
+        the segment is kept in the manifest.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.memtable_wal().clear()
+        db.db_set('chris', 'lessard', ttl=60)
+        db.db_set('john', 'smith', expires_at=now_ms() - 4000)
+        db.db_set('peter', 'parker')
+        db.flush()
+
+        segment = db.segments[0]
+        with open(TEST_BASEPATH + segment, 'r') as s:
+            self.assertEqual([line.split(',')[0] for line in s], ['chris', 'peter'])
+        self.assertEqual(db.stats()['expiry.dropped_records'], 1)
+        self.assertFalse(db.segment_expiries[segment][2])
+        expiry = db.segment_expiries[segment]
+        del db
+
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        self.assertEqual(db.segment_expiries, {segment: expiry})
+
+    def test_compaction_drops_segments_that_have_expired(self):
+        '''
+        Tests that compaction drops a segment once every record of it has expired.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.memtable_wal().clear()
+        db.db_set('chris', 'lessard', ttl=60)
+        db.db_set('john', 'smith', ttl=60)
+        db.flush()
+        segment = db.segments[0]
+
+        db.segment_expiries[segment] = (now_ms() - 2000, now_ms() - 1000, True)
+        db.compact()
+
+        self.assertEqual(db.segments, [])
+        self.assertFalse(os.path.exists(TEST_BASEPATH + segment))
+        self.assertEqual(db.stats()['expiry.dropped_segments'], 1)
+
+    def test_compaction_drops_expired_records(self):
+        '''
+        Tests that compaction rewrites segments to drop their expired records
+        once enough of them have expired.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.memtable_wal().clear()
+        db.db_set('chris', 'lessard', ttl=1)
+        db.db_set('john', 'smith', ttl=60)
+        db.flush()
+        segment = db.segments[0]
+        first, last, _ = db.segment_expiries[segment]
+
+        later = first + 1000
+        self.assertEqual(db.segments_with_expired_records([segment], later), ([], []))
+        later = first + (last - first) // 2 + 1000
+        self.assertEqual(db.segments_with_expired_records([segment], later), ([], [segment]))
+
+        db.delete_keys_from_segments(set(), [segment], [segment], later)
+        with open(TEST_BASEPATH + segment, 'r') as s:
+            self.assertEqual([line.split(',')[0] for line in s], ['john'])
+        self.assertEqual(db.segment_expiries[segment], (last, last, True))
+        self.assertEqual(db.segments_with_expired_records([segment], last), ([segment], []))
+
+    def test_scan_through_snapshot(self):
+        '''
+        Tests that scans through a snapshot see the memtable as it was.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.memtable_wal().clear()
+        db.db_set('a', '1')
+        db.db_set('b', '2')
+
+        with db.snapshot() as snapshot:
+            db.db_set('a', '3')
+            db.db_set('c', '4')
+
+            self.assertEqual(list(db.scan(snapshot=snapshot)), [('a', '1'), ('b', '2')])
+            self.assertEqual(list(db.scan('b', snapshot=snapshot)), [('b', '2')])
+        self.assertEqual(list(db.scan()), [('a', '3'), ('b', '2'), ('c', '4')])
+
+    def test_merge_is_deferred_for_snapshot(self):
+        '''
+        Tests that segments aren't merged while a snapshot sees only the first.
+        '''
+        segments = ['test_file-1', 'test_file-2']
+        with open(TEST_BASEPATH + segments[0], 'w') as s:
+            s.write('1,test1\n')
+        with open(TEST_BASEPATH + segments[1], 'w') as s:
+            s.write('1,test2\n')
+
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.segments = segments[:1]
+        snapshot = db.snapshot()
+        db.segments = segments[:]
+
+        self.assertIsNone(db.merge(*segments))
+        self.assertEqual(db.segments, segments)
+
+        db.release_snapshot(snapshot)
+        self.assertEqual(db.merge(*segments), segments[0])
+        self.assertEqual(db.segments, segments[:1])
+
+
+    def test_flush_moves_large_values_to_value_log(self):
+        '''
+        Tests that large values are flushed to the value log, leaving pointers in
+        the segment, and read back through them, after a restart too.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.memtable_wal().clear()
+        db.set_value_separation_threshold(10)
+        db.db_set('chris', 'lessard' * 10)
+        db.db_set('john', 'smith')
+        db.db_set('mark', 'zuckerberg' * 10, ttl=60)
+        db.flush()
+
+        with open(TEST_BASEPATH + db.segments[0], 'r') as s:
+            records = dict(line.rstrip('\n').split(',', 1) for line in s)
+        self.assertTrue(records['chris'].startswith('\x1a'))
+        self.assertEqual(records['john'], 'smith')
+        self.assertEqual(db.stats()['value_log.separated_values'], 2)
+
+        self.assertEqual(db.db_get('chris'), 'lessard' * 10)
+        self.assertEqual(db.db_get('mark'), 'zuckerberg' * 10)
+        self.assertEqual(list(db.scan()), [
+            ('chris', 'lessard' * 10), ('john', 'smith'), ('mark', 'zuckerberg' * 10)])
+
+        db.save_metadata()
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        self.assertEqual(db.db_get('chris'), 'lessard' * 10)
+        self.assertEqual(db.db_get('mark'), 'zuckerberg' * 10)
+
+    def test_values_cannot_pass_for_value_pointers(self):
+        '''
+        Tests that values starting like pointers to the value log are rejected, and
+        that values are only read as pointers once the value log is used.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.memtable_wal().clear()
+        with self.assertRaises(ValueError):
+            db.db_set('chris', '\x1ahello')
+        self.assertIsNone(db.db_get('chris'))
+        self.assertEqual(db.resolve_value('\x1a1:0:10'), '\x1a1:0:10')
+
+        db.db_set('chris', 'hello\x1a')
+        db.flush()
+        self.assertEqual(db.db_get('chris'), 'hello\x1a')
+
+    def test_merge_copies_value_pointers(self):
+        '''
+        Tests that merging segments copies the pointers, not the values.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.memtable_wal().clear()
+        db.set_value_separation_threshold(10)
+        db.db_set('chris', 'lessard' * 10)
+        db.flush()
+        db.db_set('john', 'smith' * 10)
+        db.flush()
+        vlog_size = db.value_log.disk_size()
+
+        segment = db.merge(*db.segments)
+        self.assertEqual(db.value_log.disk_size(), vlog_size)
+        self.assertLess(os.path.getsize(TEST_BASEPATH + segment), 100)
+        self.assertEqual(db.db_get('chris'), 'lessard' * 10)
+        self.assertEqual(db.db_get('john'), 'smith' * 10)
+
+    def test_collect_value_log_rewrites_live_values(self):
+        '''
+        Tests that garbage collection moves the live values out of a file that is
+        mostly garbage, and deletes it on the next run.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.memtable_wal().clear()
+        db.set_value_separation_threshold(10)
+        for i in range(10):
+            db.db_set('key{}'.format(i), 'old{}'.format(i) * 10)
+        db.flush()
+        first = db.value_log.current
+        db.value_log.seal()
+
+        for i in range(8):
+            db.db_set('key{}'.format(i), 'new{}'.format(i) * 10)
+        db.flush()
+
+        self.assertGreater(db.collect_value_log(), 0)
+        self.assertEqual(db.collected_value_logs, [first])
+        for i in range(10):
+            self.assertEqual(db.db_get('key{}'.format(i)), '{}{}'.format('new' if i < 8 else 'old', i) * 10)
+
+        db.collect_value_log()
+        self.assertNotIn(first, db.value_log.file_numbers())
+        self.assertEqual(db.db_get('key9'), 'old9' * 10)
+
+    def test_collect_value_log_leaves_read_statistics_alone(self):
+        '''
+        Tests that the lookups of garbage collection aren't counted as reads.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.memtable_wal().clear()
+        db.set_value_separation_threshold(10)
+        for i in range(10):
+            db.db_set('key{}'.format(i), 'old{}'.format(i) * 10)
+        db.flush()
+        db.value_log.seal()
+        for i in range(8):
+            db.db_set('key{}'.format(i), 'new{}'.format(i) * 10)
+        db.flush()
+
+        probes = db.io_counters['segment_probes']
+        filter_counters = {name: dict(counters) for name, counters in db.filter_counters.items()}
+        negative_cache = db.negative_cache.stats()
+
+        self.assertGreater(db.collect_value_log(), 0)
+        self.assertEqual(db.io_counters['segment_probes'], probes)
+        self.assertEqual(db.io_counters['reads'], 0)
+        self.assertEqual({name: dict(counters) for name, counters in db.filter_counters.items()}, filter_counters)
+        self.assertEqual(db.negative_cache.stats(), negative_cache)
+
+    def test_close_stops_value_log_garbage_collection(self):
+        '''
+        Tests that a single garbage collection thread runs however often value
+        separation is turned on, and that closing the DB stops it and closes the
+        files of the value log.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.memtable_wal().clear()
+        db.set_value_separation_threshold(10)
+        thread = db.value_log_gc_thread
+        db.set_value_separation_threshold(20)
+        self.assertIs(db.value_log_gc_thread, thread)
+
+        db.db_set('chris', 'lessard' * 10)
+        db.flush()
+        self.assertEqual(db.db_get('chris'), 'lessard' * 10)
+
+        db.close()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertIsNone(db.value_log_gc_thread)
+        self.assertIsNone(db.value_log.stream)
+        self.assertEqual(db.value_log.readers, {})
+
+        db.set_value_separation_threshold(10)
+        self.assertIsNone(db.value_log_gc_thread)
+
+    def test_collect_value_log_waits_for_snapshots(self):
+        '''
+        Tests that nothing is collected while a snapshot is live.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.memtable_wal().clear()
+        db.set_value_separation_threshold(10)
+        db.db_set('chris', 'lessard' * 10)
+        db.flush()
+        db.value_log.seal()
+
+        with db.snapshot() as snapshot:
+            db.db_set('chris', 'hemsworth')
+            db.flush()
+            self.assertEqual(db.collect_value_log(), 0)
+            self.assertEqual(db.db_get('chris', snapshot), 'lessard' * 10)
+        self.assertGreater(db.collect_value_log(), 0)
+
+
+    def test_amplification_counts_bytes_written(self):
+        '''
+        Tests that the bytes written by users, the write ahead log, flushes,
+        compactions and merges are counted.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.memtable_wal().clear()
+        db.db_set('chris', 'lessard')
+        db.db_set('john', 'smith')
+        db.flush()
+        db.db_set('chris', 'hemsworth')
+        db.flush()
+
+        amplification = db.amplification()
+        self.assertEqual(amplification['user_bytes'], 35)
+        self.assertGreater(amplification['wal_bytes'], 30)
+        self.assertEqual(amplification['flush_bytes'], len('chris,lessard\njohn,smith\nchris,hemsworth\n'))
+        self.assertEqual(amplification['compaction_bytes'], len('john,smith\n'))
+        self.assertEqual(amplification['merge_bytes'], 0)
+
+        segment = db.merge(*db.segments)
+        amplification = db.amplification()
+        self.assertEqual(amplification['merge_bytes'], os.path.getsize(TEST_BASEPATH + segment))
+        written = sum(amplification[name] for name in (
+            'wal_bytes', 'flush_bytes', 'compaction_bytes', 'merge_bytes'))
+        self.assertEqual(amplification['write'], round(written / 35, 6))
+
+    def test_amplification_counts_segments_probed_per_read(self):
+        '''
+        Tests that read amplification counts the segments probed per lookup.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.memtable_wal().clear()
+        db.db_set('chris', 'lessard')
+        db.flush()
+        db.db_set('john', 'smith')
+        db.flush()
+        db.db_set('mark', 'zuckerberg')
+
+        db.db_get('mark')
+        self.assertEqual(db.amplification()['segment_probes'], 0)
+        db.db_get('chris')
+        db.db_get('john')
+
+        amplification = db.amplification()
+        self.assertEqual(amplification['reads'], 3)
+        self.assertGreaterEqual(amplification['segment_probes'], 2)
+        self.assertEqual(amplification['read'], round(amplification['segment_probes'] / 3, 6))
+
+    def test_space_amplification_compares_disk_with_live_records(self):
+        '''
+        Tests that space amplification is measured against the live records,
+        and only reported by stats when asked for.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.memtable_wal().clear()
+        db.db_set('chris', 'lessard')
+        db.flush()
+
+        amplification = db.amplification()
+        self.assertEqual(amplification['disk_bytes'], len('chris,lessard\n'))
+        self.assertEqual(amplification['live_bytes'], len('chris,lessard\n'))
+        self.assertEqual(amplification['space'], 1.0)
+        self.assertNotIn('amplification.space', db.stats())
+        self.assertEqual(db.stats(measure_space=True)['amplification.space'], 1.0)
+
+
+    def test_db_get_retries_a_miss_racing_with_compaction(self):
+        '''
+        Tests that a read that misses the memtable before a write, and the segment
+        after compaction drops the record the write replaced, is retried.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.memtable_wal().clear()
+        db.db_set('chris', 'lessard')
+        db.flush()
+
+        segments_get = db.segments_get
+        def write_and_compact(*args, **kwargs):
+            if db.memtable.find_node('chris') is None:
+                db.db_set('chris', 'martin')
+                db.compact()
+            return segments_get(*args, **kwargs)
+
+        with mock.patch.object(db, 'segments_get', side_effect=write_and_compact):
+            self.assertEqual(db.db_get('chris'), 'martin')
+
+    def test_compact_waits_for_flushes(self):
+        '''
+        Tests that a compaction started during a flush waits for it to finish.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.memtable_wal().clear()
+        db.db_set('chris', 'lessard')
+
+        with db.flush_lock:
+            compaction = threading.Thread(target=db.compact)
+            compaction.start()
+            compaction.join(0.2)
+            self.assertTrue(compaction.is_alive())
+        compaction.join()
+
+    def test_merge_waits_for_flushes(self):
+        '''
+        Tests that a merge started during a flush waits for it to finish.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.memtable_wal().clear()
+        db.db_set('chris', 'lessard')
+        db.flush()
+        db.db_set('john', 'smith')
+        db.flush()
+
+        with db.flush_lock:
+            merge = threading.Thread(target=db.merge, args=tuple(db.segments))
+            merge.start()
+            merge.join(0.2)
+            self.assertTrue(merge.is_alive())
+        merge.join()
+        self.assertEqual(len(db.segments), 1)
+        self.assertEqual(db.db_get('john'), 'smith')
+
+    def test_failed_flush_fails_later_flushes_instead_of_blocking(self):
+        '''
+        Tests that once a flush fails, its memtable stays readable and later
+        flushes raise rather than wait for it forever.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.memtable_wal().clear()
+        db.db_set('chris', 'lessard')
+        with mock.patch.object(db, 'flush_memtable_to_disk', side_effect=OSError('disk full')):
+            with self.assertRaises(OSError):
+                db.flush()
+
+        self.assertEqual(db.db_get('chris'), 'lessard')
+        db.db_set('john', 'smith')
+        with self.assertRaises(FlushFailedError):
+            db.flush()
+        with self.assertRaises(FlushFailedError):
+            db.flush()
+        self.assertEqual(db.db_get('john'), 'smith')
+
+    def test_failed_filter_catch_up_rebuilds_bloom_filter(self):
+        '''
+        Tests that keys on disk are still found when catching the bloom filter up
+        at startup fails, as the filter is rebuilt instead.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.memtable_wal().clear()
+        db.save_metadata()
+        db.db_set('a', '1')
+        db.db_set('c', '2')
+        db.flush()
+        del db
+
+        with mock.patch.object(LSMTree, 'add_segments_to_bloom_filter', side_effect=OSError):
+            db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+            db.filters_settled.wait()
+
+        self.assertTrue(db.filters_ready.is_set())
+        self.assertEqual(db.db_get('a'), '1')
+        self.assertEqual(db.db_get('c'), '2')
+
+    def test_failed_filter_rebuild_keeps_filter_out_of_reads(self):
+        '''
+        Tests that a bloom filter that can't be brought up to date lets every key
+        through and is never saved.
+        '''
+        db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+        db.memtable_wal().clear()
+        db.save_metadata()
+        db.db_set('a', '1')
+        db.db_set('c', '2')
+        db.flush()
+        del db
+
+        with mock.patch.object(LSMTree, 'add_segments_to_bloom_filter', side_effect=OSError), \
+                mock.patch.object(LSMTree, 'rebuild_bloom_filter', side_effect=OSError):
+            db = LSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME)
+            db.filters_settled.wait()
+
+        self.assertFalse(db.filters_ready.is_set())
+        self.assertEqual(db.db_get('a'), '1')
+        self.assertEqual(db.db_get('c'), '2')
+
+        db.save_metadata()
+        self.assertFalse(Path(db.bloom_filter_path()).exists())
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,81 @@
+import unittest
+import os
+import tempfile
+from src.manifest import Manifest
+
+class ManifestTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'MANIFEST')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_replay_returns_snapshot_and_edits_in_order(self):
+        '''
+        Tests that the records appended since the last checkpoint are replayed
+        after its snapshot.
+        '''
+        manifest = Manifest(self.path)
+        manifest.append({'op': 'add_segment', 'segment': 'old'})
+        manifest.checkpoint({'op': 'snapshot', 'segments': []})
+        manifest.append({'op': 'add_segment', 'segment': 'segment-1'})
+
+        records, torn = Manifest(self.path).replay()
+
+        self.assertEqual(records, [
+            {'op': 'snapshot', 'segments': []},
+            {'op': 'add_segment', 'segment': 'segment-1'},
+        ])
+        self.assertFalse(torn)
+
+    def test_replay_stops_at_torn_record(self):
+        '''
+        Tests that a record cut short by a crash is detected and ignored.
+        '''
+        manifest = Manifest(self.path)
+        manifest.checkpoint({'op': 'snapshot', 'segments': []})
+        manifest.append({'op': 'add_segment', 'segment': 'segment-1'})
+        with open(self.path, 'ab') as s:
+            s.write(b'0badc0de {"op":"add_seg')
+
+        records, torn = Manifest(self.path).replay()
+
+        self.assertEqual(len(records), 2)
+        self.assertTrue(torn)
+
+    def test_replay_cuts_off_torn_record(self):
+        '''
+        Tests that records appended after replaying a torn manifest follow the
+        valid records.
+        '''
+        manifest = Manifest(self.path)
+        manifest.checkpoint({'op': 'snapshot', 'segments': []})
+        with open(self.path, 'ab') as s:
+            s.write(b'0badc0de {"op":"add_seg')
+
+        manifest = Manifest(self.path)
+        manifest.replay()
+        manifest.append({'op': 'add_segment', 'segment': 'segment-1'})
+        records, torn = Manifest(self.path).replay()
+
+        self.assertEqual(records, [
+            {'op': 'snapshot', 'segments': []},
+            {'op': 'add_segment', 'segment': 'segment-1'},
+        ])
+        self.assertFalse(torn)
+
+    def test_needs_checkpoint_after_many_edits(self):
+        '''
+        Tests that the manifest asks for a checkpoint once it holds enough edits.
+        '''
+        manifest = Manifest(self.path)
+        manifest.checkpoint({'op': 'snapshot'})
+        for i in range(64):
+            self.assertFalse(manifest.needs_checkpoint())
+            manifest.append({'op': 'set', 'name': 'threshold', 'value': i})
+
+        self.assertTrue(manifest.needs_checkpoint())
+
+if __name__ == '__main__':
+    unittest.main()
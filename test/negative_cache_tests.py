@@ -0,0 +1,42 @@
+import unittest
+from src.negative_cache import NegativeCache
+
+class NegativeCacheTests(unittest.TestCase):
+    def test_contains_added_keys(self):
+        '''
+        Tests that keys added to the cache are known to be absent.
+        '''
+        cache = NegativeCache()
+        cache.add('chris', cache.stamp('chris'))
+
+        self.assertTrue(cache.contains('chris'))
+        self.assertFalse(cache.contains('daniel'))
+        self.assertEqual(cache.stats()['hits'], 1)
+
+    def test_invalidate_forgets_key(self):
+        '''
+        Tests that a written key is no longer known to be absent, even if its
+        miss is recorded after the write.
+        '''
+        cache = NegativeCache()
+        cache.add('chris', cache.stamp('chris'))
+        stamp = cache.stamp('chris')
+        cache.invalidate('chris')
+        self.assertFalse(cache.contains('chris'))
+
+        cache.add('chris', stamp)
+        self.assertFalse(cache.contains('chris'))
+
+    def test_least_recently_used_keys_are_dropped(self):
+        '''
+        Tests that the cache holds at most max_keys keys.
+        '''
+        cache = NegativeCache(2)
+        for key in ('a', 'b', 'c'):
+            cache.add(key, cache.stamp(key))
+
+        self.assertFalse(cache.contains('a'))
+        self.assertTrue(cache.contains('c'))
+
+if __name__ == '__main__':
+    unittest.main()
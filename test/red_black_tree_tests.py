@@ -2181,6 +2181,40 @@ class RbTreeTests(unittest.TestCase):
         for i in range(20, 50):
             self.assertEqual(rb_tree.floor(i), 20)
 
+    def test_from_sorted_builds_valid_tree(self):
+        '''
+        Tests that trees built from sorted items keep the red black properties,
+        and can still be added to and removed from.
+        '''
+        def black_height(node):
+            if node.color == NIL:
+                return 1
+            if node.color == RED:
+                self.assertEqual(node.left.color != RED and node.right.color != RED, True)
+            if node.left.color != NIL:
+                self.assertIs(node.left.parent, node)
+            if node.right.color != NIL:
+                self.assertIs(node.right.parent, node)
+
+            left, right = black_height(node.left), black_height(node.right)
+            self.assertEqual(left, right)
+            return left + (node.color == BLACK)
+
+        for count in range(65):
+            tree = RedBlackTree.from_sorted([(i, str(i)) for i in range(count)])
+
+            self.assertEqual(tree.count, count)
+            self.assertEqual([node.key for node in tree.in_order()], list(range(count)))
+            if count:
+                self.assertEqual(tree.root.color, BLACK)
+                black_height(tree.root)
+
+            tree.add(count, str(count))
+            tree.remove(0)
+            self.assertEqual(list(tree), list(range(1, count + 1)))
+            if count:
+                black_height(tree.root)
+
 
 # These tests take the bulk of the time for testing.
 class RbTreePerformanceTests(unittest.TestCase):
@@ -0,0 +1,161 @@
+import unittest
+import io
+from functools import partial
+import shutil
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+from src.client import LSMDbClient
+from src.lsm_tree import LSMTree
+from src.replication import Follower, ReplicationLog
+
+TEST_FILENAME = 'test_file-1'
+TEST_BASEPATH = 'test-replication/'
+BKUP_NAME = 'test_backup'
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def wait_for(condition, timeout=10):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError('Timed out')
+        time.sleep(0.05)
+
+class ReplicationLogTests(unittest.TestCase):
+    def setUp(self):
+        Path(TEST_BASEPATH).mkdir(exist_ok=True)
+        self.db = LSMTree(TEST_FILENAME, TEST_BASEPATH + 'leader/', BKUP_NAME)
+        self.log = ReplicationLog([self.db], buffer_size=3)
+
+    def tearDown(self):
+        self.log.close()
+        shutil.rmtree(TEST_BASEPATH)
+
+    def test_writes_are_numbered_in_order(self):
+        '''
+        Tests that every write gets the next position in the log.
+        '''
+        self.db.db_set('a', '1')
+        self.db.db_set('b', '2')
+        self.db.db_set('a', '3')
+
+        self.assertEqual(self.log.position, 3)
+        self.assertEqual(self.log.records_after(1, 0), [(2, 'b,2'), (3, 'a,3')])
+        self.assertEqual(self.log.records_after(3, 0), [])
+
+    def test_records_dropped_from_the_buffer_are_unavailable(self):
+        '''
+        Tests that a position older than the buffer can't be resumed from.
+        '''
+        for i in range(5):
+            self.db.db_set('key{}'.format(i), 'value')
+
+        self.assertIsNone(self.log.records_after(1, 0))
+        self.assertEqual(len(self.log.records_after(2, 0)), 3)
+
+    def test_follower_applies_snapshot_and_records(self):
+        '''
+        Tests that a follower that is new to the leader starts from a snapshot.
+        '''
+        for i in range(5):
+            self.db.db_set('key{}'.format(i), 'value{}'.format(i))
+
+        # Stop streaming once the first heartbeat is sent
+        self.log.close()
+        stream = io.BytesIO()
+        self.log.stream(stream, '-', 0, self.db.scan)
+
+        replica = LSMTree(TEST_FILENAME, TEST_BASEPATH + 'follower/', BKUP_NAME)
+        follower = Follower(replica, 'localhost:0')
+        for line in stream.getvalue().decode().splitlines(True):
+            follower.apply(line)
+
+        self.assertEqual(follower.log_id, self.log.log_id)
+        self.assertEqual(follower.applied, 5)
+        self.assertEqual(follower.lag(), 0)
+        for i in range(5):
+            self.assertEqual(replica.db_get('key{}'.format(i)), 'value{}'.format(i))
+
+    def test_follower_keeps_expiry_times(self):
+        '''
+        Tests that values replicated from the snapshot and the log expire when
+        they do on the leader.
+        '''
+        self.db.db_set('a', '1', ttl=60)
+        self.db.db_set('b', '2', expires_at=1000)
+
+        self.log.close()
+        stream = io.BytesIO()
+        self.log.stream(stream, '-', 0, partial(self.db.scan, with_expiry=True))
+
+        replica = LSMTree(TEST_FILENAME, TEST_BASEPATH + 'follower/', BKUP_NAME)
+        follower = Follower(replica, 'localhost:0')
+        for line in stream.getvalue().decode().splitlines(True):
+            follower.apply(line)
+
+        self.assertEqual(replica.db_get('a'), '1')
+        self.assertIsNone(replica.db_get('b'))
+        self.assertEqual(list(replica.scan(with_expiry=True)), list(self.db.scan(with_expiry=True)))
+
+class ReplicationServerTests(unittest.TestCase):
+    '''
+    Runs a leader and a follower as local server processes.
+    '''
+    def setUp(self):
+        Path(TEST_BASEPATH).mkdir(exist_ok=True)
+        self.servers = []
+        self.leader = self.start_node('leader')
+
+    def tearDown(self):
+        for server in self.servers:
+            server.kill()
+            server.wait()
+        shutil.rmtree(TEST_BASEPATH)
+
+    def start_node(self, name, *args):
+        port = free_port()
+        self.servers.append(subprocess.Popen(
+            [sys.executable, 'src/server.py', '-p', str(port), '-d', TEST_BASEPATH + name + '/', *args],
+            stdout=subprocess.DEVNULL))
+
+        # Wait for the server to accept connections
+        deadline = time.time() + 10
+        while True:
+            try:
+                return LSMDbClient('127.0.0.1', port)
+            except ConnectionRefusedError:
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.05)
+
+    def test_follower_catches_up_with_leader(self):
+        '''
+        Tests that writes made before and after a follower connects reach it.
+        '''
+        self.leader.set('before', '1')
+        follower = self.start_node('follower', '-r', '127.0.0.1:{}'.format(self.leader.port))
+        self.leader.set('after', '2')
+
+        wait_for(lambda: 'applied=2 ' in follower.status())
+        self.assertEqual(follower.get('before'), '1')
+        self.assertEqual(follower.get('after'), '2')
+        self.assertIn('lag=0', follower.status())
+        self.assertIn('followers=1', self.leader.status())
+
+    def test_follower_rejects_writes_until_promoted(self):
+        '''
+        Tests that only a promoted follower accepts writes.
+        '''
+        follower = self.start_node('follower', '-r', '127.0.0.1:{}'.format(self.leader.port))
+        self.assertTrue(follower.set('key', 'value').startswith('ERROR'))
+
+        follower.promote()
+        self.assertEqual(follower.set('key', 'value'), 'Wrote key=value')
+        self.assertTrue(follower.status().startswith('role=leader'))
+        self.assertEqual(follower.get('key'), 'value')
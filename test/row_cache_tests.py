@@ -0,0 +1,71 @@
+import unittest
+from src.row_cache import MISSING, ROW_OVERHEAD, FrequencySketch, RowCache
+
+class FrequencySketchTests(unittest.TestCase):
+    def test_estimate_counts_accesses(self):
+        '''
+        Tests that the sketch never underestimates how often a key was seen.
+        '''
+        sketch = FrequencySketch(64)
+        for _ in range(3):
+            sketch.increment('hot')
+        sketch.increment('cold')
+
+        self.assertGreaterEqual(sketch.estimate('hot'), 3)
+        self.assertGreaterEqual(sketch.estimate('cold'), 1)
+
+    def test_age_halves_counts(self):
+        '''
+        Tests that old accesses fade once the sample size is reached.
+        '''
+        sketch = FrequencySketch(16)
+        for _ in range(8):
+            sketch.increment('hot')
+        sketch.age()
+
+        self.assertEqual(sketch.estimate('hot'), 4)
+
+class RowCacheTests(unittest.TestCase):
+    def test_get_returns_cached_values_and_absent_keys(self):
+        '''
+        Tests that both values and absent keys are cached.
+        '''
+        cache = RowCache(1000)
+        cache.put('chris', 'lessard', cache.stamp('chris'))
+        cache.put('daniel', None, cache.stamp('daniel'))
+
+        self.assertEqual(cache.get('chris'), 'lessard')
+        self.assertIsNone(cache.get('daniel'))
+        self.assertIs(cache.get('steve'), MISSING)
+
+    def test_put_ignores_values_read_before_invalidation(self):
+        '''
+        Tests that a value read before a write to the key isn't cached.
+        '''
+        cache = RowCache(1000)
+        stamp = cache.stamp('chris')
+        cache.invalidate('chris')
+        cache.put('chris', 'lessard', stamp)
+
+        self.assertIs(cache.get('chris'), MISSING)
+
+    def test_cold_keys_do_not_evict_hot_keys(self):
+        '''
+        Tests that a full cache only admits keys read more often than the
+        key it would evict.
+        '''
+        cache = RowCache(2 * (ROW_OVERHEAD + 10))
+        for key in ('hot00', 'hot01'):
+            for _ in range(3):
+                cache.get(key)
+            cache.put(key, 'value', cache.stamp(key))
+
+        cache.get('cold0')
+        cache.put('cold0', 'value', cache.stamp('cold0'))
+
+        self.assertEqual(cache.get('hot00'), 'value')
+        self.assertIs(cache.get('cold0'), MISSING)
+        self.assertEqual(cache.stats()['rejections'], 1)
+
+if __name__ == '__main__':
+    unittest.main()
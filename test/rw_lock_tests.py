@@ -0,0 +1,55 @@
+import threading
+import unittest
+from src.rw_lock import RWLock
+
+class RWLockTests(unittest.TestCase):
+    def test_readers_share_the_lock(self):
+        '''
+        Tests that several readers can hold the lock at once.
+        '''
+        lock = RWLock()
+        with lock.read():
+            with lock.read():
+                self.assertEqual(lock.readers, 2)
+
+        self.assertEqual(lock.readers, 0)
+
+    def test_writer_excludes_readers(self):
+        '''
+        Tests that a reader waits for the writer to release the lock.
+        '''
+        lock = RWLock()
+        events = []
+
+        def read():
+            with lock.read():
+                events.append('read')
+
+        with lock.write():
+            reader = threading.Thread(target=read)
+            reader.start()
+            reader.join(timeout=0.1)
+            events.append('write')
+
+        reader.join()
+        self.assertEqual(events, ['write', 'read'])
+
+    def test_writer_waits_for_readers(self):
+        '''
+        Tests that a writer waits for readers to release the lock.
+        '''
+        lock = RWLock()
+        events = []
+
+        def write():
+            with lock.write():
+                events.append('write')
+
+        with lock.read():
+            writer = threading.Thread(target=write)
+            writer.start()
+            writer.join(timeout=0.1)
+            events.append('read')
+
+        writer.join()
+        self.assertEqual(events, ['read', 'write'])
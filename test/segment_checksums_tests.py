@@ -0,0 +1,73 @@
+import unittest
+import os
+import tempfile
+import zlib
+from src.block_cache import BLOCK_SIZE
+from src.segment_checksums import block_checksums, checksummed_size, checksums_path, load_checksums, write_checksums
+
+class SegmentChecksumsTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'segment-1')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write_segment(self, count):
+        with open(self.path, 'wb') as s:
+            for i in range(count):
+                s.write('key{:05},value{}\n'.format(i, i).encode())
+        with open(self.path, 'rb') as s:
+            return s.read()
+
+    def test_block_checksums_cover_records_of_each_block(self):
+        '''
+        Tests that each block's checksum covers the records that start within it.
+        '''
+        data = self.write_segment(1000)
+
+        checksums = block_checksums(data)
+
+        self.assertEqual(len(checksums), -(-len(data) // BLOCK_SIZE))
+        first_block_end = data.find(b'\n', BLOCK_SIZE - 1) + 1
+        self.assertEqual(checksums[0], zlib.crc32(data[:first_block_end]))
+
+    def test_write_and_load_checksums(self):
+        '''
+        Tests that saved checksums are loaded back for a segment of the same size.
+        '''
+        data = self.write_segment(1000)
+        write_checksums(self.path)
+
+        self.assertTrue(os.path.exists(checksums_path(self.path)))
+        self.assertEqual(list(load_checksums(self.path, len(data))), list(block_checksums(data)))
+
+    def test_load_checksums_of_another_size(self):
+        '''
+        Tests that checksums computed for another version of a segment are ignored.
+        '''
+        data = self.write_segment(1000)
+        write_checksums(self.path)
+
+        self.assertIsNone(load_checksums(self.path, len(data) + 1))
+        self.assertEqual(checksummed_size(self.path), len(data))
+
+    def test_load_missing_checksums(self):
+        '''
+        Tests that segments written without checksums have none.
+        '''
+        self.write_segment(10)
+        self.assertIsNone(load_checksums(self.path, 10))
+        self.assertIsNone(checksummed_size(self.path))
+
+    def test_checksums_of_empty_segment(self):
+        '''
+        Tests that an empty segment has no blocks to check.
+        '''
+        self.write_segment(0)
+        write_checksums(self.path)
+
+        self.assertEqual(list(load_checksums(self.path, 0)), [])
+
+if __name__ == '__main__':
+    unittest.main()
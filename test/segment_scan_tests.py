@@ -0,0 +1,83 @@
+import unittest
+import os
+import pickle
+import tempfile
+from src.segment_scan import SegmentSamples, scan_segment, scan_segments
+
+class SegmentScanTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write_segment(self, name, records):
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'w') as s:
+            for key, value in records:
+                s.write('{},{}\n'.format(key, value))
+        return path
+
+    def test_scan_segment_samples_every_sparsity_records(self):
+        '''
+        Tests that every sparsity-th record is sampled along with its offset.
+        '''
+        path = self.write_segment('segment-1', [('blue', '1'), ('green', '2'), ('red', '3'), ('white', '4')])
+
+        samples = scan_segment(path, 2)
+
+        self.assertEqual(list(samples), [('green', '2', 7), ('white', '4', 21)])
+        self.assertIsNone(samples.all_keys)
+
+    def test_scan_segment_returns_every_key(self):
+        '''
+        Tests that every key of the segment is returned when asked for.
+        '''
+        path = self.write_segment('segment-1', [('blue', '1'), ('green', '2'), ('red', '3')])
+
+        samples = scan_segment(path, 2, with_keys=True)
+
+        self.assertEqual(samples.all_keys, ['blue', 'green', 'red'])
+
+    def test_scan_segment_of_empty_segment(self):
+        '''
+        Tests that an empty segment has no samples.
+        '''
+        path = self.write_segment('segment-1', [])
+
+        samples = scan_segment(path, 2, with_keys=True)
+
+        self.assertEqual(list(samples), [])
+        self.assertEqual(samples.all_keys, [])
+
+    def test_samples_survive_pickling(self):
+        '''
+        Tests that samples sent back by worker processes are unchanged.
+        '''
+        samples = pickle.loads(pickle.dumps(SegmentSamples(['a', 'b'], ['1', ''], [0, 4], ['a', 'b'])))
+        self.assertEqual(list(samples), [('a', '1', 0), ('b', '', 4)])
+        self.assertEqual(samples.all_keys, ['a', 'b'])
+
+        samples = pickle.loads(pickle.dumps(SegmentSamples([], [], [], None)))
+        self.assertEqual(list(samples), [])
+        self.assertIsNone(samples.all_keys)
+
+    def test_scan_segments_in_processes_keeps_order(self):
+        '''
+        Tests that segments scanned by several processes come back in order,
+        with the same samples as when scanned in this process.
+        '''
+        paths = [
+            self.write_segment('segment-{}'.format(i), [('key{}-{}'.format(i, j), str(j)) for j in range(10)])
+            for i in range(4)
+        ]
+
+        in_processes = scan_segments(paths, 3, with_keys=True, processes=2)
+        inline = scan_segments(paths, 3, with_keys=True, processes=1)
+
+        self.assertEqual([list(samples) for samples in in_processes], [list(samples) for samples in inline])
+        self.assertEqual([samples.all_keys for samples in in_processes], [samples.all_keys for samples in inline])
+        self.assertEqual(in_processes[2].keys, ['key2-2', 'key2-5', 'key2-8'])
+
+if __name__ == '__main__':
+    unittest.main()
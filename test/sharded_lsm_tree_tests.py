@@ -0,0 +1,149 @@
+import unittest
+import shutil
+import tempfile
+from pathlib import Path
+from src.checkpoint import restore_checkpoint
+from src.sharded_lsm_tree import ShardedLSMTree
+
+TEST_FILENAME = 'test_file-1'
+TEST_BASEPATH = 'test-shards/'
+BKUP_NAME = 'test_backup'
+NUM_SHARDS = 4
+
+class ShardedLSMTreeTests(unittest.TestCase):
+    def tearDown(self):
+        if Path(TEST_BASEPATH).exists():
+            shutil.rmtree(TEST_BASEPATH)
+
+    def test_init_creates_a_directory_per_shard(self):
+        '''
+        Tests that every shard is stored in its own directory.
+        '''
+        db = ShardedLSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME, NUM_SHARDS)
+
+        self.assertEqual(len(db.shards), NUM_SHARDS)
+        for number, shard in enumerate(db.shards):
+            self.assertEqual(shard.segments_directory, TEST_BASEPATH + 'shard-{}/'.format(number))
+            self.assertTrue(Path(shard.segments_directory).is_dir())
+
+    def test_close_stops_the_garbage_collection_of_every_shard(self):
+        '''
+        Tests that closing the DB stops the value log garbage collection of every shard.
+        '''
+        db = ShardedLSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME, NUM_SHARDS)
+        db.set_value_separation_threshold(10)
+        threads = [shard.value_log_gc_thread for shard in db.shards]
+
+        db.close()
+
+        for thread in threads:
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+
+    def test_db_set_stores_pair_in_owning_shard(self):
+        '''
+        Tests that each key is only stored in the shard that owns it.
+        '''
+        db = ShardedLSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME, NUM_SHARDS)
+
+        for i in range(20):
+            db.db_set('key{}'.format(i), 'value{}'.format(i))
+
+        for i in range(20):
+            key = 'key{}'.format(i)
+            for shard in db.shards:
+                self.assertEqual(shard.memtable.contains(key), shard is db.shard(key))
+            self.assertEqual(db.db_get(key), 'value{}'.format(i))
+
+    def test_db_get_many_returns_values_in_order(self):
+        '''
+        Tests that multi-key lookups return the values in the order of the keys,
+        with None for missing keys.
+        '''
+        db = ShardedLSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME, NUM_SHARDS)
+        db.set_threshold(40)
+
+        for i in range(20):
+            db.db_set('key{}'.format(i), 'value{}'.format(i))
+
+        keys = ['key3', 'missing', 'key17', 'key0', 'key3']
+        self.assertEqual(db.db_get_many(keys), ['value3', None, 'value17', 'value0', 'value3'])
+
+    def test_set_threshold_splits_threshold_across_shards(self):
+        '''
+        Tests that each shard gets its share of the DB's threshold.
+        '''
+        db = ShardedLSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME, NUM_SHARDS)
+        db.set_threshold(1000)
+
+        for shard in db.shards:
+            self.assertEqual(shard.threshold, 250)
+
+    def test_flush_flushes_every_shard(self):
+        '''
+        Tests that flushing writes the memtable of every shard to disk.
+        '''
+        db = ShardedLSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME, NUM_SHARDS)
+        for i in range(20):
+            db.db_set('key{}'.format(i), 'value{}'.format(i))
+
+        db.flush()
+
+        for shard in db.shards:
+            self.assertEqual(shard.memtable.count, 0)
+            self.assertEqual(shard.segments, [TEST_FILENAME])
+        self.assertEqual(db.db_get('key7'), 'value7')
+
+    def test_stats_sum_amplification_of_every_shard(self):
+        '''
+        Tests that the amplification of the whole DB adds up the shards'.
+        '''
+        db = ShardedLSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME, NUM_SHARDS)
+        for i in range(20):
+            db.db_set('key{}'.format(i), 'value{}'.format(i))
+        db.flush()
+
+        stats = db.stats(measure_space=True)
+        self.assertEqual(stats['amplification.user_bytes'], sum(
+            stats['shard-{}.amplification.user_bytes'.format(number)] for number in range(NUM_SHARDS)))
+        self.assertEqual(stats['amplification.live_bytes'], stats['amplification.disk_bytes'])
+        self.assertEqual(stats['amplification.space'], 1.0)
+
+    def test_snapshot_covers_every_shard(self):
+        '''
+        Tests that a snapshot hides later writes to every shard.
+        '''
+        db = ShardedLSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME, NUM_SHARDS)
+        keys = ['key{}'.format(i) for i in range(20)]
+        for key in keys:
+            db.db_set(key, 'old')
+
+        with db.snapshot() as snapshot:
+            for key in keys:
+                db.db_set(key, 'new')
+            db.flush()
+
+            self.assertEqual(db.db_get_many(keys, snapshot), ['old'] * len(keys))
+            self.assertEqual(db.db_get('key3', snapshot), 'old')
+            self.assertEqual([value for _, value in db.scan(snapshot=snapshot)], ['old'] * len(keys))
+        self.assertEqual(db.db_get_many(keys), ['new'] * len(keys))
+        for shard in db.shards:
+            self.assertEqual(shard.snapshots, [])
+
+    def test_checkpoint_restores_every_shard(self):
+        '''
+        Tests that a checkpoint of every shard can be restored as a whole DB.
+        '''
+        db = ShardedLSMTree(TEST_FILENAME, TEST_BASEPATH, BKUP_NAME, NUM_SHARDS)
+        for i in range(20):
+            db.db_set('key{}'.format(i), 'value{}'.format(i))
+
+        with tempfile.TemporaryDirectory() as directory:
+            checkpoint = directory + '/checkpoint'
+            report = db.checkpoint(checkpoint)
+            self.assertEqual(sum(report['shard-{}.segments'.format(n)] for n in range(NUM_SHARDS)), NUM_SHARDS)
+
+            restore_checkpoint(checkpoint, directory + '/restored')
+            restored = ShardedLSMTree(TEST_FILENAME, directory + '/restored/', BKUP_NAME, NUM_SHARDS)
+            for i in range(20):
+                self.assertEqual(restored.db_get('key{}'.format(i)), 'value{}'.format(i))
@@ -0,0 +1,106 @@
+import unittest
+import os
+import shutil
+from src.value_log import CorruptValueLogError, ValueLog, is_pointer, parse_pointer
+
+TEST_BASEPATH = 'test-value-log/'
+
+class ValueLogTests(unittest.TestCase):
+    def setUp(self):
+        os.makedirs(TEST_BASEPATH, exist_ok=True)
+
+    def tearDown(self):
+        shutil.rmtree(TEST_BASEPATH)
+
+    def test_append_returns_pointer_to_value(self):
+        '''
+        Tests that values are read back through the pointers to them.
+        '''
+        log = ValueLog(TEST_BASEPATH)
+        first = log.append('chris', 'lessard,\nhemsworth')
+        second = log.append('john', 'smith')
+        log.sync()
+
+        self.assertTrue(is_pointer(first))
+        self.assertEqual(parse_pointer(second)[:2], (1, parse_pointer(first)[2]))
+        self.assertEqual(log.read(first), 'lessard,\nhemsworth')
+        self.assertEqual(log.read(second), 'smith')
+
+    def test_log_is_used_once_a_value_is_appended(self):
+        '''
+        Tests that a log only counts as used once it holds a file.
+        '''
+        log = ValueLog(TEST_BASEPATH)
+        self.assertFalse(log.used)
+        log.append('chris', 'lessard')
+        log.seal()
+        self.assertTrue(log.used)
+        self.assertTrue(ValueLog(TEST_BASEPATH).used)
+
+    def test_reopened_log_starts_new_file(self):
+        '''
+        Tests that a log appends to a new file when it is opened again.
+        '''
+        log = ValueLog(TEST_BASEPATH)
+        pointer = log.append('chris', 'lessard')
+        log.sync()
+
+        log = ValueLog(TEST_BASEPATH)
+        self.assertEqual(log.sealed_files(), [1])
+        self.assertEqual(parse_pointer(log.append('john', 'smith'))[0], 2)
+        self.assertEqual(log.read(pointer), 'lessard')
+
+    def test_seal_moves_on_to_next_file(self):
+        '''
+        Tests that sealing the current file makes the next append start another.
+        '''
+        log = ValueLog(TEST_BASEPATH)
+        log.append('chris', 'lessard')
+        log.seal()
+        log.append('john', 'smith')
+        log.sync()
+
+        self.assertEqual(log.file_numbers(), [1, 2])
+        self.assertEqual(log.sealed_files(), [1])
+
+    def test_records_yields_pointers(self):
+        '''
+        Tests that the records of a file are yielded with the pointers to them.
+        '''
+        log = ValueLog(TEST_BASEPATH)
+        pointers = [log.append('chris', 'lessard'), log.append('john', 'smith')]
+        log.seal()
+
+        self.assertEqual(list(log.records(1)), [
+            ('chris', 'lessard', pointers[0]), ('john', 'smith', pointers[1])])
+
+    def test_read_raises_on_corrupt_record(self):
+        '''
+        Tests that a record failing its checksum isn't returned.
+        '''
+        log = ValueLog(TEST_BASEPATH)
+        pointer = log.append('chris', 'lessard')
+        log.seal()
+        with open(log.path(1), 'r+b') as s:
+            s.seek(-1, os.SEEK_END)
+            s.write(b'X')
+
+        with self.assertRaises(CorruptValueLogError):
+            log.read(pointer)
+        self.assertEqual(list(log.records(1)), [])
+
+    def test_remove_deletes_file(self):
+        '''
+        Tests that removed files are gone from the log.
+        '''
+        log = ValueLog(TEST_BASEPATH)
+        pointer = log.append('chris', 'lessard')
+        log.seal()
+        log.read(pointer)
+        log.remove(1)
+
+        self.assertEqual(log.file_numbers(), [])
+        self.assertEqual(log.disk_size(), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+import unittest
+import os
+import shutil
+from multiprocessing.connection import Listener
+from pathlib import Path
+from src.expiry import now_ms, split_expiry
+from src.lsm_tree import LSMTree
+from src.workers import WorkerEngine
+
+TEST_FILENAME = 'test_file-1'
+TEST_BASEPATH = 'test-workers/'
+BKUP_NAME = 'test_backup'
+AUTHKEY = b'test'
+NUM_WORKERS = 2
+
+class WorkerEngineTests(unittest.TestCase):
+    def setUp(self):
+        Path(TEST_BASEPATH).mkdir(exist_ok=True)
+
+        listeners = [Listener(family='AF_UNIX', authkey=AUTHKEY) for _ in range(NUM_WORKERS)]
+        addresses = [listener.address for listener in listeners]
+
+        self.workers = []
+        for worker_id in range(NUM_WORKERS):
+            tree = LSMTree(TEST_FILENAME, TEST_BASEPATH + 'worker-{}/'.format(worker_id), BKUP_NAME)
+            worker = WorkerEngine(worker_id, tree, listeners[worker_id], addresses, AUTHKEY, TEST_BASEPATH)
+            worker.serve()
+            self.workers.append(worker)
+
+    def tearDown(self):
+        shutil.rmtree(TEST_BASEPATH)
+
+    def keys_owned_by(self, worker_id, count):
+        keys = []
+        i = 0
+        while len(keys) < count:
+            key = 'key{}'.format(i)
+            if self.workers[0].owner(key) == worker_id:
+                keys.append(key)
+            i += 1
+        return keys
+
+    def test_owner_is_the_same_for_every_worker(self):
+        '''
+        Tests that all workers agree on who owns a key.
+        '''
+        for i in range(100):
+            key = 'key{}'.format(i)
+            self.assertEqual(self.workers[0].owner(key), self.workers[1].owner(key))
+
+    def test_db_set_stores_pair_with_owner(self):
+        '''
+        Tests that writes are routed to the worker that owns the key.
+        '''
+        key0, = self.keys_owned_by(0, 1)
+        key1, = self.keys_owned_by(1, 1)
+
+        self.workers[0].db_set(key1, 'remote')
+        self.workers[0].db_set(key0, 'local')
+
+        self.assertEqual(self.workers[1].engine.memtable.find_node(key1).value, 'remote')
+        self.assertIsNone(self.workers[0].engine.memtable.find_node(key1))
+        self.assertEqual(self.workers[0].engine.memtable.find_node(key0).value, 'local')
+
+    def test_db_get_reads_from_any_worker(self):
+        '''
+        Tests that every worker can read keys owned by another worker.
+        '''
+        for key in self.keys_owned_by(0, 3) + self.keys_owned_by(1, 3):
+            self.workers[0].db_set(key, key.upper())
+
+        for worker in self.workers:
+            for key in self.keys_owned_by(0, 3) + self.keys_owned_by(1, 3):
+                self.assertEqual(worker.db_get(key), key.upper())
+
+        self.assertIsNone(self.workers[1].db_get('missing'))
+
+    def test_flush_flushes_every_worker(self):
+        '''
+        Tests that flushing through one worker flushes the memtables of all workers.
+        '''
+        for key in self.keys_owned_by(0, 2) + self.keys_owned_by(1, 2):
+            self.workers[1].db_set(key, 'value')
+
+        self.workers[1].flush()
+
+        for worker_id, worker in enumerate(self.workers):
+            self.assertEqual(worker.engine.memtable.count, 0)
+            self.assertTrue(os.path.exists(TEST_BASEPATH + 'worker-{}/'.format(worker_id) + TEST_FILENAME))
+
+    def test_db_get_many_returns_values_from_every_worker(self):
+        '''
+        Tests that multi-key lookups gather the values from every owner, in order.
+        '''
+        key0, = self.keys_owned_by(0, 1)
+        key1, = self.keys_owned_by(1, 1)
+        self.workers[0].db_set(key0, 'zero')
+        self.workers[0].db_set(key1, 'one')
+
+        values = self.workers[1].db_get_many([key1, 'missing', key0])
+        self.assertEqual(values, ['one', None, 'zero'])
+
+    def test_scan_merges_every_worker_with_expiry_times(self):
+        '''
+        Tests that scans return the pairs of every worker in key order, and their
+        expiry times if asked to.
+        '''
+        key0, = self.keys_owned_by(0, 1)
+        key1, = self.keys_owned_by(1, 1)
+        self.workers[0].db_set(key0, 'zero')
+        self.workers[0].db_set(key1, 'one', expires_at=now_ms() + 60000)
+
+        self.assertEqual(list(self.workers[1].scan()), sorted([(key0, 'zero'), (key1, 'one')]))
+        stored = dict(self.workers[1].scan(with_expiry=True))
+        self.assertEqual(split_expiry(stored[key0]), ('zero', None))
+        self.assertEqual(split_expiry(stored[key1])[0], 'one')
+        self.assertIsNotNone(split_expiry(stored[key1])[1])
+
+    def test_stats_gathers_the_stats_of_every_worker(self):
+        '''
+        Tests that statistics are reported for each worker.
+        '''
+        stats = self.workers[0].stats()
+        self.assertEqual(stats['worker-0.filter_type'], 'bloom')
+        self.assertEqual(stats['worker-1.filter_type'], 'bloom')
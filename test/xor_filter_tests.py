@@ -0,0 +1,57 @@
+import unittest
+import os
+import tempfile
+from src.xor_filter import XorFilter, load
+
+class XorFilterTests(unittest.TestCase):
+    def test_check_finds_every_key(self):
+        '''
+        Tests that an xor filter never rules out one of its keys.
+        '''
+        keys = ['key{}'.format(i) for i in range(1000)]
+        xf = XorFilter(keys)
+
+        for key in keys:
+            self.assertTrue(xf.check(key))
+        self.assertTrue(all(xf.check_many(keys)))
+
+    def test_false_positive_rate_is_one_in_256(self):
+        '''
+        Tests that the measured false positive rate matches 8 bit fingerprints.
+        '''
+        xf = XorFilter(['key{}'.format(i) for i in range(10000)])
+
+        others = ['other{}'.format(i) for i in range(20000)]
+        false_positives = sum(xf.check_many(others))
+        self.assertLess(false_positives / 20000, 0.008)
+        self.assertEqual(xf.check_many(others), [xf.check(key) for key in others])
+
+    def test_uses_fewer_bits_per_key_than_bloom_filter(self):
+        '''
+        Tests that the filter holds about 9.84 bits per key.
+        '''
+        xf = XorFilter(['key{}'.format(i) for i in range(10000)])
+        self.assertLess(len(xf.fingerprints) * 8 / 10000, 10)
+
+    def test_empty_and_duplicate_keys(self):
+        '''
+        Tests that filters can be built with no keys, or the same key twice.
+        '''
+        self.assertFalse(XorFilter([]).check('key'))
+        self.assertTrue(XorFilter(['key', 'key']).check('key'))
+
+    def test_load_returns_an_equivalent_filter(self):
+        '''
+        Tests that a saved filter loads back with the same answers.
+        '''
+        keys = ['key{}'.format(i) for i in range(500)]
+        xf = XorFilter(keys)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'segment.xor')
+            xf.save(path)
+            loaded = load(path)
+
+            self.assertEqual(loaded.seed, xf.seed)
+            self.assertTrue(all(loaded.check_many(keys)))
+            others = ['other{}'.format(i) for i in range(500)]
+            self.assertEqual(loaded.check_many(others), xf.check_many(others))